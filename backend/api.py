@@ -13,22 +13,78 @@
 # limitations under the License.
 
 """Expose REST API for product cataloging functionality."""
+import startup # first, so the imports below are timed per dependency
+startup.timed_import(startup.DEPENDENCIES)
+
+from contextlib import asynccontextmanager
 import os
-from typing import Optional
-from fastapi import FastAPI, Query
+import time
+from typing import AsyncIterator, NamedTuple, Optional
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from pydantic import BaseModel
 
 import attributes
 import category
+import config
+import enrich
 import marketing
+import metrics
+import taxonomy
 
 class Product(BaseModel):
     description: str
     category: Optional[list[str]] = []
     main_image_base64: Optional[str] = None
 
-app = FastAPI()
+class Enrichment(BaseModel):
+    categories: list[list[str]]
+    attributes: dict[str,str]
+    marketing_copy: Optional[str] = None
+    timings_ms: dict[str,float]
+
+class CategoriesResult(BaseModel):
+    categories: Optional[list[list[str]]] = None
+    error: Optional[str] = None
+
+class AttributesResult(BaseModel):
+    attributes: Optional[dict[str,str]] = None
+    error: Optional[str] = None
+
+class CategoryCompletion(BaseModel):
+    category: list[str]
+    count: int
+
+class Upload(NamedTuple):
+    description: str
+    category: list[str]
+    image: Optional[bytes]
+
+# Documents the request body of the :upload endpoints, which parse it themselves
+UPLOAD_BODY = {'requestBody': {'required': True, 'content': {
+    'multipart/form-data': {'schema': {
+        'type': 'object',
+        'required': ['description'],
+        'properties': {
+            'description': {'type': 'string'},
+            'category': {'type': 'array', 'items': {'type': 'string'}},
+            'image': {'type': 'string', 'format': 'binary'},
+        }}},
+    'application/octet-stream': {'schema': {'type': 'string', 'format': 'binary'}},
+}}}
+
+warmup = startup.Warmup()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if config.WARMUP_ENABLED:
+        warmup.start()
+    yield
+    warmup.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:4000",
@@ -44,8 +100,93 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get('route')
+    metrics.HTTP_SECONDS.labels(
+        request.method, route.path if route else 'unmatched', response.status_code
+    ).observe(time.perf_counter() - start)
+    return response
+
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    """Prometheus metrics.
+
+    Latency histograms per API route and per stage (embedding,
+    nearest_neighbors, reference_join, rank, attributes, marketing), sizes of
+    upstream calls, neighbor counts, LLM prompt and response characters,
+    fallback counts, and cache and rate limiter counters. See metrics.py.
+    """
+    return Response(generate_latest(metrics.REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/ready")
+async def ready() -> JSONResponse:
+    """Readiness probe.
+
+    Returns 200 once clients are created, connections primed and indexes
+    loaded, 503 before. The body reports where startup time went, in
+    seconds: imports per module, warmup per step and initialization per
+    client, plus the errors of warmup steps being retried.
+    """
+    if not config.WARMUP_ENABLED:
+        return JSONResponse({'ready': True})
+    report = warmup.report()
+    return JSONResponse(report, status_code=200 if report['ready'] else 503)
+
+def _observe_base64(product: Product):
+    if product.main_image_base64:
+        metrics.REQUEST_IMAGE_BYTES.labels('base64').observe(len(product.main_image_base64))
+
+async def _upload(request: Request) -> Upload:
+    """Parse the body of an :upload endpoint.
+
+    Either a multipart form with description, category (repeated, one per
+    level) and image fields, or the raw image as an application/octet-stream
+    body with description and category as query parameters. The image is
+    passed on as bytes, it is neither base64 encoded nor copied into a JSON
+    string. Like any other image it is then downsized by embeddings.embed()
+    if config.IMAGE_NORMALIZATION is set.
+
+    Raw bodies are read in chunks and rejected with a 413 as soon as they
+    exceed config.UPLOAD_MAX_BYTES, also when sent without a Content-Length.
+    """
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        async with request.form(max_files=1) as form:
+            file = form.get('image')
+            upload = Upload(
+                form.get('description'),
+                form.getlist('category'),
+                await file.read(config.UPLOAD_MAX_BYTES + 1) if file else None)
+        encoding = 'multipart'
+    elif content_type.startswith('application/octet-stream'):
+        if int(request.headers.get('content-length', 0)) > config.UPLOAD_MAX_BYTES:
+            raise HTTPException(413, f'Images are limited to {config.UPLOAD_MAX_BYTES} bytes')
+        chunks, size = [], 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > config.UPLOAD_MAX_BYTES:
+                raise HTTPException(413, f'Images are limited to {config.UPLOAD_MAX_BYTES} bytes')
+            chunks.append(chunk)
+        upload = Upload(
+            request.query_params.get('description'),
+            request.query_params.getlist('category'),
+            b''.join(chunks) or None)
+        encoding = 'octet-stream'
+    else:
+        raise HTTPException(415, 'Send a multipart/form-data or application/octet-stream body')
+    if not upload.description:
+        raise HTTPException(422, 'description is required')
+    if upload.image:
+        if len(upload.image) > config.UPLOAD_MAX_BYTES:
+            raise HTTPException(413, f'Images are limited to {config.UPLOAD_MAX_BYTES} bytes')
+        metrics.REQUEST_IMAGE_BYTES.labels(encoding).observe(len(upload.image))
+    return upload
+
 @app.post("/v1/categories/")
-def suggest_categories(product: Product) -> list[list[str]]:
+async def suggest_categories(product: Product) -> list[list[str]]:
     """Suggest categories for product.
     
     Args:
@@ -67,14 +208,87 @@ def suggest_categories(product: Product) -> list[list[str]]:
     with each string in the list representing a category level e.g. 
     ['Mens', 'Pants', 'Jeans']
     """
-    return category.retrieve_and_rank(
+    _observe_base64(product)
+    return await category.retrieve_and_rank_async(
         product.description, 
         product.main_image_base64, 
         base64=True, 
         filters=product.category)
 
+@app.get("/v1/categories/autocomplete")
+async def autocomplete_categories(
+    q: str = '',
+    category: list[str] = Query([]),
+    limit: int = Query(10, ge=1, le=100)) -> list[CategoryCompletion]:
+    """Autocomplete category names.
+
+    Served from an in-memory copy of the category tree, without calling
+    BigQuery or any model.
+
+    Args:
+    - q: start of a word of the category name, case insensitive. Empty to
+        list the subcategories of category
+    - category (optional, repeated once per level): only complete categories
+        under this category prefix e.g. ?category=Mens&category=Pants
+    - limit (optional): max number of results, 10 by default
+
+    Returns:
+
+    Fully qualified categories, with their number of products, most products
+    first e.g. [{"category": ["Mens", "Pants", "Jeans"], "count": 120}]
+    """
+    tree = taxonomy.get_taxonomy()
+    if tree is None:
+        raise HTTPException(503, 'Category taxonomy is disabled or unavailable')
+    return [CategoryCompletion(category=list(path), count=count)
+            for path, count in tree.autocomplete(q, category, limit)]
+
+@app.post("/v1/categories:upload", openapi_extra=UPLOAD_BODY)
+async def suggest_categories_upload(request: Request) -> list[list[str]]:
+    """Suggest categories for product, with the image sent as raw bytes.
+
+    Same as /v1/categories/ without the base64 and JSON overhead on the
+    image. Send either:
+    - a multipart/form-data body with fields description, category
+        (optional, repeated once per level) and image (optional, file)
+    - the image as an application/octet-stream body, with description and
+        category (optional, repeated once per level) as query parameters
+    """
+    upload = await _upload(request)
+    return await category.retrieve_and_rank_async(
+        upload.description,
+        upload.image,
+        filters=upload.category)
+
+def _batch_items(products: list[Product]) -> list[enrich.BatchItem]:
+    if len(products) > config.BATCH_MAX_PRODUCTS:
+        raise HTTPException(413, f'Batches are limited to {config.BATCH_MAX_PRODUCTS} products')
+    for product in products:
+        _observe_base64(product)
+    return [enrich.BatchItem(p.description, p.main_image_base64, True, p.category) for p in products]
+
+@app.post("/v1/categories:batch")
+async def suggest_categories_batch(products: list[Product]) -> list[CategoriesResult]:
+    """Suggest categories for many products.
+
+    Same as calling /v1/categories/ for each product, but the products are
+    embedded in batched calls, searched with one vector search call (per
+    distinct category filter) and joined against the reference table once.
+
+    Args:
+    - list of products, see /v1/categories/. At most config.BATCH_MAX_PRODUCTS
+
+    Returns:
+
+    One result per product, in order, with either categories (see
+    /v1/categories/) or error set
+    """
+    results = await enrich.suggest_categories_batch_async(_batch_items(products))
+    return [CategoriesResult(error=str(r)) if isinstance(r, Exception) else CategoriesResult(categories=r)
+            for r in results]
+
 @app.post("/v1/marketing/")
-def generate_marketing_copy(
+async def generate_marketing_copy(
     description: str, attributes: dict[str, str]) -> str:
     """Generate Marketing Copy.
     
@@ -86,10 +300,45 @@ def generate_marketing_copy(
     
     Marketing copy that can be used for a product page.
     """
-    return marketing.generate_marketing_copy(description, attributes)
+    return await marketing.generate_marketing_copy_async(description, attributes)
+
+def _sse(data: str, event: Optional[str] = None) -> str:
+    """Format one Server-Sent Event, splitting multi-line data."""
+    lines = [f'event: {event}'] if event else []
+    lines += [f'data: {line}' for line in data.split('\n')]
+    return '\n'.join(lines) + '\n\n'
+
+async def _sse_stream(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    try:
+        async for chunk in chunks:
+            yield _sse(chunk)
+    except Exception as e:
+        yield _sse(str(e), event='error')
+        return
+    yield _sse('', event='done')
+
+@app.post("/v1/marketing:stream")
+async def stream_marketing_copy(
+    description: str, attributes: dict[str, str]) -> StreamingResponse:
+    """Stream Marketing Copy.
+
+    Same as /v1/marketing/ but the copy is sent as Server-Sent Events while it
+    is generated. Each chunk of copy is a 'data' event, concatenate them in
+    order (multi-line chunks are split over several 'data' lines). The
+    stream ends with a 'done' event, or an 'error' event whose data is the
+    error message. Generation is cancelled if the client disconnects.
+
+    Args:
+    - description: sparse description of product
+    - attributes: pass as JSON key value pairs e.g. {'color':'green', 'pattern': 'striped'}
+    """
+    return StreamingResponse(
+        _sse_stream(marketing.stream_marketing_copy(description, attributes)),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.post("/v1/attributes/")
-def suggest_attributes(product: Product) -> dict[str,str]:
+async def suggest_attributes(product: Product) -> dict[str,str]:
     """Suggests attributes for product.
 
     Args:
@@ -106,9 +355,91 @@ def suggest_attributes(product: Product) -> dict[str,str]:
     JSON dictionary representing attributes as key value pairs e.g. 
     {'color':'green', 'pattern': 'striped'}
     """
-    return attributes.retrieve_and_generate_attributes(
+    _observe_base64(product)
+    return await attributes.retrieve_and_generate_attributes_async(
         product.description, 
         product.category, 
         product.main_image_base64, 
         base64=True,
-        filters=product.category)
\ No newline at end of file
+        filters=product.category)
+
+@app.post("/v1/attributes:upload", openapi_extra=UPLOAD_BODY)
+async def suggest_attributes_upload(request: Request) -> dict[str,str]:
+    """Suggests attributes for product, with the image sent as raw bytes.
+
+    Same as /v1/attributes/, see /v1/categories:upload for the request body.
+    """
+    upload = await _upload(request)
+    return await attributes.retrieve_and_generate_attributes_async(
+        upload.description,
+        upload.category,
+        upload.image,
+        filters=upload.category)
+
+@app.post("/v1/attributes:batch")
+async def suggest_attributes_batch(products: list[Product]) -> list[AttributesResult]:
+    """Suggest attributes for many products.
+
+    Same as calling /v1/attributes/ for each product, with retrieval shared
+    as in /v1/categories:batch.
+
+    Args:
+    - list of products, see /v1/attributes/. At most config.BATCH_MAX_PRODUCTS
+
+    Returns:
+
+    One result per product, in order, with either attributes (see
+    /v1/attributes/) or error set
+    """
+    results = await enrich.suggest_attributes_batch_async(_batch_items(products))
+    return [AttributesResult(error=str(r)) if isinstance(r, Exception) else AttributesResult(attributes=r)
+            for r in results]
+
+@app.post("/v1/enrich/")
+async def enrich_product(
+    product: Product, include_marketing_copy: bool = False) -> Enrichment:
+    """Suggest categories and attributes, and optionally marketing copy.
+
+    Equivalent to calling /v1/categories/, /v1/attributes/ and
+    /v1/marketing/ in sequence, but the product is embedded, searched and
+    joined against the reference table only once, and the category and
+    attribute LLM calls run concurrently.
+
+    Args:
+    - description: Sparse description of product
+    - category (optional): category prefix to restrict the suggestions space,
+        see /v1/categories/
+    - main_image_base64 (optional): base64 encoded string representing product
+            image.
+    - include_marketing_copy (optional): also generate marketing copy
+
+    Returns:
+
+    JSON object with the following keys:
+    - categories: see /v1/categories/
+    - attributes: see /v1/attributes/
+    - marketing_copy: see /v1/marketing/, null unless requested
+    - timings_ms: wall time of each stage in milliseconds
+    """
+    _observe_base64(product)
+    return await enrich.enrich_async(
+        product.description,
+        product.main_image_base64,
+        base64=True,
+        filters=product.category,
+        include_marketing_copy=include_marketing_copy)
+
+@app.post("/v1/enrich:upload", openapi_extra=UPLOAD_BODY)
+async def enrich_product_upload(
+    request: Request, include_marketing_copy: bool = False) -> Enrichment:
+    """Suggest categories and attributes, and optionally marketing copy, with
+    the image sent as raw bytes.
+
+    Same as /v1/enrich/, see /v1/categories:upload for the request body.
+    """
+    upload = await _upload(request)
+    return await enrich.enrich_async(
+        upload.description,
+        upload.image,
+        filters=upload.category,
+        include_marketing_copy=include_marketing_copy)
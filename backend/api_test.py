@@ -16,6 +16,7 @@
 
 Make sure to update the ENDPOINT variable as appropriate before running.
 """
+import base64
 import logging; logging.basicConfig(level=logging.INFO)
 import requests
 import unittest
@@ -70,6 +71,43 @@ class APITest(unittest.TestCase):
     self.assertIsInstance(res.json()[0][0],str)
     logging.info(res.json())
 
+  def test_category_autocomplete(self):
+    res = requests.get(
+      ENDPOINT+'categories/autocomplete', 
+      params={'q':config.TEST_CATEGORY_L0[:3]},
+      headers=headers
+      )
+    self.assertEqual(res.status_code, 200)
+    self.assertIn([config.TEST_CATEGORY_L0], [c['category'] for c in res.json()])
+    self.assertGreater(res.json()[0]['count'],0)
+    logging.info(res.json())
+
+  def test_category_upload(self):
+    image = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNk+A8AAQUBAScY42YAAAAASUVORK5CYII=')
+    res = requests.post(
+      ENDPOINT+'categories:upload', 
+      data={'description':'test description', 'category':[config.TEST_CATEGORY_L0]},
+      files={'image':('image.png', image, 'image/png')},
+      headers=headers
+      )
+    self.assertEqual(res.status_code, 200)
+    self.assertIsInstance(res.json(),list)
+    self.assertIsInstance(res.json()[0],list)
+    self.assertIsInstance(res.json()[0][0],str)
+    logging.info(res.json())
+
+  def test_category_batch(self):
+    res = requests.post(
+      ENDPOINT+'categories:batch', 
+      json=[{'description':'test description'}, {'description':'test description', 'category':[config.TEST_CATEGORY_L0]}],
+      headers=headers
+      )
+    self.assertEqual(res.status_code, 200)
+    self.assertEqual(len(res.json()),2)
+    self.assertIsNone(res.json()[1]['error'])
+    self.assertEqual(res.json()[1]['categories'][0][0],config.TEST_CATEGORY_L0)
+    logging.info(res.json())
+
   def test_generate_marketing_copy(self):
     res = requests.post(
       ENDPOINT+'marketing/', 
@@ -81,6 +119,21 @@ class APITest(unittest.TestCase):
     self.assertIsInstance(res.text,str)
     logging.info(res.text)
 
+  def test_stream_marketing_copy(self):
+    res = requests.post(
+      ENDPOINT+'marketing:stream', 
+      params={'description':'Mens Hooded Puffer Jacket'},
+      json={'attributes': '{"color":"green", "material": "down"}'},
+      headers=headers,
+      stream=True
+      )
+    self.assertEqual(res.status_code, 200)
+    self.assertTrue(res.headers['content-type'].startswith('text/event-stream'))
+    events = res.text.strip().split('\n\n')
+    self.assertGreater(len(events), 1)
+    self.assertEqual(events[-1].splitlines()[0], 'event: done')
+    logging.info(res.text)
+
   def test_attributes(self):
     image_base64 = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNk+A8AAQUBAScY42YAAAAASUVORK5CYII='
     res = requests.post(
@@ -105,5 +158,43 @@ class APITest(unittest.TestCase):
     self.assertGreater(len(res.json()),0)
     logging.info(res.json())
 
+  def test_attributes_upload(self):
+    image = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNk+A8AAQUBAScY42YAAAAASUVORK5CYII=')
+    res = requests.post(
+      ENDPOINT+'attributes:upload', 
+      params={'description':'test description'},
+      data=image,
+      headers={**headers, 'Content-Type':'application/octet-stream'}
+      )
+    self.assertEqual(res.status_code, 200)
+    self.assertIsInstance(res.json(),dict)
+    self.assertGreater(len(res.json()),0)
+    logging.info(res.json())
+
+  def test_attributes_batch(self):
+    res = requests.post(
+      ENDPOINT+'attributes:batch', 
+      json=[{'description':'test description'}, {'description':'another test description'}],
+      headers=headers
+      )
+    self.assertEqual(res.status_code, 200)
+    self.assertEqual(len(res.json()),2)
+    self.assertGreater(len(res.json()[0]['attributes']),0)
+    logging.info(res.json())
+
+  def test_enrich(self):
+    res = requests.post(
+      ENDPOINT+'enrich/', 
+      params={'include_marketing_copy': True},
+      json={'description':'test description', 'category':[config.TEST_CATEGORY_L0]},
+      headers=headers
+      )
+    self.assertEqual(res.status_code, 200)
+    self.assertIsInstance(res.json()['categories'],list)
+    self.assertIsInstance(res.json()['attributes'],dict)
+    self.assertIsInstance(res.json()['marketing_copy'],str)
+    self.assertIsInstance(res.json()['timings_ms'],dict)
+    logging.info(res.json())
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -19,16 +19,44 @@ from typing import Union, Optional
 
 import config
 import embeddings
+import metrics
 import nearest_neighbors
+import reference_store
+import taxonomy
 import utils
 
-bq_client = utils.get_bq_client()
-llm = utils.get_llm()
+def _attributes_desc_query(ids: list[str]) -> str:
+    return f"""
+    SELECT
+        {config.COLUMN_ID},
+        {config.COLUMN_ATTRIBUTES},
+        {config.COLUMN_DESCRIPTION}
+    FROM
+        `{config.PRODUCT_REFERENCE_TABLE}`
+    WHERE
+        {config.COLUMN_ID} IN {str(ids).replace('[','(').replace(']',')')}
+    """
 
+def parse_attributes_desc(rows) -> dict[str:dict]:
+    """Map reference table rows to attributes and descriptions, see
+    join_attributes_desc()."""
+    attributes = {}
+    for row in rows:
+        attributes[row[config.COLUMN_ID]] = {}
+        attrs = row[config.COLUMN_ATTRIBUTES]
+        # attributes are pre-parsed in the reference snapshot
+        attributes[row[config.COLUMN_ID]]['attributes'] = attrs if isinstance(attrs, dict) else json.loads(attrs)
+        attributes[row[config.COLUMN_ID]]['description'] = row[config.COLUMN_DESCRIPTION]
+    return attributes
+
+@metrics.timed('reference_join')
 def join_attributes_desc(
     ids: list[str]) -> dict[str:dict]:
     """Gets the attributes and description for given product IDs.
 
+    Served from the reference snapshot when config.REFERENCE_SNAPSHOT_PATH is
+    set, from BigQuery otherwise.
+
     Args:
         ids: The product IDs to get the attributes for.
 
@@ -38,29 +66,27 @@ def join_attributes_desc(
             attributes: e.g. {'color':'green', 'pattern': striped}
             description: e.g. 'This is a description'
     """
-    query = f"""
-    SELECT
-        {config.COLUMN_ID},
-        {config.COLUMN_ATTRIBUTES},
-        {config.COLUMN_DESCRIPTION}
-    FROM
-        `{config.PRODUCT_REFERENCE_TABLE}`
-    WHERE
-        {config.COLUMN_ID} IN {str(ids).replace('[','(').replace(']',')')}
-    """
-    query_job = bq_client.query(query)
+    store = reference_store.get_store()
+    if store:
+        return parse_attributes_desc(store.rows(ids))
+    query_job = utils.get_bq_client().query(_attributes_desc_query(ids))
     rows = query_job.result()
-    attributes = {}
-    for row in rows:
-        attributes[row[config.COLUMN_ID]] = {}
-        attributes[row[config.COLUMN_ID]]['attributes'] = json.loads(row[config.COLUMN_ATTRIBUTES])
-        attributes[row[config.COLUMN_ID]]['description'] = row[config.COLUMN_DESCRIPTION]
-    return attributes
+    return parse_attributes_desc(rows)
+
+@metrics.timed('reference_join')
+async def join_attributes_desc_async(
+    ids: list[str]) -> dict[str:dict]:
+    """Async version of join_attributes_desc()."""
+    store = reference_store.get_store()
+    if store:
+        return parse_attributes_desc(await store.rows_async(ids))
+    rows = await utils.query_async(_attributes_desc_query(ids))
+    return parse_attributes_desc(rows)
 
 def retrieve(
     desc: str, 
     category: Optional[str] = None,
-    image: Optional[str] = None, 
+    image: Union[str, bytes, None] = None, 
     base64: bool = False,
     num_neighbors: int = config.NUM_NEIGHBORS,
     filters: list[str] = []) -> list[dict]:
@@ -72,7 +98,8 @@ def retrieve(
     Args:
         desc: user provided description of product
         category: category of the product
-        image: can be local file path, GCS URI or base64 encoded image
+        image: can be local file path, GCS URI, base64 encoded image or image
+          bytes
         base64: True indicates image is base64. False (default) will be 
           interpreted as image path (either local or GCS)
         num_neigbhors: number of nearest neighbors to return for EACH embedding
@@ -93,6 +120,28 @@ def retrieve(
       return []
     ids = [n.id[:-2] for n in neighbors] # last 3 chars are not part of product ID
     attributes_desc = join_attributes_desc(ids)
+    return _candidates(neighbors, attributes_desc)
+
+async def retrieve_async(
+    desc: str, 
+    category: Optional[str] = None,
+    image: Union[str, bytes, None] = None, 
+    base64: bool = False,
+    num_neighbors: int = config.NUM_NEIGHBORS,
+    filters: list[str] = []) -> list[dict]:
+    """Async version of retrieve()."""
+    res = await embeddings.embed_async(desc,image, base64)
+    embeds = [res.text_embedding, res.image_embedding] if res.image_embedding else [res.text_embedding]
+    neighbors = await nearest_neighbors.get_nn_async(embeds,filters)
+    if not neighbors:
+      return []
+    ids = [n.id[:-2] for n in neighbors] # last 3 chars are not part of product ID
+    attributes_desc = await join_attributes_desc_async(ids)
+    return _candidates(neighbors, attributes_desc)
+
+def _candidates(
+    neighbors: list[nearest_neighbors.Neighbor],
+    attributes_desc: dict[str:dict]) -> list[dict]:
     candidates = [
         {'attributes':attributes_desc[n.id[:-2]]['attributes'],
         'description':attributes_desc[n.id[:-2]]['description'],
@@ -132,6 +181,11 @@ Attributes:
     """
     return prompt
 
+def _cache_key(desc: str, candidates: list[dict]) -> str:
+    """LLM cache key of a prompt, the same for attribute dicts whose keys
+    are in a different order."""
+    return json.dumps([desc, [[c['description'], sorted(c['attributes'].items())] for c in candidates]])
+
 def parse_answer(ans: str) -> dict[str,str]:
     """Translate LLM response into dict.
 
@@ -146,6 +200,12 @@ def parse_answer(ans: str) -> dict[str,str]:
         d[k.strip()]=v.strip()
     return d
 
+LLM_PARAMETERS = {
+    "max_output_tokens": 256,
+    "temperature": 0.0,
+}
+
+@metrics.timed('attributes')
 def generate_attributes(
     desc: str,
     candidates: list[dict]
@@ -161,15 +221,30 @@ def generate_attributes(
     Returns: attributes in dict form e.g. {'color':'green', 'pattern': 'striped'}
     """
     prompt = generate_prompt(desc, candidates)
-    llm_parameters = {
-        "max_output_tokens": 256,
-        "temperature": 0.0,
-    }
-    response = llm.predict(
+    response = utils.get_cached_llm().predict(
         prompt,
-        **llm_parameters
+        cache_key=_cache_key(desc, candidates),
+        **LLM_PARAMETERS
     )
-    res = response.text
+    metrics.observe_llm('attributes', prompt, response.text)
+    return _parse_response(response.text)
+
+@metrics.timed('attributes')
+async def generate_attributes_async(
+    desc: str,
+    candidates: list[dict]
+) -> dict[str,str]:
+    """Async version of generate_attributes()."""
+    prompt = generate_prompt(desc, candidates)
+    response = await utils.get_cached_llm().predict_async(
+        prompt,
+        cache_key=_cache_key(desc, candidates),
+        **LLM_PARAMETERS
+    )
+    metrics.observe_llm('attributes', prompt, response.text)
+    return _parse_response(response.text)
+
+def _parse_response(res: str) -> dict[str,str]:
     if not res:
         raise ValueError('ERROR: No LLM response returned. This seems to be an intermittent bug')
     try:
@@ -182,7 +257,7 @@ def generate_attributes(
 def retrieve_and_generate_attributes(
     desc: str,
     category: Optional[str] = None,
-    image: Optional[str] = None,
+    image: Union[str, bytes, None] = None,
     base64: bool = False,
     num_neighbors: int = config.NUM_NEIGHBORS,
     filters: list[str] = []
@@ -195,7 +270,8 @@ def retrieve_and_generate_attributes(
     Args:
         desc: user provided description of product
         category: category of the product
-        image: can be local file path, GCS URI or base64 encoded image
+        image: can be local file path, GCS URI, base64 encoded image or image
+          bytes
         base64: True indicates image is base64. False (default) will be 
           interpreted as image path (either local or GCS)
         num_neigbhors: number of nearest neighbors to return for EACH embedding
@@ -203,6 +279,8 @@ def retrieve_and_generate_attributes(
 
     Returns: attributes in dict form e.g. {'color':'green', 'pattern': 'striped'}
     """
+    if not taxonomy.matches(filters):
+        return {'error':'ERROR: no existing products match that category'}
     candidates = retrieve(desc, category, image, base64, num_neighbors, filters)
     if filters and not candidates:
         return {'error':'ERROR: no existing products match that category'}
@@ -211,6 +289,35 @@ def retrieve_and_generate_attributes(
     except ValueError as e:
         logging.error(e)
         logging.error('Falling back to greedy approach')
+        metrics.FALLBACKS.labels('attributes', 'unparseable_response').inc()
         return candidates[0]['attributes']
 
-    
\ No newline at end of file
+async def retrieve_and_generate_attributes_async(
+    desc: str,
+    category: Optional[str] = None,
+    image: Union[str, bytes, None] = None,
+    base64: bool = False,
+    num_neighbors: int = config.NUM_NEIGHBORS,
+    filters: list[str] = []
+) -> dict[str,str]:
+    """Async version of retrieve_and_generate_attributes()."""
+    if not taxonomy.matches(filters):
+        return {'error':'ERROR: no existing products match that category'}
+    candidates = await retrieve_async(desc, category, image, base64, num_neighbors, filters)
+    if filters and not candidates:
+        return {'error':'ERROR: no existing products match that category'}
+    return await generate_attributes_with_fallback_async(desc, candidates)
+
+async def generate_attributes_with_fallback_async(
+    desc: str,
+    candidates: list[dict]
+) -> dict[str,str]:
+    """generate_attributes_async() falling back to the closest candidate's
+    attributes if the LLM answer can't be parsed."""
+    try:
+        return await generate_attributes_async(desc, candidates)
+    except ValueError as e:
+        logging.error(e)
+        logging.error('Falling back to greedy approach')
+        metrics.FALLBACKS.labels('attributes', 'unparseable_response').inc()
+        return candidates[0]['attributes']
@@ -19,6 +19,7 @@ These tests assume:
 -The test is run from an environment that has permission to call cloud APIs
 """
 import logging; logging.basicConfig(level=logging.INFO)
+import asyncio
 import unittest
 
 import attributes
@@ -47,6 +48,12 @@ class AttributesTest(unittest.TestCase):
     logging.info(res)
     self.assertIsInstance(res, str)
 
+  def test_prompt_keeps_attribute_order(self):
+    candidates = [{'description': 'Apple', 'attributes': {'Taste':'sweet', 'Color':'green'}}]
+    reordered = [{'description': 'Apple', 'attributes': {'Color':'green', 'Taste':'sweet'}}]
+    self.assertIn('Taste:sweet|Color:green', attributes.generate_prompt('desc', candidates))
+    self.assertEqual(attributes._cache_key('desc', candidates), attributes._cache_key('desc', reordered))
+
   def test_retrieve_no_category(self):
     res = attributes.retrieve(
         'This is a test description',
@@ -107,5 +114,15 @@ class AttributesTest(unittest.TestCase):
     self.assertIsInstance(res, dict)
     self.assertGreater(len(res),0)
 
+  def test_retrieve_and_generate_attributes_async(self):
+    res = asyncio.run(attributes.retrieve_and_generate_attributes_async(
+        'Fleece Jacket',
+        None,
+        config.TEST_GCS_IMAGE
+    ))
+    logging.info(res)
+    self.assertIsInstance(res, dict)
+    self.assertGreater(len(res),0)
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
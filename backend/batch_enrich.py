@@ -0,0 +1,291 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Enrich a catalog of products in bulk.
+
+Products are read from a JSONL, CSV or Parquet file and run through
+enrich.enrich_async() with bounded concurrency. Results are written to
+numbered Parquet files in the output directory, each followed by an update
+of _checkpoint.json, so an interrupted run picks up where it stopped when
+started again with the same arguments:
+
+    python batch_enrich.py products.jsonl enriched/ --concurrency 32
+
+The output directory can be read as one table with
+pyarrow.parquet.read_table(). Every input row produces one output row. Rows that failed have their error
+message in the error column and are not retried on resume; select them and
+run them again as a separate input if needed.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+from typing import Iterator, Optional
+
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.parquet as pq
+
+import config
+import enrich
+
+CHECKPOINT = '_checkpoint.json' # '_' prefix so pq.read_table(output_dir) skips it
+CATEGORY_SEPARATOR = '->' # separates category levels in CSV filter columns
+
+SCHEMA = pa.schema([
+    ('row', pa.int64()),
+    ('id', pa.string()),
+    ('categories', pa.list_(pa.list_(pa.string()))),
+    ('attributes', pa.map_(pa.string(), pa.string())),
+    ('marketing_copy', pa.string()),
+    ('error', pa.string()),
+    ('latency_ms', pa.float64()),
+])
+
+
+def read_products(path: str, batch_size: int = 10000) -> Iterator[dict]:
+    """Stream products from a .jsonl/.json, .csv or .parquet file as dicts."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.jsonl', '.json'):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    if ext == '.csv':
+        batches = pyarrow.csv.open_csv(
+            path, read_options=pyarrow.csv.ReadOptions(block_size=1 << 22))
+    elif ext == '.parquet':
+        batches = pq.ParquetFile(path).iter_batches(batch_size)
+    else:
+        raise ValueError(f'Unsupported input format {ext}, expected .jsonl, .csv or .parquet')
+    for batch in batches:
+        yield from batch.to_pylist()
+
+
+class Checkpoint:
+    """Tracks which input rows have been written.
+
+    Rows complete out of order, so progress is stored as a watermark below
+    which every row is done, plus the done rows above it. The latter is
+    bounded by the flush size and the concurrency.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.watermark = 0
+        self.done = set()
+        self.parts = []
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.watermark = state['watermark']
+            self.done = set(state['done'])
+            self.parts = state['parts']
+
+    def __contains__(self, row: int) -> bool:
+        return row < self.watermark or row in self.done
+
+    def __len__(self) -> int:
+        return self.watermark + len(self.done)
+
+    def add(self, rows: list[int], part: str):
+        self.done.update(rows)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.watermark += 1
+        self.parts.append(part)
+        self.save()
+
+    def save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'watermark': self.watermark, 'done': sorted(self.done), 'parts': self.parts}, f)
+        os.replace(tmp_path, self.path)
+
+
+class BatchEnricher:
+    """Runs enrich_async() over products and writes results to output_dir.
+
+    Args:
+        output_dir: directory for Parquet files and the checkpoint
+        concurrency: max number of products in flight
+        flush_rows: results per Parquet file
+        id_column, description_column: input columns
+        image_column: optional input column of image paths or GCS URIs
+        category_column: optional input column of category prefixes to
+            restrict results to, a list or a '->' separated string
+        image_base64: images are base64 encoded rather than paths
+        include_marketing_copy: also generate marketing copy
+    """
+    def __init__(
+        self,
+        output_dir: str,
+        concurrency: int = config.BULK_CONCURRENCY,
+        flush_rows: int = config.BULK_FLUSH_ROWS,
+        id_column: str = config.COLUMN_ID,
+        description_column: str = config.COLUMN_DESCRIPTION,
+        image_column: Optional[str] = None,
+        category_column: Optional[str] = None,
+        image_base64: bool = False,
+        include_marketing_copy: bool = False):
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.flush_rows = flush_rows
+        self.id_column = id_column
+        self.description_column = description_column
+        self.image_column = image_column
+        self.category_column = category_column
+        self.image_base64 = image_base64
+        self.include_marketing_copy = include_marketing_copy
+        os.makedirs(output_dir, exist_ok=True)
+        self.checkpoint = Checkpoint(os.path.join(output_dir, CHECKPOINT))
+        self._remove_orphans()
+        self._buffer = []
+        self._flush_lock = asyncio.Lock() # parts are numbered and checkpointed in order
+        self.processed = 0
+        self.failed = 0
+
+    def _remove_orphans(self):
+        """Delete parts written after the last checkpoint, they will be redone."""
+        for path in glob.glob(os.path.join(self.output_dir, 'part-*.parquet')):
+            if os.path.basename(path) not in self.checkpoint.parts:
+                logging.info(f'Removing {path} written after the last checkpoint')
+                os.remove(path)
+
+    def _filters(self, product: dict) -> list[str]:
+        filters = product.get(self.category_column) if self.category_column else None
+        if not filters:
+            return []
+        if isinstance(filters, str):
+            return filters.split(CATEGORY_SEPARATOR)
+        return list(filters)
+
+    async def _enrich(self, row: int, product: dict) -> dict:
+        result = {'row': row, 'id': str(product.get(self.id_column, row))}
+        start = time.perf_counter()
+        try:
+            res = await enrich.enrich_async(
+                product[self.description_column],
+                product.get(self.image_column) if self.image_column else None,
+                base64=self.image_base64,
+                filters=self._filters(product),
+                include_marketing_copy=self.include_marketing_copy)
+            result['categories'] = [list(c) for c in res['categories']]
+            result['attributes'] = list(res['attributes'].items())
+            result['marketing_copy'] = res['marketing_copy']
+        except Exception as e:
+            logging.error(f'Row {row} failed: {e}')
+            result['error'] = f'{type(e).__name__}: {e}'
+            self.failed += 1
+        result['latency_ms'] = (time.perf_counter() - start) * 1000
+        return result
+
+    def _write(self, results: list[dict], part: str):
+        table = pa.Table.from_pylist(results, schema=SCHEMA)
+        tmp_path = os.path.join(self.output_dir, f'_{part}.tmp')
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, os.path.join(self.output_dir, part))
+
+    async def _flush(self):
+        """Write the buffered results to a new part, in a thread so enrich
+        tasks keep running meanwhile."""
+        if not self._buffer:
+            return
+        results, self._buffer = self._buffer, []
+        async with self._flush_lock:
+            part = f'part-{len(self.checkpoint.parts):05d}.parquet'
+            await asyncio.to_thread(self._write, results, part)
+            self.checkpoint.add([r['row'] for r in results], part)
+
+    async def run(self, products: Iterator[dict], report_seconds: float = 10.0) -> dict:
+        """Enrich all products not yet in the checkpoint.
+
+        Returns:
+            dict with processed, failed, skipped, seconds and items_per_second
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        skipped = 0
+        start = last_report = time.perf_counter()
+
+        async def worker(row, product):
+            try:
+                result = await self._enrich(row, product)
+                self._buffer.append(result)
+                self.processed += 1
+                if len(self._buffer) >= self.flush_rows:
+                    await self._flush()
+            finally:
+                semaphore.release()
+
+        for row, product in enumerate(products):
+            if row in self.checkpoint:
+                skipped += 1
+                continue
+            await semaphore.acquire()
+            task = asyncio.create_task(worker(row, product))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            now = time.perf_counter()
+            if now - last_report >= report_seconds:
+                logging.info(f'{self.processed} products enriched, {self.processed / (now - start):.1f} items/sec')
+                last_report = now
+        if tasks:
+            await asyncio.gather(*tasks)
+        await self._flush()
+
+        seconds = time.perf_counter() - start
+        stats = {
+            'processed': self.processed,
+            'failed': self.failed,
+            'skipped': skipped,
+            'seconds': seconds,
+            'items_per_second': self.processed / seconds if seconds else 0.0,
+        }
+        logging.info(f'Done: {stats}')
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enrich products in bulk.')
+    parser.add_argument('input', help='.jsonl, .csv or .parquet file of products')
+    parser.add_argument('output', help='directory to write Parquet results and the checkpoint to')
+    parser.add_argument('--concurrency', type=int, default=config.BULK_CONCURRENCY)
+    parser.add_argument('--flush_rows', type=int, default=config.BULK_FLUSH_ROWS)
+    parser.add_argument('--id_column', default=config.COLUMN_ID)
+    parser.add_argument('--description_column', default=config.COLUMN_DESCRIPTION)
+    parser.add_argument('--image_column', help='column of image paths or GCS URIs')
+    parser.add_argument('--image_base64', action='store_true', help='images are base64 encoded')
+    parser.add_argument('--category_column', help='column of category prefixes to restrict results to')
+    parser.add_argument('--marketing_copy', action='store_true', help='also generate marketing copy')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    enricher = BatchEnricher(
+        args.output,
+        concurrency=args.concurrency,
+        flush_rows=args.flush_rows,
+        id_column=args.id_column,
+        description_column=args.description_column,
+        image_column=args.image_column,
+        category_column=args.category_column,
+        image_base64=args.image_base64,
+        include_marketing_copy=args.marketing_copy)
+    asyncio.run(enricher.run(read_products(args.input)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bulk Enrichment Unit Tests.
+
+These tests replace enrich.enrich_async with a fake so no cloud APIs are
+called.
+"""
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.parquet as pq
+
+import batch_enrich
+
+PRODUCTS = [{'id': f'p{i}', 'description': f'product {i}'} for i in range(40)]
+
+async def fake_enrich(desc, image=None, base64=False, filters=[], include_marketing_copy=False):
+  await asyncio.sleep(0.001)
+  if desc == 'product 7':
+    raise ValueError('bad product')
+  return {
+    'categories': [('A', desc)],
+    'attributes': {'color': 'red'},
+    'marketing_copy': None,
+    'timings_ms': {},
+  }
+
+def crash_after(products, n):
+  for i, p in enumerate(products):
+    if i == n:
+      raise RuntimeError('crash')
+    yield p
+
+def read_results(output_dir):
+  return pq.read_table(output_dir).to_pylist()
+
+class BatchEnrichTest(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(batch_enrich.enrich, 'enrich_async', fake_enrich)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.dir.cleanup)
+    self.output = os.path.join(self.dir.name, 'out')
+
+  def test_run(self):
+    enricher = batch_enrich.BatchEnricher(self.output, concurrency=4, flush_rows=16)
+    stats = asyncio.run(enricher.run(iter(PRODUCTS), report_seconds=0))
+    self.assertEqual(stats['processed'], 40)
+    self.assertEqual(stats['failed'], 1)
+    rows = sorted(read_results(self.output), key=lambda r: r['row'])
+    self.assertEqual([r['id'] for r in rows], [p['id'] for p in PRODUCTS])
+    self.assertEqual(rows[0]['categories'], [['A', 'product 0']])
+    self.assertEqual(rows[0]['attributes'], [('color', 'red')])
+    self.assertIn('bad product', rows[7]['error'])
+
+  def test_parts_written_off_the_event_loop(self):
+    threads = []
+    def write_table(table, path):
+      threads.append(threading.current_thread())
+      pq_write_table(table, path)
+    pq_write_table = pq.write_table
+    enricher = batch_enrich.BatchEnricher(self.output, concurrency=8, flush_rows=5)
+    with mock.patch.object(batch_enrich.pq, 'write_table', write_table):
+      asyncio.run(enricher.run(iter(PRODUCTS)))
+    self.assertEqual(len(threads), 8)
+    self.assertNotIn(threading.main_thread(), threads)
+    self.assertEqual(enricher.checkpoint.parts, [f'part-{i:05d}.parquet' for i in range(8)])
+    self.assertEqual(len(read_results(self.output)), 40)
+
+  def test_resume(self):
+    enricher = batch_enrich.BatchEnricher(self.output, concurrency=4, flush_rows=10)
+    with self.assertRaises(RuntimeError):
+      asyncio.run(enricher.run(crash_after(PRODUCTS, 25)))
+    with open(os.path.join(self.output, batch_enrich.CHECKPOINT)) as f:
+      self.assertGreaterEqual(json.load(f)['watermark'], 10)
+
+    enricher = batch_enrich.BatchEnricher(self.output, concurrency=4, flush_rows=10)
+    stats = asyncio.run(enricher.run(iter(PRODUCTS)))
+    self.assertEqual(stats['skipped'] + stats['processed'], 40)
+    self.assertGreater(stats['skipped'], 0)
+    rows = read_results(self.output)
+    self.assertEqual(sorted(r['row'] for r in rows), list(range(40)))
+
+  def test_checkpoint_watermark(self):
+    checkpoint = batch_enrich.Checkpoint(os.path.join(self.dir.name, 'checkpoint.json'))
+    checkpoint.add([0, 1, 3], 'part-00000.parquet')
+    self.assertEqual((checkpoint.watermark, checkpoint.done), (2, {3}))
+    checkpoint.add([2, 4], 'part-00001.parquet')
+    self.assertEqual((checkpoint.watermark, checkpoint.done), (5, set()))
+    reloaded = batch_enrich.Checkpoint(checkpoint.path)
+    self.assertIn(4, reloaded)
+    self.assertNotIn(5, reloaded)
+
+  def test_read_products(self):
+    table = pa.Table.from_pylist(PRODUCTS[:3])
+    paths = {ext: os.path.join(self.dir.name, f'products{ext}') for ext in ('.jsonl', '.csv', '.parquet')}
+    with open(paths['.jsonl'], 'w') as f:
+      f.write('\n'.join(json.dumps(p) for p in PRODUCTS[:3]))
+    pyarrow.csv.write_csv(table, paths['.csv'])
+    pq.write_table(table, paths['.parquet'])
+    for path in paths.values():
+      self.assertEqual(list(batch_enrich.read_products(path)), PRODUCTS[:3])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,111 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalesce concurrent calls into batched RPCs."""
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Hashable, Optional
+
+
+class MicroBatcher:
+    """Collects items submitted by concurrent callers and processes them in batches.
+
+    A batch is closed when max_batch_size items were collected or max_wait_ms
+    elapsed since its first item, whichever comes first. Closed batches are
+    dispatched to a thread pool so several batched RPCs can be in flight.
+
+    Items whose key differs cannot share an RPC (e.g. different category
+    filters for a vector search), so each batch is split by key before
+    calling fn. If a call for several items fails, they are retried one by
+    one, so e.g. an invalid image only fails its own caller.
+
+    Args:
+        fn: processes a list of items and returns one result per item, in order
+        max_batch_size: max number of items per call to fn
+        max_wait_ms: max time to wait for a batch to fill up
+        key: returns the grouping key of an item, None to batch all items
+        max_concurrency: max number of concurrent calls to fn
+        name: used in log messages and thread names
+    """
+    def __init__(
+        self,
+        fn: Callable[[list], list],
+        max_batch_size: int,
+        max_wait_ms: float,
+        key: Optional[Callable[[Any], Hashable]] = None,
+        max_concurrency: int = 8,
+        name: str = 'batcher'):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.key = key
+        self.name = name
+        self._queue = queue.SimpleQueue()
+        self._executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix=name)
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, item) -> Future:
+        """Queue an item. The returned future resolves to its result."""
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._collect, name=self.name, daemon=True)
+                    self._worker.start()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        """Queue an item and block until its result is available."""
+        return self.submit(item).result()
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            groups = {}
+            for item, future in batch:
+                groups.setdefault(self.key(item) if self.key else None, []).append((item, future))
+            for group in groups.values():
+                self._executor.submit(self._run, group)
+
+    def _run(self, batch: list[tuple[Any, Future]]):
+        items = [item for item, _ in batch]
+        try:
+            results = self.fn(items)
+            if len(results) != len(items):
+                raise ValueError(f'{self.name} returned {len(results)} results for {len(items)} items')
+        except Exception as e:
+            if len(batch) > 1:
+                logging.warning(f'{self.name} batch of {len(items)} failed, retrying one by one: {e}')
+                for pair in batch:
+                    self._executor.submit(self._run, [pair])
+                return
+            logging.error(f'{self.name} call failed: {e}')
+            batch[0][1].set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
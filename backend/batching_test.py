@@ -0,0 +1,81 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-batching Unit Tests.
+
+These tests run fully offline.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import unittest
+
+import batching
+
+class MicroBatcherTest(unittest.TestCase):
+
+  def test_coalesces_concurrent_calls(self):
+    calls = []
+    def double(items):
+      calls.append(len(items))
+      return [i * 2 for i in items]
+    batcher = batching.MicroBatcher(double, max_batch_size=100, max_wait_ms=50)
+    with ThreadPoolExecutor(10) as pool:
+      res = list(pool.map(batcher, range(10)))
+    self.assertEqual(res, [i * 2 for i in range(10)])
+    self.assertLess(len(calls), 10)
+
+  def test_max_batch_size(self):
+    calls = []
+    def identity(items):
+      calls.append(len(items))
+      return items
+    batcher = batching.MicroBatcher(identity, max_batch_size=3, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in range(7)]
+    self.assertEqual([f.result() for f in futures], list(range(7)))
+    self.assertTrue(all(size <= 3 for size in calls))
+
+  def test_groups_by_key(self):
+    calls = []
+    def identity(items):
+      calls.append(items)
+      return items
+    batcher = batching.MicroBatcher(identity, max_batch_size=10, max_wait_ms=50, key=lambda i: i % 2)
+    futures = [batcher.submit(i) for i in range(6)]
+    self.assertEqual([f.result() for f in futures], list(range(6)))
+    for items in calls:
+      self.assertEqual(len({i % 2 for i in items}), 1)
+
+  def test_exception_propagates(self):
+    def fail(items):
+      raise RuntimeError('upstream error')
+    batcher = batching.MicroBatcher(fail, max_batch_size=10, max_wait_ms=1)
+    with self.assertRaises(RuntimeError):
+      batcher(1)
+
+  def test_failed_batch_retries_items(self):
+    calls = []
+    def check(items):
+      calls.append(len(items))
+      if 'bad' in items:
+        raise ValueError('invalid item')
+      return items
+    batcher = batching.MicroBatcher(check, max_batch_size=10, max_wait_ms=50)
+    futures = [batcher.submit(i) for i in ['a', 'bad', 'b']]
+    self.assertEqual(futures[0].result(), 'a')
+    self.assertEqual(futures[2].result(), 'b')
+    with self.assertRaises(ValueError):
+      futures[1].result()
+    self.assertGreater(max(calls), 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,287 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline benchmarks of each stage and of the whole enrichment pipeline.
+
+Upstream services are replaced by the fakes of fakes.py, so the benchmarks
+run anywhere. The 'zero' latency profile measures the CPU cost of our own
+code (prompt building, parsing, caching, local search), the 'vertex' profile
+adds realistic upstream latency to measure concurrency behavior e.g. of
+batching and rate limiting:
+
+    python benchmark.py
+    python benchmark.py --profile vertex --scale 0.1 --only pipeline
+
+The request_base64 and request_upload benchmarks compare the same product
+image sent base64 encoded in JSON and as raw bytes through the REST API,
+including the peak Python heap used by one request.
+
+Each run is appended to config.BENCHMARK_HISTORY_PATH as one JSON line. A
+run fails (exit code 1) if a benchmark's throughput or median latency is
+worse than the median of the previous config.BENCHMARK_BASELINE_RUNS
+comparable runs by more than config.BENCHMARK_REGRESSION_THRESHOLD.
+"""
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import random
+import subprocess
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Optional
+from unittest import mock
+
+import httpx
+import numpy as np
+
+import api
+import attributes
+import category
+import config
+import embeddings
+import enrich
+import fakes
+import loadgen
+import nearest_neighbors
+
+HIGHER_IS_BETTER = {'ops_per_sec': True, 'p50_ms': False} # metrics checked for regressions
+
+
+class Benchmark:
+    """A coroutine run many times, at most concurrency at once.
+
+    Args:
+        name: benchmark name
+        op: called with the index of the operation, returns an awaitable
+        requests: number of measured operations
+        concurrency: max operations in flight
+        warmup: operations run before measuring
+        memory: also measure the peak Python heap of one operation, run alone
+    """
+    def __init__(
+        self,
+        name: str,
+        op: Callable[[int], Awaitable],
+        requests: int = 200,
+        concurrency: int = 1,
+        warmup: int = 10,
+        memory: bool = False):
+        self.name = name
+        self.op = op
+        self.requests = requests
+        self.concurrency = concurrency
+        self.warmup = warmup
+        self.memory = memory
+
+    async def run(self) -> dict:
+        """Returns throughput, latency percentiles and the number of errors."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        latencies, errors = [], 0
+
+        async def timed(i: int, record: bool):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await self.op(i)
+                except Exception as e:
+                    errors += 1
+                    logging.debug(f'{self.name} operation {i} failed: {e}')
+                if record:
+                    latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(timed(-1 - i, False) for i in range(self.warmup)))
+        start = time.perf_counter()
+        await asyncio.gather(*(timed(i, True) for i in range(self.requests)))
+        elapsed = time.perf_counter() - start
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+        result = {
+            'ops_per_sec': round(self.requests / elapsed, 2),
+            'p50_ms': round(p50, 3),
+            'p90_ms': round(p90, 3),
+            'p99_ms': round(p99, 3),
+            'errors': errors,
+        }
+        if self.memory:
+            tracemalloc.start()
+            try:
+                await self.op(self.requests)
+                result['peak_kb'] = round(tracemalloc.get_traced_memory()[1] / 1024)
+            finally:
+                tracemalloc.stop()
+        return result
+
+
+def benchmarks(catalog: fakes.Catalog, requests: int, concurrency: int) -> list[Benchmark]:
+    """One benchmark per stage, then the whole pipeline.
+
+    Each operation uses a new description so caches don't serve repeats,
+    except for the vector search which has no cache.
+    """
+    ids = list(catalog.products)
+    queries = [catalog.embed(catalog.description(i)) for i in range(64)]
+
+    def neighbors(i: int) -> list[dict]:
+        product_ids = [ids[(i * 7 + j) % len(ids)] for j in range(config.NUM_NEIGHBORS)]
+        rows = {id: catalog.row(id) for id in product_ids}
+        return [{'id': id + '_T', 'distance': 0.1 * j,
+                 'category': [rows[id][c] for c in config.COLUMN_CATEGORIES],
+                 'attributes': json.loads(rows[id][config.COLUMN_ATTRIBUTES]),
+                 'description': rows[id][config.COLUMN_DESCRIPTION]}
+                for j, id in enumerate(product_ids)]
+
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url='http://benchmark')
+    photo = loadgen.png(1024, 768, random.Random(0)) # about 2MiB, like a phone photo
+    photo_base64 = base64.b64encode(photo).decode()
+
+    async def post(i: int, path: str, **kwargs):
+        (await client.post(path, timeout=None, **kwargs)).raise_for_status()
+
+    stages = {
+        'embedding': lambda i: embeddings.embed_async(catalog.description(i)),
+        'nearest_neighbors': lambda i: nearest_neighbors.get_nn_async([queries[i % len(queries)]]),
+        'reference_join': lambda i: enrich.join_reference_async(
+            [c['id'][:-2] for c in neighbors(i)]),
+        'rank': lambda i: category.rank_candidates_async(catalog.description(i), neighbors(i)),
+        'attributes': lambda i: attributes.generate_attributes_async(catalog.description(i), neighbors(i)),
+        'pipeline': lambda i: enrich.enrich_async(catalog.description(i)),
+    }
+    upload_stages = {
+        'request_base64': lambda i: post(i, '/v1/categories/', json={
+            'description': catalog.description(i), 'main_image_base64': photo_base64}),
+        'request_upload': lambda i: post(i, '/v1/categories:upload', content=photo, params={
+            'description': catalog.description(i)}, headers={'content-type': 'application/octet-stream'}),
+    }
+    return [Benchmark(name, op, requests, concurrency) for name, op in stages.items()] + \
+        [Benchmark(name, op, requests, concurrency, memory=True) for name, op in upload_stages.items()]
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    profile: str = 'zero',
+    scale: float = 1.0,
+    requests: int = 200,
+    concurrency: int = 16,
+    only: Optional[list[str]] = None,
+    products: int = 1000) -> dict:
+    """Run the benchmarks against fakes.
+
+    Returns:
+        run record with the settings and, per benchmark, the result of
+        Benchmark.run()
+    """
+    catalog = fakes.Catalog(products)
+    record = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'commit': _commit(),
+        'host': platform.node(),
+        'settings': {'profile': profile, 'scale': scale, 'requests': requests,
+                     'concurrency': concurrency, 'products': products},
+        'results': {},
+    }
+    # In-memory caches start empty, persistent ones would serve repeats of
+    # previous runs' operations
+    embeddings.get_cache.cache_clear()
+    with fakes.installed(catalog, profile, scale), \
+         mock.patch.object(config, 'EMBEDDING_CACHE_PATH', None), \
+         mock.patch.object(config, 'LLM_CACHE_PATH', None):
+        for benchmark in benchmarks(catalog, requests, concurrency):
+            if only and benchmark.name not in only:
+                continue
+            record['results'][benchmark.name] = asyncio.run(benchmark.run())
+            logging.info(f'{benchmark.name}: {record["results"][benchmark.name]}')
+    return record
+
+
+def load_history(path: str = config.BENCHMARK_HISTORY_PATH) -> list[dict]:
+    if not path or not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(record: dict, path: str = config.BENCHMARK_HISTORY_PATH):
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def regressions(
+    record: dict,
+    history: list[dict],
+    threshold: float = config.BENCHMARK_REGRESSION_THRESHOLD,
+    window: int = config.BENCHMARK_BASELINE_RUNS) -> list[str]:
+    """Compare a run to the median of the last window runs with the same settings.
+
+    Returns:
+        one message per benchmark metric worse than the baseline by more
+        than threshold, as a fraction of the baseline
+    """
+    previous = [r for r in history if r['settings'] == record['settings']][-window:]
+    found = []
+    for name, result in record['results'].items():
+        for metric, higher_is_better in HIGHER_IS_BETTER.items():
+            values = [r['results'][name][metric] for r in previous if name in r['results']]
+            if not values:
+                continue
+            baseline = statistics.median(values)
+            change = (result[metric] - baseline) / baseline if baseline else 0.0
+            if (-change if higher_is_better else change) > threshold:
+                found.append(f'{name} {metric} {result[metric]} vs baseline {baseline} ({change:+.0%})')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the enrichment stages against local fakes.')
+    parser.add_argument('--profile', default='zero', choices=sorted(fakes.PROFILES))
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply profile latencies')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--products', type=int, default=1000, help='size of the fake catalog')
+    parser.add_argument('--only', nargs='+', help='benchmarks to run, default all')
+    parser.add_argument('--history', default=config.BENCHMARK_HISTORY_PATH)
+    parser.add_argument('--threshold', type=float, default=config.BENCHMARK_REGRESSION_THRESHOLD)
+    parser.add_argument('--no-record', action='store_true', help="don't append the run to the history")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger().setLevel(logging.WARNING) # stage modules log every call at INFO
+
+    record = run(args.profile, args.scale, args.requests, args.concurrency, args.only, args.products)
+    print(f"{'benchmark':<20}{'ops/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'errors':>8}{'peak KiB':>10}")
+    for name, r in record['results'].items():
+        print(f"{name:<20}{r['ops_per_sec']:>10}{r['p50_ms']:>10}{r['p90_ms']:>10}{r['p99_ms']:>10}{r['errors']:>8}"
+              f"{r.get('peak_kb', ''):>10}")
+
+    found = regressions(record, load_history(args.history), args.threshold)
+    if not args.no_record and args.history:
+        append_history(record, args.history)
+    for message in found:
+        print(f'REGRESSION: {message}')
+    raise SystemExit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark Unit Tests.
+
+These tests run fully offline against fakes.
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+
+import benchmark
+
+def _record(ops_per_sec, p50_ms, requests=100):
+  return {
+    'settings': {'profile': 'zero', 'requests': requests},
+    'results': {'pipeline': {'ops_per_sec': ops_per_sec, 'p50_ms': p50_ms}},
+  }
+
+class BenchmarkTest(unittest.TestCase):
+
+  def test_benchmark_run(self):
+    async def op(i):
+      await asyncio.sleep(0.01)
+    res = asyncio.run(benchmark.Benchmark('sleep', op, requests=20, concurrency=10, warmup=0).run())
+    self.assertGreater(res['ops_per_sec'], 100)
+    self.assertGreaterEqual(res['p50_ms'], 10)
+    self.assertEqual(res['errors'], 0)
+
+  def test_errors_are_counted(self):
+    async def op(i):
+      if i % 2:
+        raise RuntimeError('failed')
+    res = asyncio.run(benchmark.Benchmark('fail', op, requests=10, warmup=0).run())
+    self.assertEqual(res['errors'], 5)
+
+  def test_run_all(self):
+    record = benchmark.run(requests=5, concurrency=2, products=100)
+    self.assertEqual(
+      set(record['results']),
+      {'embedding', 'nearest_neighbors', 'reference_join', 'rank', 'attributes', 'pipeline',
+       'request_base64', 'request_upload'})
+    self.assertTrue(all(r['errors'] == 0 for r in record['results'].values()))
+    # the base64 string and its JSON body are held on top of the image bytes
+    self.assertLess(record['results']['request_upload']['peak_kb'], record['results']['request_base64']['peak_kb'])
+
+  def test_history(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'history.jsonl')
+      self.assertEqual(benchmark.load_history(path), [])
+      benchmark.append_history(_record(100, 10), path)
+      benchmark.append_history(_record(110, 9), path)
+      self.assertEqual(len(benchmark.load_history(path)), 2)
+
+  def test_regressions(self):
+    history = [_record(100, 10), _record(110, 9), _record(90, 11), _record(10, 100, requests=5)]
+    self.assertEqual(benchmark.regressions(_record(95, 10.5), history, threshold=0.25), [])
+    found = benchmark.regressions(_record(50, 20), history, threshold=0.25)
+    self.assertEqual(len(found), 2)
+    self.assertIn('pipeline ops_per_sec', found[0])
+
+  def test_no_baseline(self):
+    self.assertEqual(benchmark.regressions(_record(1, 1000), [], threshold=0.25), [])
+
+if __name__ == '__main__':
+  unittest.main()
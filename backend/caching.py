@@ -0,0 +1,202 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Two-tier key value cache: in-memory LRU in front of a SQLite store."""
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+
+def content_hash(*parts) -> str:
+    """Stable hex digest of strings and/or bytes."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        h.update(b'\0') # separator so ('ab', 'c') != ('a', 'bc')
+    return h.hexdigest()
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by the total size of its values.
+
+    Args:
+        max_bytes: evict least recently used entries once the summed size of
+            the values exceeds this
+        sizeof: function returning the size of a value in bytes
+    """
+    def __init__(self, max_bytes: int, sizeof: Callable = len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key: str, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def pop(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                value, size = self._entries.pop(key)
+                self.bytes -= size
+                return value
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+
+class SQLiteStore:
+    """Persistent blob store backed by a single SQLite table.
+
+    Safe to share between threads, and between processes thanks to WAL mode.
+    """
+    def __init__(self, path: str, table: str = 'cache'):
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                created REAL NOT NULL
+            )''')
+
+    def get(self, key: str) -> Optional[tuple[bytes, float]]:
+        """Returns (value, creation timestamp) or None if not found."""
+        with self._lock:
+            return self._conn.execute(
+                f'SELECT value, created FROM {self.table} WHERE key = ?', (key,)).fetchone()
+
+    def put(self, key: str, value: bytes):
+        with self._lock:
+            self._conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, value, created) VALUES (?, ?, ?)',
+                (key, value, time.time()))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TieredCache:
+    """LRUCache in front of an optional SQLiteStore, with hit/miss counters.
+
+    Values must be bytes. Entries found on disk are promoted to memory.
+
+    Args:
+        memory: in-memory tier
+        store: persistent tier, None for a memory only cache
+        ttl: seconds after which entries are considered stale, None to keep
+            entries forever
+    """
+    def __init__(
+        self,
+        memory: LRUCache,
+        store: Optional[SQLiteStore] = None,
+        ttl: Optional[float] = None):
+        self.memory = memory
+        self.store = store
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def _count(self, stat: str):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self.memory.get(key)
+        if entry is not None:
+            value, created = entry
+            if not self._expired(created):
+                self._count('memory_hits')
+                return value
+            self.memory.pop(key)
+        if self.store is not None:
+            row = self.store.get(key)
+            if row is not None and not self._expired(row[1]):
+                self.memory.put(key, (row[0], row[1]))
+                self._count('disk_hits')
+                return row[0]
+        self._count('misses')
+        return None
+
+    def put(self, key: str, value: bytes):
+        self.memory.put(key, (value, time.time()))
+        if self.store is not None:
+            self.store.put(key, value)
+
+    def stats(self) -> dict[str, float]:
+        """Hit/miss counters plus the hit rate and the memory tier size."""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = sum(stats.values())
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        stats['memory_entries'] = len(self.memory)
+        stats['memory_bytes'] = self.memory.bytes
+        return stats
+
+
+def tiered_cache(
+    max_bytes: int,
+    path: Optional[str] = None,
+    table: str = 'cache',
+    ttl: Optional[float] = None) -> TieredCache:
+    """Create a TieredCache holding bytes values.
+
+    Args:
+        max_bytes: size of the in-memory tier
+        path: SQLite file for the persistent tier, None for memory only
+        table: SQLite table name, lets several caches share one file
+        ttl: seconds after which entries are considered stale
+    """
+    memory = LRUCache(max_bytes, sizeof=lambda entry: len(entry[0]))
+    store = SQLiteStore(path, table) if path else None
+    return TieredCache(memory, store, ttl)
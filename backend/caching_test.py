@@ -0,0 +1,70 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache Unit Tests.
+
+These tests run fully offline.
+"""
+import os
+import tempfile
+import time
+import unittest
+
+import caching
+
+class LRUCacheTest(unittest.TestCase):
+
+  def test_evicts_least_recently_used(self):
+    lru = caching.LRUCache(max_bytes=6)
+    lru.put('a', b'aa')
+    lru.put('b', b'bb')
+    lru.put('c', b'cc')
+    lru.get('a')
+    lru.put('d', b'dd')
+    self.assertIsNone(lru.get('b'))
+    self.assertEqual(lru.get('a'), b'aa')
+    self.assertEqual(lru.bytes, 6)
+
+  def test_skips_oversized_values(self):
+    lru = caching.LRUCache(max_bytes=1)
+    lru.put('a', b'aa')
+    self.assertEqual(len(lru), 0)
+
+class TieredCacheTest(unittest.TestCase):
+
+  def test_persists_across_instances(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'cache.sqlite')
+      caching.tiered_cache(1024, path).put('k', b'value')
+      c = caching.tiered_cache(1024, path)
+      self.assertEqual(c.get('k'), b'value')
+      self.assertEqual(c.get('k'), b'value')
+      self.assertIsNone(c.get('missing'))
+      stats = c.stats()
+    self.assertEqual(stats['disk_hits'], 1)
+    self.assertEqual(stats['memory_hits'], 1)
+    self.assertEqual(stats['misses'], 1)
+
+  def test_ttl(self):
+    c = caching.tiered_cache(1024, ttl=0.01)
+    c.put('k', b'value')
+    time.sleep(0.02)
+    self.assertIsNone(c.get('k'))
+
+  def test_content_hash(self):
+    self.assertEqual(caching.content_hash('a', b'b'), caching.content_hash(b'a', 'b'))
+    self.assertNotEqual(caching.content_hash('ab', 'c'), caching.content_hash('a', 'bc'))
+
+if __name__ == '__main__':
+  unittest.main()
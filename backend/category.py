@@ -13,34 +13,28 @@
 # limitations under the License.
 
 """Functions related to product categorization."""
-from collections import defaultdict
+from collections import Counter, defaultdict
+import json
 import logging
 import re
-from typing import Optional
+from typing import Union
 
+import centroid_classifier
 import config
 import embeddings
+import metrics
 import nearest_neighbors
+import reference_store
+import taxonomy
 import utils
 
-bq_client = utils.get_bq_client()
-llm = utils.get_llm()
+vote_stats = Counter() # fast_path, llm and agree counts of the vote ranker
+metrics.collected(
+  'catalog_rank_vote', 'Vote ranker outcomes: fast_path, llm and agree',
+  ('outcome',), lambda: {(k,): v for k, v in vote_stats.items()}, type='counter')
 
-def join_categories(
-    ids: list[str], 
-    category_depth:int = config.CATEGORY_DEPTH,
-    allow_trailing_nulls:bool = config.ALLOW_TRAILING_NULLS) -> dict[str:list[str]]:
-    """Given list of product IDs, join category names.
-    
-    Args:
-        ids: list of product IDs used to join against master product table
-        category_depth: number of levels in category hierarchy to return
-
-    Returns:
-        dict mapping product IDs to category name. The category name will be
-        a list of strings e.g. ['level 1 category', 'level 2 category']
-    """
-    query = f"""
+def _categories_query(ids: list[str], category_depth: int) -> str:
+    return f"""
     SELECT
         {config.COLUMN_ID},
         {','.join(config.COLUMN_CATEGORIES[:category_depth])}
@@ -49,8 +43,9 @@ def join_categories(
     WHERE
         {config.COLUMN_ID} IN {str(ids).replace('[','(').replace(']',')')}
     """
-    query_job = bq_client.query(query)
-    rows = query_job.result()
+
+def parse_categories(rows, allow_trailing_nulls: bool) -> dict[str:list[str]]:
+    """Map reference table rows to category lists, see join_categories()."""
     categories = defaultdict(list) 
     for row in rows:
       for col in config.COLUMN_CATEGORIES:
@@ -66,10 +61,47 @@ def join_categories(
               raise ValueError(f'Column {col} for product {row[config.COLUMN_ID]} is null. To allow nulls update config.py')
     return categories
 
+@metrics.timed('reference_join')
+def join_categories(
+    ids: list[str], 
+    category_depth:int = config.CATEGORY_DEPTH,
+    allow_trailing_nulls:bool = config.ALLOW_TRAILING_NULLS) -> dict[str:list[str]]:
+    """Given list of product IDs, join category names.
+
+    Served from the reference snapshot when config.REFERENCE_SNAPSHOT_PATH is
+    set, from BigQuery otherwise.
+    
+    Args:
+        ids: list of product IDs used to join against master product table
+        category_depth: number of levels in category hierarchy to return
+
+    Returns:
+        dict mapping product IDs to category name. The category name will be
+        a list of strings e.g. ['level 1 category', 'level 2 category']
+    """
+    store = reference_store.get_store()
+    if store:
+        return parse_categories(store.rows(ids), allow_trailing_nulls)
+    query_job = utils.get_bq_client().query(_categories_query(ids, category_depth))
+    rows = query_job.result()
+    return parse_categories(rows, allow_trailing_nulls)
+
+@metrics.timed('reference_join')
+async def join_categories_async(
+    ids: list[str], 
+    category_depth:int = config.CATEGORY_DEPTH,
+    allow_trailing_nulls:bool = config.ALLOW_TRAILING_NULLS) -> dict[str:list[str]]:
+    """Async version of join_categories()."""
+    store = reference_store.get_store()
+    if store:
+        return parse_categories(await store.rows_async(ids), allow_trailing_nulls)
+    rows = await utils.query_async(_categories_query(ids, category_depth))
+    return parse_categories(rows, allow_trailing_nulls)
+
 
 def retrieve(
     desc: str, 
-    image: Optional[str] = None, 
+    image: Union[str, bytes, None] = None, 
     base64: bool = False,
     num_neighbors: int = config.NUM_NEIGHBORS,
     filters: list[str] = []) -> list[dict]:
@@ -81,7 +113,8 @@ def retrieve(
 
     Args:
         desc: user provided description of product
-        image: can be local file path, GCS URI or base64 encoded image
+        image: can be local file path, GCS URI, base64 encoded image or image
+          bytes
         base64: True indicates image is base64. False (default) will be 
           interpreted as image path (either local or GCS)
         num_neigbhors: number of nearest neighbors to return for EACH embedding
@@ -101,17 +134,71 @@ def retrieve(
       return []
     ids = [n.id[:-2] for n in neighbors] # last 3 chars are not part of product ID
     categories = join_categories(ids)
+    return prune(_candidates(neighbors, categories), embeds, filters)
+
+async def retrieve_async(
+    desc: str, 
+    image: Union[str, bytes, None] = None, 
+    base64: bool = False,
+    num_neighbors: int = config.NUM_NEIGHBORS,
+    filters: list[str] = []) -> list[dict]:
+    """Async version of retrieve()."""
+    res = await embeddings.embed_async(desc,image, base64)
+    embeds = [res.text_embedding, res.image_embedding] if res.image_embedding else [res.text_embedding]
+    neighbors = await nearest_neighbors.get_nn_async(embeds,filters)
+    if not neighbors:
+      return []
+    ids = [n.id[:-2] for n in neighbors] # last 3 chars are not part of product ID
+    categories = await join_categories_async(ids)
+    return prune(_candidates(neighbors, categories), embeds, filters)
+
+def _candidates(
+    neighbors: list[nearest_neighbors.Neighbor],
+    categories: dict[str:list[str]]) -> list[dict]:
     candidates = [{'category':categories[n.id[:-2]],'id':n.id, 'distance':n.distance}
                     for n in neighbors]
     return sorted(candidates, key=lambda d: d['distance'])
 
-def _rank(desc: str, candidates: list[list[str]]) -> list[list[str]]:
-  """See rank() for docstring."""
-  logging.info(f'Candidates:\n{candidates}')
-  if not candidates:
-    return []
+@metrics.timed('classify')
+def classify(embeds: list[list[float]], filters: list[str] = []) -> list[tuple[str]]:
+  """Rank categories with the centroid classifier, without any RPC.
 
-  query = f"""
+  Args:
+    embeds: text and/or image embeddings of the product
+    filters: category prefix to restrict results to
+
+  Returns:
+    The config.CENTROID_BEAM_WIDTH best categories from most to least
+    relevant, see centroid_classifier.CentroidClassifier.classify()
+  """
+  ranked = centroid_classifier.get_classifier().classify(embeds, filters=filters)
+  if filters and not ranked:
+    return [['ERROR: No existing products match that category']]
+  return [path for path, _ in ranked]
+
+async def classify_async(embeds: list[list[float]], filters: list[str] = []) -> list[tuple[str]]:
+  """Async version of classify(). Runs inline as it only takes microseconds."""
+  return classify(embeds, filters)
+
+def prune(candidates: list[dict], embeds: list[list[float]], filters: list[str] = []) -> list[dict]:
+  """Drop candidates outside the best paths of the centroid classifier.
+
+  A no-op unless config.CENTROID_PRUNING is set. Fewer candidates make for
+  a shorter rank prompt and a more decisive vote. Candidates are kept as
+  they are if none would be left.
+  """
+  if not config.CENTROID_PRUNING or not candidates:
+    return candidates
+  ranked = centroid_classifier.get_classifier().classify(embeds, filters=filters)
+  # prefixes too, in case categories are truncated by config.CATEGORY_DEPTH or trailing nulls
+  keep = {path[:i] for path, _ in ranked for i in range(1, len(path) + 1)}
+  pruned = [c for c in candidates if tuple(c['category']) in keep]
+  logging.info(f'Pruned {len(candidates) - len(pruned)} of {len(candidates)} candidates')
+  return pruned or candidates
+
+def _rank_prompt(desc: str, candidates: list[list[str]]) -> str:
+  # chr(10) == \n. workaround since backslash not allowed in f-string in python < 3.12
+  return f"""
   Given the following product description:
   {desc}
 
@@ -120,23 +207,48 @@ def _rank(desc: str, candidates: list[list[str]]) -> list[list[str]]:
 
   Do not include any commentary in the result.
   """
-  # chr(10) == \n. workaround since backslash not allowed in f-string in python < 3.12
 
-  llm_parameters = {
-    "max_output_tokens": 256,
-    "temperature": 0.0,
-  }
-  response = llm.predict(
-      query,
-      **llm_parameters
-  )
-  res = response.text.splitlines()
+def _rank_cache_key(desc: str, candidates: list[list[str]]) -> str:
+  """LLM cache key of a rank prompt, only depending on the candidate set.
+
+  The prompt keeps the candidates in distance order with repeats, which the
+  LLM can use. Responses are reused across orders of the same set.
+  """
+  return json.dumps([desc, sorted(set(tuple(cat) for cat in candidates))])
+
+RANK_LLM_PARAMETERS = {
+  "max_output_tokens": 256,
+  "temperature": 0.0,
+}
+
+def _snap(line: list[str], candidates: list[list[str]]) -> list[str]:
+  """Map a category returned by the LLM onto a real category path.
+
+  Lines that are not one of the candidates, e.g. misspelled, differently
+  cased or missing a level, are snapped with taxonomy.Taxonomy.snap().
+  Returned as is if they can't be.
+  """
+  if tuple(line) in {tuple(c) for c in candidates}:
+    return line
+  tree = taxonomy.get_taxonomy()
+  snapped = tree.snap([part.strip() for part in line]) if tree is not None else None
+  if snapped and len(snapped) == len(candidates[0]) and list(snapped) != line:
+    taxonomy.stats['rank_snapped'] += 1
+    logging.info(f'Snapped {line} to {snapped}')
+    return list(snapped)
+  return line
+
+def _parse_rank(text: str, candidates: list[list[str]]) -> list[list[str]]:
+  res = text.splitlines()
   if not res:
     raise ValueError('ERROR: No LLM response returned. This seems to be an intermittent bug')
   
   logging.info(f'Response:\n{res}')
   formatted_res = [re.sub(r"^\s*(\d+\.|\*|-)\s+", "", line.strip()).split('->') for line in res]
-  formatted_res = [res for res in formatted_res if len(res) == len(candidates[0])] #remove answers that don't match expected length
+  formatted_res = [_snap(res, candidates) for res in formatted_res if any(res)]
+  expected = [res for res in formatted_res if len(res) == len(candidates[0])] #remove answers that don't match expected length
+  taxonomy.stats['rank_dropped'] += len(formatted_res) - len(expected)
+  formatted_res = expected
   
   unique_res = list(dict.fromkeys([tuple(l) for l in formatted_res]))
   logging.info(f'Formatted Response:\n {unique_res}')
@@ -144,6 +256,38 @@ def _rank(desc: str, candidates: list[list[str]]) -> list[list[str]]:
     raise ValueError('ERROR: No responses returned in expected format')
   return unique_res
 
+@metrics.timed('rank')
+def _rank(desc: str, candidates: list[list[str]]) -> list[list[str]]:
+  """See rank() for docstring."""
+  logging.info(f'Candidates:\n{candidates}')
+  if not candidates:
+    return []
+
+  prompt = _rank_prompt(desc, candidates)
+  response = utils.get_cached_llm().predict(
+      prompt,
+      cache_key=_rank_cache_key(desc, candidates),
+      **RANK_LLM_PARAMETERS
+  )
+  metrics.observe_llm('rank', prompt, response.text)
+  return _parse_rank(response.text, candidates)
+
+@metrics.timed('rank')
+async def _rank_async(desc: str, candidates: list[list[str]]) -> list[list[str]]:
+  """Async version of _rank()."""
+  logging.info(f'Candidates:\n{candidates}')
+  if not candidates:
+    return []
+
+  prompt = _rank_prompt(desc, candidates)
+  response = await utils.get_cached_llm().predict_async(
+      prompt,
+      cache_key=_rank_cache_key(desc, candidates),
+      **RANK_LLM_PARAMETERS
+  )
+  metrics.observe_llm('rank', prompt, response.text)
+  return _parse_rank(response.text, candidates)
+
 def rank(desc: str, candidates: list[list[str]]) -> list[list[str]]:
   """Use an LLM to rank candidates by description.
   
@@ -161,11 +305,109 @@ def rank(desc: str, candidates: list[list[str]]) -> list[list[str]]:
   except ValueError as e:
     logging.error(e)
     logging.error('Falling back to original candidate ranking.')
+    metrics.FALLBACKS.labels('rank', 'unparseable_response').inc()
     return list(dict.fromkeys([tuple(l) for l in candidates]))
 
+async def rank_async(desc: str, candidates: list[list[str]]) -> list[list[str]]:
+  """Async version of rank()."""
+  try:
+    return await _rank_async(desc, candidates)
+  except ValueError as e:
+    logging.error(e)
+    logging.error('Falling back to original candidate ranking.')
+    metrics.FALLBACKS.labels('rank', 'unparseable_response').inc()
+    return list(dict.fromkeys([tuple(l) for l in candidates]))
+
+def vote(candidates: list[dict]) -> tuple[list[tuple[str]], float]:
+  """Rank candidates by distance weighted vote over the category tree.
+
+  Each candidate votes for its category with weight 1/distance. Starting at
+  the root, the child with the most weight under the current prefix is picked
+  until a leaf is reached.
+
+  Args:
+    candidates: candidate dicts as returned by retrieve()
+
+  Returns:
+    Deduped categories, the winner first and the rest by descending weight,
+    and the margin of the winner: the smallest lead over the runner up, as a
+    share of the vote, across levels. 1.0 means all neighbors agree
+  """
+  weights = defaultdict(float)
+  for c in candidates:
+    weights[tuple(c['category'])] += 1 / (c['distance'] + config.RANK_VOTE_EPSILON)
+  if not weights:
+    return [], 0.0
+
+  prefix, margin = (), 1.0
+  while True:
+    children = defaultdict(float)
+    for path, w in weights.items():
+      if path[:len(prefix)] == prefix:
+        # a path ending at prefix competes as a child i.e. "stop here"
+        children[path[:len(prefix) + 1]] += w
+    top = sorted(children.values(), reverse=True)
+    margin = min(margin, (top[0] - (top[1] if len(top) > 1 else 0)) / sum(top))
+    best = max(children, key=children.get)
+    if best == prefix:
+      break
+    prefix = best
+  ranked = sorted(weights, key=lambda p: (p != prefix, -weights[p]))
+  return ranked, margin
+
+def _log_vote_stats():
+  total = vote_stats['fast_path'] + vote_stats['llm']
+  logging.info(
+    f"Vote ranker: fast path {vote_stats['fast_path']}/{total}, "
+    f"LLM agreed with vote {vote_stats['agree']}/{vote_stats['llm']}")
+
+def _rank_by_vote(candidates: list[dict]) -> tuple[list[tuple[str]], bool]:
+  voted, margin = vote(candidates)
+  fast = margin >= config.RANK_VOTE_MARGIN
+  vote_stats['fast_path' if fast else 'llm'] += 1
+  logging.info(f'Vote margin {margin:.2f}, {"skipping" if fast else "calling"} LLM')
+  return voted, fast
+
+def _record_agreement(voted: list[tuple[str]], ranked: list[list[str]]):
+  if voted and ranked and tuple(ranked[0]) == voted[0]:
+    vote_stats['agree'] += 1
+  _log_vote_stats()
+
+def rank_candidates(desc: str, candidates: list[dict]) -> list[list[str]]:
+  """Rank retrieved candidates according to config.RANK_MODE.
+
+  Args:
+    desc: user provided description of product
+    candidates: candidate dicts as returned by retrieve()
+
+  Returns:
+    Deduped categories from most to least relevant, see rank()
+  """
+  if config.RANK_MODE != 'vote':
+    return rank(desc, [c['category'] for c in candidates])
+  voted, fast = _rank_by_vote(candidates)
+  if fast:
+    _log_vote_stats()
+    return voted
+  ranked = rank(desc, voted)
+  _record_agreement(voted, ranked)
+  return ranked
+
+async def rank_candidates_async(desc: str, candidates: list[dict]) -> list[list[str]]:
+  """Async version of rank_candidates()."""
+  if config.RANK_MODE != 'vote':
+    return await rank_async(desc, [c['category'] for c in candidates])
+  voted, fast = _rank_by_vote(candidates)
+  if fast:
+    _log_vote_stats()
+    return voted
+  ranked = await rank_async(desc, voted)
+  _record_agreement(voted, ranked)
+  return ranked
+
 def retrieve_and_rank(    
     desc: str, 
-    image: Optional[str] = None, 
+    image: Union[str, bytes, None] = None, 
     base64: bool = False,
     num_neighbors: int = config.NUM_NEIGHBORS,
     filters: list[str] = []) -> list[list[str]]:
@@ -173,17 +415,42 @@ def retrieve_and_rank(
     
     Args:
         desc: user provided description of product
-        image: can be local file path, GCS URI or base64 encoded image
+        image: can be local file path, GCS URI, base64 encoded image or image
+          bytes
         base64: True indicates image is base64. False (default) will be 
           interpreted as image path (either local or GCS)
         num_neigbhors: number of nearest neighbors to return for EACH embedding
         filters: category prefix to restrict results to
 
     Returns:
-      The candidates ranked by the LLM from most to least relevant. If there are
-      duplicate candidates the list is deduped prior to returning
+      The candidates ranked from most to least relevant, by the LLM or by
+      vote depending on config.RANK_MODE. If there are duplicate candidates
+      the list is deduped prior to returning. With config.RANK_MODE set to
+      'centroid', the categories of classify() instead
     """
+    if not taxonomy.matches(filters):
+      return [['ERROR: No existing products match that category']]
+    if config.RANK_MODE == 'centroid':
+      res = embeddings.embed(desc, image, base64)
+      return classify([res.text_embedding, res.image_embedding] if res.image_embedding else [res.text_embedding], filters)
     candidates = retrieve(desc, image, base64, num_neighbors, filters)
     if filters and not candidates:
       return [['ERROR: No existing products match that category']]
-    return rank(desc, [candidate['category'] for candidate in candidates])
+    return rank_candidates(desc, candidates)
+
+async def retrieve_and_rank_async(    
+    desc: str, 
+    image: Union[str, bytes, None] = None, 
+    base64: bool = False,
+    num_neighbors: int = config.NUM_NEIGHBORS,
+    filters: list[str] = []) -> list[list[str]]:
+    """Async version of retrieve_and_rank()."""
+    if not taxonomy.matches(filters):
+      return [['ERROR: No existing products match that category']]
+    if config.RANK_MODE == 'centroid':
+      res = await embeddings.embed_async(desc, image, base64)
+      return classify([res.text_embedding, res.image_embedding] if res.image_embedding else [res.text_embedding], filters)
+    candidates = await retrieve_async(desc, image, base64, num_neighbors, filters)
+    if filters and not candidates:
+      return [['ERROR: No existing products match that category']]
+    return await rank_candidates_async(desc, candidates)
@@ -19,7 +19,9 @@ These tests assume:
 -The test is run from an environment that has permission to call cloud APIs
 """
 import logging; logging.basicConfig(level=logging.INFO)
+import asyncio
 import unittest
+from unittest import mock
 
 import category
 import config
@@ -52,6 +54,51 @@ class CategoryTest(unittest.TestCase):
     logging.info(res)
     self.assertEqual(sorted(candidates),sorted(res))
 
+  def test_rank_prompt_keeps_candidate_order(self):
+    candidates = [['b', 'c'], ['a', 'c'], ['b', 'c']]
+    prompt = category._rank_prompt('desc', candidates)
+    self.assertLess(prompt.index('b->c'), prompt.index('a->c'))
+    self.assertEqual(prompt.count('b->c'), 2)
+    self.assertEqual(category._rank_cache_key('desc', candidates),
+                     category._rank_cache_key('desc', [['a', 'c'], ['b', 'c']]))
+
+  def test_vote_unanimous(self):
+    candidates = [{'category': ['a', 'b'], 'distance': d} for d in (0.1, 0.2, 0.3)]
+    ranked, margin = category.vote(candidates)
+    self.assertEqual(ranked, [('a', 'b')])
+    self.assertEqual(margin, 1.0)
+
+  def test_vote_weighted_by_distance(self):
+    candidates = [
+      {'category': ['a', 'b'], 'distance': 0.05},
+      {'category': ['a', 'c'], 'distance': 0.4},
+      {'category': ['a', 'c'], 'distance': 0.45},
+      {'category': ['d', 'e'], 'distance': 0.5},
+    ]
+    ranked, margin = category.vote(candidates)
+    self.assertEqual(ranked, [('a', 'b'), ('a', 'c'), ('d', 'e')])
+    self.assertGreater(margin, 0.0)
+    self.assertLess(margin, 1.0)
+
+  def test_rank_candidates_vote_skips_llm(self):
+    candidates = [{'category': ['a', 'b'], 'distance': 0.1}] * 3
+    with mock.patch.object(config, 'RANK_MODE', 'vote'), \
+         mock.patch.object(category, 'rank') as rank:
+      res = category.rank_candidates('This is a test description', candidates)
+    rank.assert_not_called()
+    self.assertEqual(res, [('a', 'b')])
+
+  def test_rank_candidates_vote_ambiguous(self):
+    candidates = [
+      {'category': ['a', 'b'], 'distance': 0.3},
+      {'category': ['c', 'd'], 'distance': 0.3},
+    ]
+    with mock.patch.object(config, 'RANK_MODE', 'vote'), \
+         mock.patch.object(category, 'rank', return_value=[('c', 'd'), ('a', 'b')]) as rank:
+      res = category.rank_candidates('This is a test description', candidates)
+    rank.assert_called_once()
+    self.assertEqual(res, [('c', 'd'), ('a', 'b')])
+
   def test_retrieve_and_rank(self):
     res = category.retrieve_and_rank(
         'This is a test description',
@@ -81,5 +128,15 @@ class CategoryTest(unittest.TestCase):
     self.assertIsInstance(res, list)
     self.assertGreater(len(res),0)
 
+  def test_retrieve_and_rank_async(self):
+    res = asyncio.run(category.retrieve_and_rank_async(
+        'This is a test description',
+        config.TEST_GCS_IMAGE,
+        filters=[config.TEST_CATEGORY_L0]
+    ))
+    logging.info(res)
+    self.assertIsInstance(res, list)
+    self.assertGreater(len(res),0)
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -0,0 +1,369 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Nearest centroid classification down the category tree.
+
+Every node of the L0 -> L3 category tree is summarized offline by up to
+config.CENTROID_PROTOTYPES prototypes: spherical k-means centroids of the
+embeddings of the products under it (one centroid when k is 1). A query
+embedding is then classified by beam search from the root: at each level
+only the children of the config.CENTROID_BEAM_WIDTH best prefixes so far are
+scored, with one matrix product against their prototypes. A path's score is
+the mean, over its levels, of the best cosine similarity between the query
+and the prototypes of the node at that level.
+
+Classifying an embedding needs no RPC and takes microseconds, so it can
+replace retrieval and ranking altogether (config.RANK_MODE = 'centroid') or
+prune the retrieved candidates before they are ranked
+(config.CENTROID_PRUNING), see category.py.
+
+Build a classifier from the data_prep_with_restricts JSONL, whose category
+restricts hold the path of each datapoint, and report its accuracy and
+latency on a held-out split of products against a nearest neighbor vote,
+with:
+
+    python centroid_classifier.py build sample.json centroid_classifier/
+    python centroid_classifier.py evaluate sample.json
+"""
+import argparse
+from collections import defaultdict
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import numpy as np
+
+import config
+import local_index
+import utils
+
+
+def _paths(datapoints: local_index.Datapoints) -> list[tuple[str]]:
+    """Category path of each datapoint, read from its restricts up to the first unset level."""
+    tokens = [{code: token for token, code in vocab.items()} for vocab in datapoints.vocab]
+    paths = []
+    for codes in np.asarray(datapoints.codes):
+        path = ()
+        for level, code in enumerate(codes):
+            if code == local_index.MISSING:
+                break
+            path += (tokens[level][code],)
+        paths.append(path)
+    return paths
+
+
+def _spherical_kmeans(x: np.ndarray, k: int, iters: int, rng: np.random.Generator) -> np.ndarray:
+    """k unit length centroids of the unit length rows of x, by cosine similarity."""
+    if len(x) <= k:
+        return x.copy()
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        for j in range(k):
+            members = x[assign == j]
+            if len(members):
+                centroids[j] = members.sum(0)
+        centroids = local_index.normalize(centroids)
+    return centroids
+
+
+class CentroidClassifier:
+    """Prototypes of every node of the category tree, level by level.
+
+    Nodes of a level are sorted by parent, so the children of a node are a
+    contiguous range of the next level. Every node of a level has the same
+    number of prototypes, nodes with fewer repeat their first one, so the
+    prototypes of any set of nodes are gathered with a single index.
+
+    Args:
+        paths: per level, the category path of each node e.g.
+            [[('Clothing',), ...], [('Clothing', 'Men'), ...], ...]
+        counts: per level, the number of datapoints under each node
+        children: per level but the last, (start, stop) of each node's
+            children in the next level. start == stop for a node without
+            children i.e. a path with trailing nulls
+        prototypes: per level, float32 array of unit length prototypes of
+            shape (nodes, prototypes per node, dimensions)
+    """
+    def __init__(
+        self,
+        paths: list[list[tuple[str]]],
+        counts: list[np.ndarray],
+        children: list[np.ndarray],
+        prototypes: list[np.ndarray]):
+        self.paths = paths
+        self.counts = counts
+        self.children = children
+        self.prototypes = prototypes
+        self.index = [{path: i for i, path in enumerate(level)} for level in paths]
+
+    @property
+    def depth(self) -> int:
+        return len(self.paths)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the prototypes."""
+        return sum(p.nbytes for p in self.prototypes)
+
+    @classmethod
+    def build(
+        cls,
+        datapoints: local_index.Datapoints,
+        prototypes: int = config.CENTROID_PROTOTYPES,
+        iters: int = 10,
+        seed: int = 0) -> 'CentroidClassifier':
+        """Summarize the embeddings under each category node.
+
+        The category path of a datapoint is read from its restricts, one
+        namespace per level, and ends at its first unset level.
+
+        Args:
+            datapoints: datapoints with category restricts, text and image
+                datapoints alike
+            prototypes: max prototypes per node. Nodes with fewer datapoints
+                keep each of them as a prototype
+            iters: k-means iterations
+            seed: random seed of the k-means initialization
+        """
+        rng = np.random.default_rng(seed)
+        rows = defaultdict(list) # path -> datapoint rows under it, at every level
+        for row, path in enumerate(_paths(datapoints)):
+            for level in range(len(path)):
+                rows[path[:level + 1]].append(row)
+        depth = max((len(path) for path in rows), default=0)
+        levels = [sorted(p for p in rows if len(p) == level + 1) for level in range(depth)]
+
+        counts, children, protos = [], [], []
+        for level, paths in enumerate(levels):
+            counts.append(np.array([len(rows[p]) for p in paths], dtype=np.int64))
+            vectors = [_spherical_kmeans(np.asarray(datapoints.embeddings[np.array(rows[p])]), prototypes, iters, rng)
+                       for p in paths]
+            k = max(len(v) for v in vectors)
+            protos.append(np.stack([np.concatenate([v, v[:1].repeat(k - len(v), 0)]) for v in vectors])
+                          .astype(np.float32))
+            if level + 1 < depth:
+                index = {p: i for i, p in enumerate(paths)}
+                parents = np.array([index[p[:-1]] for p in levels[level + 1]], dtype=np.int64)
+                start = np.searchsorted(parents, np.arange(len(paths)), side='left')
+                stop = np.searchsorted(parents, np.arange(len(paths)), side='right')
+                children.append(np.stack([start, stop], axis=1))
+        logging.info(f'Built centroid classifier of {sum(p.shape[0] * p.shape[1] for p in protos)} prototypes '
+                     f'for {sum(len(p) for p in levels)} categories')
+        return cls(levels, counts, children, protos)
+
+    def _score(self, queries: np.ndarray, level: int, nodes: np.ndarray) -> np.ndarray:
+        """Mean over queries of the best prototype similarity of each node."""
+        sims = self.prototypes[level][nodes] @ queries.T # (nodes, prototypes, queries)
+        return sims.max(axis=1).mean(axis=1)
+
+    def classify(
+        self,
+        embeddings: list[list[float]],
+        beam_width: int = config.CENTROID_BEAM_WIDTH,
+        top_k: Optional[int] = None,
+        filters: list[str] = []) -> list[tuple[tuple[str], float]]:
+        """Rank category paths by similarity to the embeddings.
+
+        Args:
+            embeddings: text and/or image embeddings of one product, their
+                similarities are averaged
+            beam_width: prefixes kept at each level
+            top_k: number of paths to return, defaults to beam_width
+            filters: category prefix to restrict results to
+
+        Returns:
+            (path, score) tuples, best first. Paths end at a node without
+            children so may be shorter than the tree when trailing levels are
+            unspecified. Empty if no category matches the filters
+        """
+        if not self.depth or not len(embeddings):
+            return []
+        queries = local_index.normalize(np.asarray(embeddings, dtype=np.float32))
+        nodes = np.arange(len(self.paths[0]))
+        totals = np.zeros(len(nodes))
+        done = [] # (node index, level, total) of paths that ended above the last level
+        for level in range(self.depth):
+            if level < len(filters):
+                allowed = [self.index[level].get(tuple(filters[:level + 1]), -1)]
+                keep = np.isin(nodes, allowed)
+                nodes, totals = nodes[keep], totals[keep]
+            if not len(nodes):
+                break
+            totals = totals + self._score(queries, level, nodes)
+            best = np.argsort(-totals, kind='stable')[:beam_width]
+            nodes, totals = nodes[best], totals[best]
+            if level + 1 == self.depth:
+                break
+            start, stop = self.children[level][nodes].T
+            leaf = start == stop
+            done.extend((n, level, t) for n, t in zip(nodes[leaf], totals[leaf]))
+            nodes = np.concatenate([np.arange(a, b) for a, b in zip(start, stop)] or [nodes[:0]])
+            totals = np.repeat(totals[~leaf], (stop - start)[~leaf])
+        ranked = [(self.paths[self.depth - 1][n], t / self.depth) for n, t in zip(nodes, totals)]
+        ranked += [(self.paths[level][n], t / (level + 1)) for n, level, t in done
+                   if len(filters) <= level + 1]
+        ranked.sort(key=lambda r: -r[1])
+        return [(path, float(score)) for path, score in ranked[:top_k or beam_width]]
+
+    def save(self, path: str):
+        """Write the classifier to a directory of .npy files."""
+        os.makedirs(path, exist_ok=True)
+        arrays = {}
+        for level in range(self.depth):
+            arrays[f'prototypes_{level}'] = self.prototypes[level]
+            arrays[f'counts_{level}'] = self.counts[level]
+            if level < len(self.children):
+                arrays[f'children_{level}'] = self.children[level]
+        np.savez(os.path.join(path, 'centroids.npz'), **arrays)
+        with open(os.path.join(path, 'centroids.json'), 'w') as f:
+            json.dump({'paths': self.paths}, f)
+
+    @classmethod
+    def load(cls, path: str) -> 'CentroidClassifier':
+        """Load a classifier written by save()."""
+        with open(os.path.join(path, 'centroids.json')) as f:
+            paths = [[tuple(p) for p in level] for level in json.load(f)['paths']]
+        with np.load(os.path.join(path, 'centroids.npz')) as arrays:
+            return cls(
+                paths,
+                [arrays[f'counts_{level}'] for level in range(len(paths))],
+                [arrays[f'children_{level}'] for level in range(len(paths) - 1)],
+                [arrays[f'prototypes_{level}'] for level in range(len(paths))])
+
+
+@utils.lazy
+def get_classifier() -> Optional[CentroidClassifier]:
+    """Returns the classifier, or None if not used in config.py."""
+    if config.RANK_MODE != 'centroid' and not config.CENTROID_PRUNING:
+        return None
+    return CentroidClassifier.load(config.CENTROID_CLASSIFIER_PATH)
+
+
+def _knn_vote(index: local_index.ExactIndex, labels: dict[str, tuple[str]], query: list[float], k: int) -> tuple[str]:
+    """Path with the most 1/distance weighted votes among the k nearest neighbors."""
+    weights = defaultdict(float)
+    for n in index.find_neighbors(queries=[query], num_neighbors=k)[0]:
+        weights[labels[n.id]] += 1 / (n.distance + config.RANK_VOTE_EPSILON)
+    return max(weights, key=weights.get) if weights else ()
+
+
+def evaluate(
+    datapoints: local_index.Datapoints,
+    test_fraction: float = 0.2,
+    settings: Optional[list[dict]] = None,
+    top_k: int = 3,
+    num_neighbors: int = config.NUM_NEIGHBORS,
+    max_queries: int = 1000,
+    seed: int = 0) -> list[dict]:
+    """Accuracy and latency of classifiers on a held-out split of products.
+
+    Products, not datapoints, are split so the text and image datapoints of
+    a test product are never seen at build time. Each test datapoint is
+    classified on its own and compared to its own category path. A nearest
+    neighbor vote over exact search of the training datapoints, as with
+    config.RANK_MODE = 'vote', is reported first as the baseline.
+
+    Args:
+        datapoints: datapoints with category restricts
+        test_fraction: share of products held out
+        settings: list of dicts with prototypes and beam_width. Defaults to
+            1 and config.CENTROID_PROTOTYPES prototypes with beams of 1 and
+            config.CENTROID_BEAM_WIDTH
+        top_k: a classifier is also credited if the path is among its top_k
+        num_neighbors: neighbors of the baseline vote
+        max_queries: max test datapoints classified per setting
+        seed: random seed of the split
+
+    Returns:
+        one dict per setting with accuracy (top path correct), accuracy_top_k,
+        accuracy_l0 (top L0 category correct), us_per_query and bytes
+    """
+    if settings is None:
+        settings = [{'prototypes': p, 'beam_width': b}
+                    for p in sorted({1, config.CENTROID_PROTOTYPES}) for b in sorted({1, config.CENTROID_BEAM_WIDTH})]
+    rng = np.random.default_rng(seed)
+    products = sorted({id[:-2] for id in datapoints.ids})
+    test = set(rng.choice(products, int(len(products) * test_fraction), replace=False).tolist())
+    is_test = np.array([id[:-2] in test for id in datapoints.ids])
+    train = datapoints.remove(id for id, t in zip(datapoints.ids, is_test) if t)
+    queries = rng.permutation(np.flatnonzero(is_test))[:max_queries]
+
+    paths = _paths(datapoints)
+    labels = [paths[row] for row in queries]
+    embeds = [np.asarray(datapoints.embeddings[row]).tolist() for row in queries]
+
+    def run(classify):
+        start = time.perf_counter()
+        ranked = [classify(e) for e in embeds]
+        return ranked, (time.perf_counter() - start) * 1e6 / max(len(embeds), 1)
+
+    def score(ranked):
+        return {
+            'accuracy': float(np.mean([bool(r) and r[0] == l for r, l in zip(ranked, labels)])),
+            'accuracy_top_k': float(np.mean([l in r[:top_k] for r, l in zip(ranked, labels)])),
+            'accuracy_l0': float(np.mean([bool(r) and r[0][:1] == l[:1] for r, l in zip(ranked, labels)])),
+        }
+
+    index = local_index.ExactIndex(train)
+    train_labels = dict(zip(train.ids, _paths(train)))
+    ranked, us = run(lambda e: [_knn_vote(index, train_labels, e, num_neighbors)])
+    report = [{'method': 'knn_vote', 'prototypes': None, 'beam_width': None, **score(ranked),
+               'us_per_query': us, 'bytes': train.embeddings.nbytes}]
+    built = {}
+    for setting in settings:
+        prototypes, beam_width = setting['prototypes'], setting['beam_width']
+        if prototypes not in built:
+            built[prototypes] = CentroidClassifier.build(train, prototypes, seed=seed)
+        classifier = built[prototypes]
+        ranked, us = run(lambda e: [p for p, _ in classifier.classify([e], beam_width, max(top_k, beam_width))])
+        report.append({'method': 'centroid', 'prototypes': prototypes, 'beam_width': beam_width, **score(ranked),
+                       'us_per_query': us, 'bytes': classifier.nbytes})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or evaluate a centroid category classifier.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='build a classifier from JSONL datapoints')
+    build.add_argument('input', help='JSONL file or index directory of datapoints with category restricts')
+    build.add_argument('output', help='directory to write the classifier to')
+    build.add_argument('--prototypes', type=int, default=config.CENTROID_PROTOTYPES)
+    report = subparsers.add_parser('evaluate', help='report accuracy and latency on a held-out split')
+    report.add_argument('input', help='JSONL file or index directory of datapoints with category restricts')
+    report.add_argument('--test_fraction', type=float, default=0.2)
+    report.add_argument('--top_k', type=int, default=3)
+    report.add_argument('--queries', type=int, default=1000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    datapoints = local_index.load_datapoints(args.input)
+    if args.command == 'build':
+        classifier = CentroidClassifier.build(datapoints, args.prototypes)
+        classifier.save(args.output)
+        logging.info(f'Wrote classifier of {classifier.nbytes / 1024**2:.1f} MiB to {args.output}')
+    else:
+        rows = evaluate(datapoints, args.test_fraction, top_k=args.top_k, max_queries=args.queries)
+        print(f"{'method':>9} {'protos':>6} {'beam':>4} {'acc@1':>6} {f'acc@{args.top_k}':>6} "
+              f"{'L0 acc':>6} {'us/query':>9} {'MiB':>7}")
+        for r in rows:
+            print(f"{r['method']:>9} {r['prototypes'] or '-':>6} {r['beam_width'] or '-':>4} {r['accuracy']:>6.3f} "
+                  f"{r['accuracy_top_k']:>6.3f} {r['accuracy_l0']:>6.3f} {r['us_per_query']:>9.1f} "
+                  f"{r['bytes'] / 1024**2:>7.1f}")
+
+
+if __name__ == '__main__':
+    main()
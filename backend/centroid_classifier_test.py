@@ -0,0 +1,128 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Centroid Classifier Unit Tests.
+
+These tests run fully offline against the synthetic catalog of fakes.py.
+"""
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+import category
+import centroid_classifier
+import config
+import embeddings
+import enrich
+import fakes
+import local_index
+
+class CentroidClassifierTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.catalog = fakes.Catalog(500)
+    cls.datapoints = local_index.Datapoints.from_records(cls.catalog.datapoints())
+    cls.classifier = centroid_classifier.CentroidClassifier.build(cls.datapoints, prototypes=2)
+
+  def test_tree(self):
+    leaves = {p['leaf'] for p in self.catalog.products.values()}
+    self.assertEqual([len(level) for level in self.classifier.paths], [4, 16, 48, len(leaves)])
+    self.assertEqual(self.classifier.counts[0].sum(), len(self.datapoints))
+    # children of a node are the next level's paths under it
+    start, stop = self.classifier.children[0][1]
+    self.assertTrue(all(p[:1] == self.classifier.paths[0][1] for p in self.classifier.paths[1][start:stop]))
+
+  def test_classify(self):
+    for leaf in (0, 50, 143):
+      ranked = self.classifier.classify([self.catalog.embed('query', leaf)], beam_width=3)
+      self.assertEqual(len(ranked), 3)
+      self.assertEqual(ranked[0][0], self.catalog.leaves[leaf])
+      self.assertEqual([s for _, s in ranked], sorted((s for _, s in ranked), reverse=True))
+
+  def test_filters(self):
+    query = [self.catalog.embed('query', 0)]
+    ranked = self.classifier.classify(query, filters=['Category 2', 'Category 2.3'])
+    self.assertTrue(ranked)
+    self.assertTrue(all(path[:2] == ('Category 2', 'Category 2.3') for path, _ in ranked))
+    self.assertEqual(self.classifier.classify(query, filters=['Category 9']), [])
+
+  def test_trailing_nulls(self):
+    records = [{'id': f'{i}_T', 'embedding': self.catalog.embed(str(i), i % 2),
+                'restricts': [{'namespace': 'L0', 'allow': ['a']}] + ([{'namespace': 'L1', 'allow': ['b']}] if i % 2 else [])}
+               for i in range(20)]
+    classifier = centroid_classifier.CentroidClassifier.build(local_index.Datapoints.from_records(records))
+    self.assertEqual(classifier.classify([self.catalog.embed('query', 1)])[0][0], ('a', 'b'))
+    self.assertEqual(classifier.classify([self.catalog.embed('query', 0)], filters=['a'])[0][0], ('a', 'b'))
+
+  def test_save_and_load(self):
+    query = [self.catalog.embed('query', 7)]
+    with tempfile.TemporaryDirectory() as d:
+      self.classifier.save(d)
+      loaded = centroid_classifier.CentroidClassifier.load(d)
+    self.assertEqual(loaded.classify(query), self.classifier.classify(query))
+
+  def test_evaluate(self):
+    report = centroid_classifier.evaluate(self.datapoints, settings=[{'prototypes': 2, 'beam_width': 3}])
+    self.assertEqual([r['method'] for r in report], ['knn_vote', 'centroid'])
+    self.assertGreaterEqual(report[1]['accuracy'], 0.9)
+    self.assertGreaterEqual(report[1]['accuracy_top_k'], report[1]['accuracy'])
+    self.assertLess(report[1]['bytes'], report[0]['bytes'])
+
+class CategoryTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.catalog = fakes.Catalog(200)
+    cls.classifier = centroid_classifier.CentroidClassifier.build(
+      local_index.Datapoints.from_records(cls.catalog.datapoints()))
+
+  def setUp(self):
+    embeddings.get_cache.cache_clear()
+    patcher = mock.patch.object(centroid_classifier, 'get_classifier', return_value=self.classifier)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_rank_mode_centroid(self):
+    desc = self.catalog.description(1)
+    with mock.patch.object(config, 'RANK_MODE', 'centroid'), fakes.installed(self.catalog) as f:
+      res = category.retrieve_and_rank(desc)
+      filtered = asyncio.run(category.retrieve_and_rank_async(desc, filters=['Category 9']))
+    self.assertEqual(len(res[0]), 4)
+    self.assertEqual(filtered, [['ERROR: No existing products match that category']])
+    self.assertEqual((f.llm.calls, f.bigquery.queries), (0, 0))
+
+  def test_enrich_centroid(self):
+    with mock.patch.object(config, 'RANK_MODE', 'centroid'), fakes.installed(self.catalog) as f:
+      res = asyncio.run(enrich.enrich_async(self.catalog.description(2)))
+      batch = asyncio.run(enrich.suggest_categories_batch_async([enrich.BatchItem(self.catalog.description(3))]))
+    self.assertEqual(len(res['categories'][0]), 4)
+    self.assertIn('color', res['attributes'])
+    self.assertEqual(f.llm.calls, 1) # attributes only
+    self.assertEqual(len(batch[0][0]), 4)
+
+  def test_prune(self):
+    leaf = self.catalog.leaves[5]
+    candidates = [{'category': list(leaf), 'distance': 0.1}, {'category': ['Category 9'], 'distance': 0.2}]
+    embeds = [self.catalog.embed('query', 5)]
+    self.assertEqual(category.prune(candidates, embeds), candidates)
+    with mock.patch.object(config, 'CENTROID_PRUNING', True):
+      self.assertEqual(category.prune(candidates, embeds), candidates[:1])
+      # truncated categories match on prefix, and nothing is dropped rather than everything
+      self.assertEqual(category.prune([{'category': list(leaf[:2]), 'distance': 0.1}], embeds)[0]['category'], list(leaf[:2]))
+      self.assertEqual(category.prune(candidates[1:], embeds), candidates[1:])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -20,10 +20,44 @@ Update as needed to match your enivornment
 PROJECT = '<YOUR GCP PROJECT ID>'
 LOCATION = '<YOUR GCP PROJECT LOCATION>' # e.g. 'us-central1'
 
-# Vertex Vector Search
+# Vector Search
+VECTOR_SEARCH_BACKEND = 'vertex' # 'vertex' for Vertex Vector Search, 'exact'
+                                 # for in-process brute force search over
+                                 # LOCAL_INDEX_PATH, 'hnsw' for in-process
+                                 # approximate search over HNSW_INDEX_PATH or
+                                 # 'quantized' for in-process search over
+                                 # compressed vectors in QUANTIZED_INDEX_PATH
+LOCAL_INDEX_PATH = '<PATH TO JSONL OF id, embedding AND CATEGORY RESTRICTS>' # e.g. 'sample.json'
+                 # as produced by notebooks/vectorSearchIndexUpdate/data_prep_with_restricts.ipynb,
+                 # or a directory written by local_index.Datapoints.save(), which index_sync.py needs
+LOCAL_INDEX_RELOAD_SECONDS = 10 # how often a LOCAL_INDEX_PATH directory is checked for updates by index_sync.py
+HNSW_INDEX_PATH = '<PATH TO INDEX DIRECTORY BUILT WITH hnsw_index.py>'
+HNSW_M = 16 # max links per node, higher improves recall at the cost of memory
+HNSW_EF_CONSTRUCTION = 200 # candidate list size at build time
+HNSW_EF_SEARCH = 150 # candidate list size at query time, analogous to
+                     # approximate_neighbors_count of the Vertex tree-AH index
+HNSW_EXACT_SEARCH_THRESHOLD = 6000 # scan matching datapoints exactly when a
+                                   # category filter matches fewer than this,
+                                   # filtered graph search calls back into
+                                   # Python for every visited node
+QUANTIZED_INDEX_PATH = '<PATH TO INDEX DIRECTORY BUILT WITH quantized_index.py>'
+PQ_SUBSPACES = 88 # product quantization bytes per vector, must divide the
+                  # embedding dimensions (1408)
+QUANTIZED_RERANK_MULTIPLIER = 10 # candidates re-ranked at full precision per
+                                 # neighbor returned, 0 disables re-ranking
+INDEX_ID = '<YOUR VERTEX VECTOR SEARCH INDEX ID>' # e.g. '924016377843417088', must be a
+                                                  # STREAM_UPDATE index for index_sync.py
 ENDPOINT_ID = '<YOUR VERTEX VECTOR SEARCH ENDPOINT ID>' # e.g. '1641918305943945216'
 DEPLOYED_INDEX = '<YOUR VERTEX VECTOR SEARCH DEPLOYED INDEX ID>' # e.g. 'flipkart_1702030773989'
 NUM_NEIGHBORS = 7
+NEIGHBOR_CACHE_ENABLED = False # reuse the neighbors of a recent, nearly identical
+                               # query embedding, see neighbor_cache.py
+NEIGHBOR_CACHE_MIN_SIMILARITY = 0.97 # min cosine similarity to the cached query
+NEIGHBOR_CACHE_MAX_ENTRIES = 10000 # about 6KB each
+NEIGHBOR_CACHE_TABLES = 4 # SimHash tables, more find more near duplicates
+NEIGHBOR_CACHE_BITS = 12 # random projections per table
+NEIGHBOR_CACHE_VERSION_SECONDS = 60 # how often the Vertex index update time is
+                                    # checked, entries are dropped when it changes
 FILTER_CATEGORIES = [ # List of category filter names from root to leaf
     'L0',
     'L1',
@@ -31,6 +65,50 @@ FILTER_CATEGORIES = [ # List of category filter names from root to leaf
     'L3'
 ]
 
+# Request coalescing
+BATCHING_ENABLED = False # coalesce concurrent embedding and vector search
+                         # calls into batched RPCs
+BATCH_WINDOW_MS = 5 # max time a call waits for others to join its batch
+EMBEDDING_BATCH_MAX_SIZE = 16 # max instances per embedding predict call
+NN_BATCH_MAX_SIZE = 32 # max get_nn calls per find_neighbors call
+BATCH_MAX_PRODUCTS = 100 # max products per call of the :batch endpoints, see api.py
+
+# Rate limiting, see ratelimit.py
+RATE_LIMITING_ENABLED = True # queue and retry calls to Vertex AI on throttling
+RETRY_DEADLINE_SECONDS = 30 # max time a call may spend queued and retrying
+RATE_LIMITS = { # per upstream. Set rate (requests/sec) to your Vertex AI quota,
+                # None only adapts concurrency to throttling
+    'embedding': {'rate': None, 'max_concurrency': 32},
+    'vector_search': {'rate': None, 'max_concurrency': 64},
+    'llm': {'rate': None, 'max_concurrency': 16},
+}
+
+# Startup, see startup.py
+WARMUP_ENABLED = True # create clients, prime connections and load indexes in the
+                      # background at startup. /ready returns 503 until done
+WARMUP_RETRY_SECONDS = 5 # delay before failed warmup steps are retried
+
+# Metrics, see metrics.py
+TRACING_ENABLED = False # also create an OpenTelemetry span per stage. Requires
+                        # opentelemetry-api, and an SDK with an exporter to export them
+
+# Embeddings
+EMBEDDING_CACHE_MAX_BYTES = 256 * 1024**2 # in-memory LRU size for embeddings,
+                                          # 0 disables the in-memory cache
+EMBEDDING_CACHE_PATH = None # SQLite file persisting embeddings across restarts
+                            # e.g. 'embeddings_cache.sqlite'. None disables it
+IMAGE_NORMALIZATION = True # downsize and re-encode base64, local and raw images before
+                           # embedding, see images.py. GCS images are sent as URIs
+IMAGE_MAX_SIDE = 512 # max width and height in pixels, the model works at 512x512
+IMAGE_JPEG_QUALITY = 90
+IMAGE_PERCEPTUAL_CACHE_KEY = False # opt in to keying cached image embeddings on a
+                                   # perceptual hash of structure and colors, so
+                                   # near-identical images share an entry. Products
+                                   # that differ only in small details can collide.
+                                   # False keys on the image bytes as given and
+                                   # as normalized
+UPLOAD_MAX_BYTES = 20 * 1024**2 # largest image accepted by the :upload endpoints, see api.py
+
 # BigQuery
 PRODUCT_REFERENCE_TABLE = '<YOUR BQ TABLE NAME>' # e.g. 'project_name.flipkart.products'
 COLUMN_ID = 'id'
@@ -42,11 +120,80 @@ COLUMN_CATEGORIES = [ # List of category column names from root to leaf
 ]
 COLUMN_ATTRIBUTES = 'attributes'
 COLUMN_DESCRIPTION = 'description'
+COLUMN_IMAGE_URI = 'image_uri'
+COLUMN_TEXT_EMBEDDING = 'text_embedding'
+COLUMN_IMAGE_EMBEDDING = 'image_embedding'
+COLUMN_EMBEDDING_HASH = 'embedding_hash' # hash of the description and image URI
+                                         # the embeddings were computed from,
+                                         # added by embedding_backfill.py
 ALLOW_TRAILING_NULLS = True # whether to allow trailing category levels to be 
                             # unspecified e.g (only top-level category is specified)
+REFERENCE_SNAPSHOT_PATH = None # Arrow file holding a local copy of the reference
+                               # table e.g. 'products.arrow'. None always queries BigQuery
+REFERENCE_REFRESH_SECONDS = 3600 # re-export the snapshot at this interval,
+                                 # None to never refresh
+TAXONOMY_ENABLED = True # keep a trie of the category paths in memory to reject
+                        # unknown category filters before any RPC, autocomplete
+                        # categories and snap LLM rank outputs, see taxonomy.py
+TAXONOMY_REFRESH_SECONDS = 3600 # rebuild the trie at this interval even if the
+                                # reference table did not change, None to only rebuild on changes
+TAXONOMY_CHECK_SECONDS = 60 # check the reference table for changes at this interval,
+                            # unknown category filters are only rejected by a trie
+                            # at least as new as the table
+TAXONOMY_SNAP_CUTOFF = 0.8 # min spelling similarity (0-1) of an LLM output to
+                           # the category it is snapped to
+
+# LLM
+LLM_MODEL = 'text-bison' # pin a version e.g. 'text-bison@002' so cached responses
+                         # are invalidated when the model changes
+LLM_CACHE_MAX_BYTES = 64 * 1024**2 # in-memory LRU size for LLM responses,
+                                   # 0 disables the in-memory cache
+LLM_CACHE_PATH = None # SQLite file persisting LLM responses across restarts
+                      # e.g. 'llm_cache.sqlite'. None disables it
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 3600 # None to never expire
+LLM_CACHE_NONZERO_TEMPERATURE = False # also cache sampled (temperature > 0)
+                                      # calls e.g. marketing copy
 
 # Category
 CATEGORY_DEPTH = len(COLUMN_CATEGORIES) # number of levels in category hierarchy to consider
+RANK_MODE = 'llm' # 'llm' always ranks candidates with the LLM. 'vote' ranks
+                  # by distance weighted vote and only calls the LLM when the
+                  # vote is ambiguous. 'centroid' skips retrieval and ranking,
+                  # classifying the embeddings with centroid_classifier.py
+RANK_VOTE_MARGIN = 0.5 # min lead of the winning category over the runner up,
+                       # as a share of the vote at each level of the tree, to
+                       # skip the LLM. 1.0 only skips it when neighbors agree
+RANK_VOTE_EPSILON = 0.01 # added to distances before inverting them into weights
+CENTROID_CLASSIFIER_PATH = '<PATH TO CLASSIFIER DIRECTORY BUILT WITH centroid_classifier.py>'
+CENTROID_PROTOTYPES = 4 # max prototypes per category node, 1 for plain centroids
+CENTROID_BEAM_WIDTH = 5 # category prefixes kept at each level of the search
+CENTROID_PRUNING = False # drop retrieved candidates outside the classifier's best
+                         # CENTROID_BEAM_WIDTH paths before they are ranked
+
+# Embedding backfill, see embedding_backfill.py
+BACKFILL_CONCURRENCY = 16 # products embedded concurrently
+BACKFILL_STAGING_TABLE = None # table embeddings are loaded into before being
+                              # merged, defaults to <PRODUCT_REFERENCE_TABLE>_embedding_staging
+
+# Index sync, see index_sync.py
+SYNC_STATE_PATH = 'index_sync_state.json' # hashes of the products in the index
+SYNC_BATCH_SIZE = 500 # datapoints per upsert/remove call
+SYNC_INTERVAL_SECONDS = 60 # time between syncs when run continuously
+
+# Bulk enrichment, see batch_enrich.py
+BULK_CONCURRENCY = 16 # products enriched concurrently
+BULK_FLUSH_ROWS = 1000 # results per output Parquet file, progress is
+                       # checkpointed after each file is written
+
+# Benchmarks, see benchmark.py
+BENCHMARK_HISTORY_PATH = 'benchmark_history.jsonl' # results of each run, one JSON per line
+BENCHMARK_REGRESSION_THRESHOLD = 0.25 # fail a run if a benchmark's throughput or
+                                      # median latency is this much worse than baseline
+BENCHMARK_BASELINE_RUNS = 5 # the baseline is the median of this many previous runs
+
+# Load testing, see loadgen.py
+LOADTEST_SLO_P99_MS = 3000 # p99 latency objective of /v1/categories/ and /v1/attributes/
+LOADTEST_MAX_ERROR_RATE = 0.01 # share of failed requests allowed within the SLO
 
 # Testing - Update these for unit tests to run properly
 TEST_GCS_IMAGE = 'gs://genai-product-catalog/toy_images/shorts.jpg' # Any image you have access to in GCS
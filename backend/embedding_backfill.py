@@ -0,0 +1,261 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Backfill text and image embeddings of the product reference table.
+
+Replaces the row by row embedding and CASE/WHEN UPDATE loop of
+1_generate_embeddings.ipynb:
+
+1. Select only rows whose description or image URI changed since they were
+   last embedded, by comparing a hash of both computed in BigQuery with the
+   stored config.COLUMN_EMBEDDING_HASH, or that have no embedding yet
+2. Embed them concurrently with embeddings.embed_async()
+3. Stage the results to a local Parquet file
+4. Load the file into a staging table with a single load job, which unlike
+   DML does not count against DML quotas
+5. MERGE the staging table into the reference table in one statement
+
+Run it with:
+
+    python embedding_backfill.py --concurrency 32
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import tempfile
+import time
+from typing import Iterable, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+
+import config
+import embeddings
+import utils
+
+STAGING_SCHEMA = pa.schema([
+    (config.COLUMN_ID, pa.string()),
+    (config.COLUMN_TEXT_EMBEDDING, pa.list_(pa.float64())),
+    (config.COLUMN_IMAGE_EMBEDDING, pa.list_(pa.float64())),
+    (config.COLUMN_EMBEDDING_HASH, pa.string()),
+])
+
+
+def content_hash_sql() -> str:
+    """BigQuery expression hashing the inputs of a row's embeddings."""
+    return (f"TO_HEX(SHA256(CONCAT(IFNULL({config.COLUMN_DESCRIPTION}, ''), '\\n', "
+            f"IFNULL({config.COLUMN_IMAGE_URI}, ''))))")
+
+
+def add_hash_column_query(table: str = config.PRODUCT_REFERENCE_TABLE) -> str:
+    return f"""
+    ALTER TABLE `{table}`
+    ADD COLUMN IF NOT EXISTS {config.COLUMN_EMBEDDING_HASH} STRING
+    """
+
+
+def changed_rows_query(table: str = config.PRODUCT_REFERENCE_TABLE, force: bool = False) -> str:
+    """Select rows to embed along with the hash of their current content.
+
+    Args:
+        table: reference table
+        force: select all rows regardless of their stored hash
+    """
+    where = '' if force else f"""
+    WHERE
+        {config.COLUMN_EMBEDDING_HASH} IS NULL
+        OR {config.COLUMN_EMBEDDING_HASH} != content_hash
+        OR ARRAY_LENGTH({config.COLUMN_TEXT_EMBEDDING}) = 0"""
+    return f"""
+    SELECT
+        {config.COLUMN_ID},
+        {config.COLUMN_DESCRIPTION},
+        {config.COLUMN_IMAGE_URI},
+        content_hash
+    FROM (
+        SELECT
+            *,
+            {content_hash_sql()} AS content_hash
+        FROM
+            `{table}`
+    ){where}
+    """
+
+
+def merge_query(staging_table: str, table: str = config.PRODUCT_REFERENCE_TABLE) -> str:
+    return f"""
+    MERGE `{table}` T
+    USING `{staging_table}` S
+    ON T.{config.COLUMN_ID} = S.{config.COLUMN_ID}
+    WHEN MATCHED THEN UPDATE SET
+        {config.COLUMN_TEXT_EMBEDDING} = S.{config.COLUMN_TEXT_EMBEDDING},
+        {config.COLUMN_IMAGE_EMBEDDING} = S.{config.COLUMN_IMAGE_EMBEDDING},
+        {config.COLUMN_EMBEDDING_HASH} = S.{config.COLUMN_EMBEDDING_HASH}
+    """
+
+
+async def stage_embeddings(
+    rows: Iterable,
+    path: str,
+    concurrency: int = config.BACKFILL_CONCURRENCY,
+    flush_rows: int = 1000) -> tuple[int, int]:
+    """Embed rows and write them to a Parquet file in STAGING_SCHEMA.
+
+    Rows that fail to embed are logged and left out, so they keep their old
+    hash and are picked up by the next run.
+
+    rows is iterated flush_rows at a time in a thread, since a BigQuery
+    RowIterator blocks on the network whenever it fetches the next page.
+
+    Args:
+        rows: rows of changed_rows_query()
+        path: Parquet file to write
+        concurrency: max number of embedding calls in flight
+        flush_rows: rows per Parquet row group
+
+    Returns:
+        number of rows staged and number of rows that failed
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    buffer, tasks = [], set()
+    failed = 0
+
+    async def embed(row):
+        nonlocal failed
+        try:
+            res = await embeddings.embed_async(
+                row[config.COLUMN_DESCRIPTION] or '', row[config.COLUMN_IMAGE_URI] or None)
+            buffer.append({
+                config.COLUMN_ID: row[config.COLUMN_ID],
+                config.COLUMN_TEXT_EMBEDDING: list(res.text_embedding),
+                config.COLUMN_IMAGE_EMBEDDING: list(res.image_embedding or []),
+                config.COLUMN_EMBEDDING_HASH: row['content_hash'],
+            })
+        except Exception as e:
+            logging.error(f'Embedding {row[config.COLUMN_ID]} failed: {e}')
+            failed += 1
+        finally:
+            semaphore.release()
+
+    staged = 0
+    with pq.ParquetWriter(path, STAGING_SCHEMA) as writer:
+        def flush():
+            nonlocal buffer, staged
+            if buffer:
+                writer.write_table(pa.Table.from_pylist(buffer, schema=STAGING_SCHEMA))
+                staged += len(buffer)
+                buffer = []
+
+        start = time.perf_counter()
+        rows = iter(rows)
+        while batch := await asyncio.to_thread(list, itertools.islice(rows, flush_rows)):
+            for row in batch:
+                await semaphore.acquire()
+                task = asyncio.create_task(embed(row))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                if len(buffer) >= flush_rows:
+                    flush()
+                    logging.info(f'Embedded {staged} rows, {staged / (time.perf_counter() - start):.1f} rows/sec')
+        if tasks:
+            await asyncio.gather(*tasks)
+        flush()
+    return staged, failed
+
+
+def load_staging(
+    client: bigquery.Client,
+    path: str,
+    staging_table: str) -> bigquery.LoadJob:
+    """Replace staging_table with the contents of a staged Parquet file."""
+    parquet_options = bigquery.format_options.ParquetOptions()
+    parquet_options.enable_list_inference = True # load list<double> as ARRAY<FLOAT64>
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        parquet_options=parquet_options)
+    with open(path, 'rb') as f:
+        job = client.load_table_from_file(f, staging_table, job_config=job_config)
+    return job.result()
+
+
+def backfill(
+    table: str = config.PRODUCT_REFERENCE_TABLE,
+    staging_table: Optional[str] = config.BACKFILL_STAGING_TABLE,
+    concurrency: int = config.BACKFILL_CONCURRENCY,
+    force: bool = False,
+    staging_dir: Optional[str] = None) -> dict:
+    """Embed changed rows of table and write the embeddings back.
+
+    Args:
+        table: reference table
+        staging_table: BigQuery table to load embeddings into before merging,
+            deleted afterwards
+        concurrency: max number of embedding calls in flight
+        force: re-embed all rows
+        staging_dir: directory for the staged Parquet file, a temporary
+            directory by default
+
+    Returns:
+        dict with the number of rows changed, staged and failed and the time
+        spent in each step
+    """
+    client = utils.get_bq_client()
+    staging_table = staging_table or f'{table}_embedding_staging'
+    stats = {}
+    start = time.perf_counter()
+    client.query(add_hash_column_query(table)).result()
+    rows = client.query(changed_rows_query(table, force)).result()
+    stats['changed'] = rows.total_rows
+    logging.info(f'{rows.total_rows} rows to embed')
+    if not rows.total_rows:
+        return stats
+
+    with tempfile.TemporaryDirectory(dir=staging_dir) as d:
+        path = os.path.join(d, 'embeddings.parquet')
+        step = time.perf_counter()
+        stats['staged'], stats['failed'] = asyncio.run(stage_embeddings(rows, path, concurrency))
+        stats['embed_seconds'] = time.perf_counter() - step
+        if not stats['staged']:
+            return stats
+        step = time.perf_counter()
+        load_staging(client, path, staging_table)
+        stats['load_seconds'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    client.query(merge_query(staging_table, table)).result()
+    stats['merge_seconds'] = time.perf_counter() - step
+    client.delete_table(staging_table, not_found_ok=True)
+    stats['total_seconds'] = time.perf_counter() - start
+    logging.info(f'Backfill done: {stats}')
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill embeddings of the product reference table.')
+    parser.add_argument('--table', default=config.PRODUCT_REFERENCE_TABLE)
+    parser.add_argument('--staging_table', default=config.BACKFILL_STAGING_TABLE)
+    parser.add_argument('--concurrency', type=int, default=config.BACKFILL_CONCURRENCY)
+    parser.add_argument('--force', action='store_true', help='re-embed all rows')
+    parser.add_argument('--staging_dir', help='directory for the staged Parquet file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    backfill(args.table, args.staging_table, args.concurrency, args.force, args.staging_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Embedding Backfill Unit Tests.
+
+These tests replace the embedding API and BigQuery client with fakes so no
+cloud APIs are called.
+"""
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import pyarrow.parquet as pq
+
+import config
+import embedding_backfill
+import embeddings
+
+ROWS = [
+  {config.COLUMN_ID: f'p{i}', config.COLUMN_DESCRIPTION: f'product {i}',
+   config.COLUMN_IMAGE_URI: f'gs://bucket/{i}.jpg' if i % 2 else None,
+   'content_hash': f'hash{i}'}
+  for i in range(10)]
+
+async def fake_embed(text, image=None, base64=False):
+  if text == 'product 3':
+    raise ValueError('bad product')
+  return embeddings.EmbeddingResponse([0.1, 0.2], [0.3, 0.4] if image else None)
+
+class Rows(list):
+  total_rows = property(len)
+
+class EmbeddingBackfillTest(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(embeddings, 'embed_async', fake_embed)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def test_changed_rows_query(self):
+    query = embedding_backfill.changed_rows_query('p.d.t')
+    self.assertIn(f'{config.COLUMN_EMBEDDING_HASH} != content_hash', query)
+    self.assertNotIn('WHERE', embedding_backfill.changed_rows_query('p.d.t', force=True))
+
+  def test_stage_embeddings(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'staged.parquet')
+      staged, failed = asyncio.run(embedding_backfill.stage_embeddings(ROWS, path, 4, flush_rows=3))
+      table = pq.read_table(path)
+    self.assertEqual((staged, failed), (9, 1))
+    self.assertEqual(table.schema, embedding_backfill.STAGING_SCHEMA)
+    rows = {r[config.COLUMN_ID]: r for r in table.to_pylist()}
+    self.assertNotIn('p3', rows)
+    self.assertEqual(rows['p1'][config.COLUMN_IMAGE_EMBEDDING], [0.3, 0.4])
+    self.assertEqual(rows['p2'][config.COLUMN_IMAGE_EMBEDDING], [])
+    self.assertEqual(rows['p2'][config.COLUMN_EMBEDDING_HASH], 'hash2')
+
+  def test_rows_fetched_off_the_event_loop(self):
+    threads = set()
+    def rows(): # like a RowIterator, fetching pages as it is iterated
+      for row in ROWS:
+        threads.add(threading.current_thread())
+        yield row
+    with tempfile.TemporaryDirectory() as d:
+      staged, _ = asyncio.run(embedding_backfill.stage_embeddings(rows(), os.path.join(d, 's.parquet'), flush_rows=4))
+    self.assertEqual(staged, 9)
+    self.assertNotIn(threading.main_thread(), threads)
+
+  def test_backfill(self):
+    client = mock.Mock()
+    client.query.return_value.result.side_effect = [None, Rows(ROWS), None]
+    with mock.patch.object(embedding_backfill.utils, 'get_bq_client', return_value=client):
+      stats = embedding_backfill.backfill('p.d.t')
+    self.assertEqual((stats['changed'], stats['staged'], stats['failed']), (10, 9, 1))
+    client.load_table_from_file.assert_called_once()
+    self.assertEqual(client.load_table_from_file.call_args.args[1], 'p.d.t_embedding_staging')
+    queries = [c.args[0] for c in client.query.call_args_list]
+    self.assertEqual(len(queries), 3)
+    self.assertIn('MERGE `p.d.t`', queries[-1])
+    client.delete_table.assert_called_once_with('p.d.t_embedding_staging', not_found_ok=True)
+
+  def test_backfill_nothing_changed(self):
+    client = mock.Mock()
+    client.query.return_value.result.side_effect = [None, Rows()]
+    with mock.patch.object(embedding_backfill.utils, 'get_bq_client', return_value=client):
+      stats = embedding_backfill.backfill('p.d.t')
+    self.assertEqual(stats, {'changed': 0})
+    client.load_table_from_file.assert_not_called()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -14,45 +14,179 @@
 
 """Invoke Vertex Embedding API."""
 
+from array import array
+import asyncio
 import base64
-from functools import cache
 import time
 import logging
-from typing import NamedTuple, Optional, Sequence
+from typing import NamedTuple, Optional, Sequence, Union
 
 from google.cloud import aiplatform
 from google.protobuf import struct_pb2
 
+import batching
+import caching
 import config
+import images
+import metrics
+import ratelimit
+import utils
+
+MODEL = 'multimodalembedding@001'
+MAX_TEXT_LENGTH = 1023
 
 class EmbeddingResponse(NamedTuple):
   text_embedding: Sequence[float]
   image_embedding: Sequence[float]
 
 
+def truncate_text(text: str) -> str:
+  """Truncate text to the maximum length accepted by the embedding model."""
+  if len(text) > MAX_TEXT_LENGTH:
+    logging.warning('Text must be less than 1024 characters. Truncating text.')
+    return text[:MAX_TEXT_LENGTH]
+  return text
+
+
+def read_image_base64(path: str) -> str:
+  """Read a local image file as a base64 encoded string."""
+  with open(path, "rb") as f:
+    return base64.b64encode(f.read()).decode("utf-8")
+
+
+class EmbeddingRequest(NamedTuple):
+  text: Optional[str] = None
+  image: Union[str, bytes, None] = None # bytes are the encoded image, base64 is ignored
+  base64: bool = False
+
+
+def _observe_instances(instances: list[struct_pb2.Struct]):
+  metrics.BATCH_SIZE.labels('embedding').observe(len(instances))
+  metrics.PAYLOAD_BYTES.labels('embedding').observe(sum(i.ByteSize() for i in instances))
+
+
 class EmbeddingPredictionClient:
-  """Wrapper around Prediction Service Client."""
+  """Wrapper around Prediction Service Client.
+
+  client and async_client replace the Prediction Service clients, e.g. with
+  the fakes of fakes.py.
+  """
   def __init__(self, project : str,
     location : str = "us-central1",
-    api_regional_endpoint: str = "us-central1-aiplatform.googleapis.com"):
+    api_regional_endpoint: str = "us-central1-aiplatform.googleapis.com",
+    client=None,
+    async_client=None):
     client_options = {"api_endpoint": api_regional_endpoint}
     # Initialize client that will be used to create and send requests.
     # This client only needs to be created once, and can be reused for multiple requests.
-    self.client = aiplatform.gapic.PredictionServiceClient(client_options=client_options)
+    self.client = client or aiplatform.gapic.PredictionServiceClient(client_options=client_options)
+    self._async_client = async_client
+    self.client_options = client_options
     self.location = location
     self.project = project
+    self.endpoint = (f"projects/{self.project}/locations/{self.location}"
+      f"/publishers/google/models/{MODEL}")
+    # Coalesces concurrent get_embedding() calls into multi-instance predict calls
+    self.batcher = None
+    if config.BATCHING_ENABLED:
+      self.batcher = batching.MicroBatcher(
+        self._predict_batch,
+        max_batch_size=config.EMBEDDING_BATCH_MAX_SIZE,
+        max_wait_ms=config.BATCH_WINDOW_MS,
+        name='embedding-batcher')
+
+  @staticmethod
+  def _instance(request: EmbeddingRequest) -> struct_pb2.Struct:
+    text, image, is_base64 = request
+    if not text and not image:
+      raise ValueError('At least one of text or image_bytes must be specified.')
+
+    instance = struct_pb2.Struct()
+    if text:
+      instance.fields['text'].string_value = truncate_text(text)
+
+    if image:
+      image_struct = instance.fields['image'].struct_value
+      if isinstance(image, bytes): # the API only takes base64, encode once here
+        image_struct.fields['bytesBase64Encoded'].string_value = base64.b64encode(image).decode('ascii')
+      elif is_base64:
+        image_struct.fields['bytesBase64Encoded'].string_value = image
+      elif image.lower().startswith('gs://'):
+        image_struct.fields['gcsUri'].string_value = image
+      else:
+        image_struct.fields['bytesBase64Encoded'].string_value = read_image_base64(image)
+    return instance
+
+  @property
+  def async_client(self) -> aiplatform.gapic.PredictionServiceAsyncClient:
+    """Async gRPC client bound to the running event loop."""
+    if self._async_client:
+      return self._async_client
+    return utils.get_loop_client(
+      ('prediction', self.client_options['api_endpoint']),
+      lambda: aiplatform.gapic.PredictionServiceAsyncClient(client_options=self.client_options))
+
+  def _predict(
+    self,
+    requests: list[EmbeddingRequest],
+    instances: Optional[list[struct_pb2.Struct]] = None) -> list[EmbeddingResponse]:
+    """Embed all requests with a single predict call.
+
+    instances are the API instances of the requests, built here if None.
+    """
+    if instances is None:
+      instances = [self._instance(request) for request in requests]
+    _observe_instances(instances)
+    response = ratelimit.call(
+      'embedding', self.client.predict, endpoint=self.endpoint, instances=instances)
+    return self._parse(response, requests)
+
+  def _predict_batch(
+    self, items: list[tuple[EmbeddingRequest, struct_pb2.Struct]]) -> list[EmbeddingResponse]:
+    """Batcher callback. Callers build their own instance so that e.g. an
+    unreadable local image fails its own call, not the whole batch."""
+    return self._predict([request for request, _ in items], [instance for _, instance in items])
+
+  async def _predict_async(self, requests: list[EmbeddingRequest]) -> list[EmbeddingResponse]:
+    """Async version of _predict()."""
+    instances = [self._instance(request) for request in requests]
+    _observe_instances(instances)
+    response = await ratelimit.call_async(
+      'embedding', self.async_client.predict, endpoint=self.endpoint, instances=instances)
+    return self._parse(response, requests)
+
+  @staticmethod
+  def _parse(response, requests: list[EmbeddingRequest]) -> list[EmbeddingResponse]:
+    results = []
+    for prediction, request in zip(response.predictions, requests):
+      text_embedding = None
+      if request.text:
+        text_embedding = [v for v in prediction['textEmbedding']]
+
+      image_embedding = None
+      if request.image:
+        image_embedding = [v for v in prediction['imageEmbedding']]
+
+      results.append(EmbeddingResponse(
+        text_embedding=text_embedding,
+        image_embedding=image_embedding))
+    return results
 
   def get_embedding(self, text: Optional[str] = None, 
-                    image: Optional[str] = None, base64: bool = False):
+                    image: Union[str, bytes, None] = None, base64: bool = False):
     """Invoke Vertex multimodal embedding API.
     
     You can pass text and/or image. If neither is passed will raise exception
 
+    When config.BATCHING_ENABLED is set, concurrent calls are coalesced into
+    a single predict call with one instance per caller.
+
     Args:
       text: text to embed
-      image: can be local file path, GCS URI or base64 encoded image
+      image: can be local file path, GCS URI, base64 encoded image or image
+        bytes
       base64: True indicates image is base64. False (default) will be 
-        interpreted as image path (either local or GCS)
+        interpreted as image path (either local or GCS). Ignored for bytes
     Returns:
     named tuple with the following attributes:
       text_embedding: 1408 dimension vector of type Sequence[float]
@@ -62,63 +196,223 @@ class EmbeddingPredictionClient:
     if not text and not image:
       raise ValueError('At least one of text or image_bytes must be specified.')
 
-    instance = struct_pb2.Struct()
-    if text:
-      if len(text) >= 1024:
-        logging.warning('Text must be less than 1024 characters. Truncating text.')
-        text = text[:1023]
-      instance.fields['text'].string_value = text
+    request = EmbeddingRequest(text, image, base64)
+    if self.batcher:
+      return self.batcher((request, self._instance(request)))
+    return self._predict([request])[0]
 
-    if image:
-      image_struct = instance.fields['image'].struct_value
-      if base64:
-        image_struct.fields['bytesBase64Encoded'].string_value = image
-      elif image.lower().startswith('gs://'):
-        image_struct.fields['gcsUri'].string_value = image
-      else:
-        with open(image, "rb") as f:
-          image_bytes = f.read()
-        encoded_content = base64.b64encode(image_bytes).decode("utf-8")
-        image_struct.fields['bytesBase64Encoded'].string_value = encoded_content
-
-    instances = [instance]
-    endpoint = (f"projects/{self.project}/locations/{self.location}"
-      "/publishers/google/models/multimodalembedding@001")
-    response = self.client.predict(endpoint=endpoint, instances=instances)
+  async def get_embedding_async(self, text: Optional[str] = None,
+                                image: Union[str, bytes, None] = None, base64: bool = False):
+    """Async version of get_embedding()."""
+    if not text and not image:
+      raise ValueError('At least one of text or image_bytes must be specified.')
 
-    text_embedding = None
-    if text:
-      text_emb_value = response.predictions[0]['textEmbedding']
-      text_embedding = [v for v in text_emb_value]
+    request = EmbeddingRequest(text, image, base64)
+    if self.batcher:
+      instance = self._instance(request)
+      return await asyncio.wrap_future(self.batcher.submit((request, instance)))
+    return (await self._predict_async([request]))[0]
 
-    image_embedding = None
-    if image:
-      image_emb_value = response.predictions[0]['imageEmbedding']
-      image_embedding = [v for v in image_emb_value]
+  def get_embeddings(self, requests: list[EmbeddingRequest]) -> list[EmbeddingResponse]:
+    """Embed many requests, config.EMBEDDING_BATCH_MAX_SIZE instances per call.
 
-    return EmbeddingResponse(
-      text_embedding=text_embedding,
-      image_embedding=image_embedding)
+    Args:
+      requests: list of EmbeddingRequest(text, image, base64)
+    Returns:
+      one EmbeddingResponse per request, in order
+    """
+    size = config.EMBEDDING_BATCH_MAX_SIZE
+    return [response for i in range(0, len(requests), size)
+            for response in self._predict(requests[i:i + size])]
 
+  async def get_embeddings_async(self, requests: list[EmbeddingRequest]) -> list[EmbeddingResponse]:
+    """Async version of get_embeddings(), predict calls are made concurrently."""
+    size = config.EMBEDDING_BATCH_MAX_SIZE
+    chunks = await asyncio.gather(*(
+      self._predict_async(requests[i:i + size]) for i in range(0, len(requests), size)))
+    return [response for chunk in chunks for response in chunk]
 
 
-@cache
+@utils.lazy
 def get_client(project):
   return EmbeddingPredictionClient(project)
 
 
+@utils.lazy
+def get_cache() -> Optional[caching.TieredCache]:
+  """Returns the embedding cache, or None if disabled in config.py."""
+  if not config.EMBEDDING_CACHE_MAX_BYTES and not config.EMBEDDING_CACHE_PATH:
+    return None
+  return caching.tiered_cache(
+    config.EMBEDDING_CACHE_MAX_BYTES,
+    config.EMBEDDING_CACHE_PATH,
+    table='embeddings')
+
+
+def cache_stats() -> dict[str, float]:
+  """Hit/miss counters of the embedding cache."""
+  c = get_cache.peek()
+  return c.stats() if c is not None else {}
+
+
+metrics.collected(
+  'catalog_embedding_cache', 'Embedding cache counters, see caching.TieredCache.stats()',
+  ('stat',), lambda: {(k,): v for k, v in cache_stats().items()})
+
+
+def _text_key(text: str) -> str:
+  return f'{MODEL}:text:' + caching.content_hash(text)
+
+
+def _image_key(image: Union[str, bytes], is_base64: bool, phash: Optional[str] = None) -> str:
+  """Key on the perceptual hash if given and enabled in config.py, else on the
+  image bytes as sent i.e. normalized, or on the URI for images stored in GCS."""
+  if phash and config.IMAGE_PERCEPTUAL_CACHE_KEY:
+    return f'{MODEL}:image:phash:{phash}'
+  if isinstance(image, bytes):
+    content = image
+  elif is_base64:
+    content = base64.b64decode(image)
+  elif image.lower().startswith('gs://'):
+    content = image
+  else:
+    raise ValueError('Local image paths must be read before computing the key')
+  return f'{MODEL}:image:' + caching.content_hash(content)
+
+
+def _raw_image_key(image: Union[str, bytes], is_base64: bool) -> Optional[str]:
+  """Key on the image as given, looked up before normalizing it so repeats of
+  the same bytes skip decoding and resizing. None for images that are not
+  normalized, which _image_key() already keys as given."""
+  if not config.IMAGE_NORMALIZATION or _is_gcs_uri(image, is_base64):
+    return None
+  return f'{MODEL}:image:raw:' + caching.content_hash(image)
+
+
+def _pack(embedding: Sequence[float]) -> bytes:
+  return array('f', embedding).tobytes()
+
+
+def _unpack(value: bytes) -> list[float]:
+  return array('f', value).tolist()
+
+
+def _is_gcs_uri(image: Union[str, bytes], is_base64: bool) -> bool:
+  return isinstance(image, str) and not is_base64 and image.lower().startswith('gs://')
+
+
+def _normalize_image(
+  image: Union[str, bytes, None],
+  is_base64: bool) -> tuple[Union[str, bytes, None], bool, Optional[str]]:
+  """Downsize and re-encode a base64, local or raw image, see images.py.
+
+  Returns:
+    the image, whether it is base64 encoded, and its perceptual hash.
+    Re-encoded images are returned as bytes, base64 encoded only once when
+    building the API request. Images that re-encoding doesn't shrink are
+    returned as given. The hash is None if the image was not normalized:
+    GCS URIs, normalization disabled in config.py, or an image Pillow can't
+    decode, which is sent as is for the API to judge
+  """
+  if not image or not config.IMAGE_NORMALIZATION or _is_gcs_uri(image, is_base64):
+    return image, is_base64, None
+  if isinstance(image, bytes):
+    data = image
+  elif is_base64:
+    data = base64.b64decode(image)
+  else:
+    with open(image, 'rb') as f:
+      data = f.read()
+  try:
+    result = images.normalize(data)
+  except Exception as e:
+    logging.warning(f'Sending image as is, normalization failed: {e}')
+    return image, is_base64, None
+  if result.data is data:
+    return image, is_base64, result.phash
+  return result.data, False, result.phash
+
+
+def _from_cache(
+  c: caching.TieredCache,
+  text: Optional[str],
+  image: Union[str, bytes, None],
+  base64: bool) -> tuple[EmbeddingResponse, EmbeddingResponse, EmbeddingRequest]:
+  """Look up the text and image halves of a request in the cache.
+
+  An image is looked up by the digest of its bytes as given first, and only
+  normalized on a miss, then looked up by the key of the normalized image.
+  Its embedding is cached under both keys.
+
+  Returns:
+    the cache keys of each half, the cached packed embeddings (None where
+    missing) and the request for the missing halves, with the image normalized
+  """
+  if isinstance(image, str) and not base64 and not _is_gcs_uri(image, base64):
+    with open(image, 'rb') as f: # hashed and normalized from the same bytes
+      image, base64 = f.read(), False
+  text = truncate_text(text) if text else text
+  text_keys = (_text_key(text),) if text else ()
+  image_keys, cached_image = (), None
+  if image:
+    raw_key = _raw_image_key(image, base64)
+    cached_image = c.get(raw_key) if raw_key else None
+    if cached_image is None:
+      image, base64, phash = _normalize_image(image, base64)
+      key = _image_key(image, base64, phash)
+      image_keys = (key, raw_key) if raw_key else (key,)
+      cached_image = c.get(key)
+      if cached_image is not None and raw_key:
+        c.put(raw_key, cached_image)
+  keys = EmbeddingResponse(text_embedding=text_keys, image_embedding=image_keys)
+  cached = EmbeddingResponse(
+    text_embedding=c.get(text_keys[0]) if text_keys else None,
+    image_embedding=cached_image)
+  missing = EmbeddingRequest(
+    text=text if text and cached.text_embedding is None else None,
+    image=image if image and cached.image_embedding is None else None,
+    base64=base64)
+  return keys, cached, missing
+
+
+def _merge(
+  c: caching.TieredCache,
+  keys: EmbeddingResponse,
+  cached: EmbeddingResponse,
+  response: Optional[EmbeddingResponse]) -> EmbeddingResponse:
+  """Combine cached halves with freshly computed ones, caching the latter."""
+  values = []
+  for half_keys, value, fresh in zip(keys, cached, response or (None, None)):
+    if value is None and fresh is not None:
+      value = _pack(fresh)
+      for key in half_keys:
+        c.put(key, value)
+    values.append(_unpack(value) if value is not None else None)
+  return EmbeddingResponse(*values)
+
+
+@metrics.timed('embedding')
 def embed(
   text: str,
-  image: Optional[str] = None,
+  image: Union[str, bytes, None] = None,
   base64: bool = False, 
   project: str = config.PROJECT) -> EmbeddingResponse:
   """Invoke vertex multimodal embedding API.
 
+  Base64, local and raw images are downsized and re-encoded first, see
+  images.py. Text and image embeddings are cached independently, keyed by a
+  hash of the truncated text and a hash of the normalized image (or its GCS
+  URI) respectively, or a perceptual hash of the image if
+  config.IMAGE_PERCEPTUAL_CACHE_KEY is set. Images are also keyed by a hash
+  of the bytes as given, so a repeated image is not normalized again. On a
+  partial hit only the missing half is sent to the API.
+
   Args:
     text: text to embed
-    image: can be local file path, GCS URI or base64 encoded image
+    image: can be local file path, GCS URI, base64 encoded image or image
+      bytes
     base64: True indicates image is base64. False (default) will be 
-        interpreted as image path (either local or GCS)
+        interpreted as image path (either local or GCS). Ignored for bytes
     project: GCP Project ID
 
   Returns:
@@ -128,7 +422,101 @@ def embed(
         no image provide
   """
   client = get_client(project)
-  start = time.time()
-  response = client.get_embedding(text=text, image=image, base64=base64)
-  end = time.time()
-  return response
+  c = get_cache()
+  if c is None:
+    image, base64, _ = _normalize_image(image, base64)
+    return client.get_embedding(text=text, image=image, base64=base64)
+
+  keys, cached, missing = _from_cache(c, text, image, base64)
+  response = None
+  if missing.text or missing.image:
+    response = client.get_embedding(
+      text=missing.text, image=missing.image, base64=missing.base64)
+  return _merge(c, keys, cached, response)
+
+
+@metrics.timed('embedding')
+async def embed_async(
+  text: str,
+  image: Union[str, bytes, None] = None,
+  base64: bool = False, 
+  project: str = config.PROJECT) -> EmbeddingResponse:
+  """Async version of embed()."""
+  client = get_client(project)
+  c = get_cache()
+  keys, cached, missing = await _from_cache_async(c, EmbeddingRequest(text, image, base64))
+  if c is None:
+    return await client.get_embedding_async(text=missing.text, image=missing.image, base64=missing.base64)
+
+  response = None
+  if missing.text or missing.image:
+    response = await client.get_embedding_async(
+      text=missing.text, image=missing.image, base64=missing.base64)
+  return _merge(c, keys, cached, response)
+
+
+async def _from_cache_async(
+  c: Optional[caching.TieredCache],
+  request: EmbeddingRequest) -> tuple[Optional[EmbeddingResponse], Optional[EmbeddingResponse], EmbeddingRequest]:
+  """_from_cache() off the event loop for images, as reading and normalizing
+  them is blocking. Without a cache only the image is normalized, and the
+  whole request is missing."""
+  if c is None:
+    if not request.image:
+      return None, None, request
+    image, base64, _ = await asyncio.to_thread(_normalize_image, request.image, request.base64)
+    return None, None, EmbeddingRequest(request.text, image, base64)
+  if not request.image:
+    return _from_cache(c, *request)
+  return await asyncio.to_thread(_from_cache, c, *request)
+
+
+@metrics.timed('embedding_batch')
+async def embed_batch_async(
+  requests: list[EmbeddingRequest],
+  project: str = config.PROJECT) -> list[Union[EmbeddingResponse, Exception]]:
+  """embed_async() for many products with as few predict calls as possible.
+
+  The text and image halves missing from the cache are sent
+  config.EMBEDDING_BATCH_MAX_SIZE instances per predict call. If a call
+  fails its requests are retried one by one, so e.g. an invalid image only
+  fails its own product.
+
+  Returns:
+    one EmbeddingResponse per request, in order, or the exception raised
+    while embedding it
+  """
+  client = get_client(project)
+  c = get_cache()
+  looked_up = await asyncio.gather(*(_from_cache_async(c, r) for r in requests), return_exceptions=True)
+  results = [None] * len(requests)
+  lookups, pending = {}, []
+  for i, lookup in enumerate(looked_up):
+    if isinstance(lookup, Exception): # e.g. unreadable local image
+      results[i] = lookup
+      continue
+    keys, cached, missing = lookup
+    lookups[i] = (keys, cached) if c is not None else None
+    if c is None or missing.text or missing.image:
+      pending.append((i, missing))
+
+  async def predict(chunk: list[EmbeddingRequest]) -> list[Union[EmbeddingResponse, Exception]]:
+    try:
+      return await client.get_embeddings_async(chunk)
+    except Exception as e:
+      if len(chunk) == 1:
+        return [e]
+      logging.warning(f'Embedding {len(chunk)} instances failed, retrying one by one: {e}')
+      return [r for rs in await asyncio.gather(*(predict([r]) for r in chunk)) for r in rs]
+
+  size = config.EMBEDDING_BATCH_MAX_SIZE
+  missing = [request for _, request in pending]
+  chunks = await asyncio.gather(*(predict(missing[i:i + size]) for i in range(0, len(missing), size)))
+  fresh = dict(zip([i for i, _ in pending], [r for chunk in chunks for r in chunk]))
+  for i, lookup in lookups.items():
+    response = fresh.get(i)
+    if lookup is None or isinstance(response, Exception):
+      results[i] = response
+    else:
+      results[i] = _merge(c, *lookup, response)
+  return results
@@ -21,7 +21,11 @@ the expected format. This integration test assumes:
 
 https://cloud.google.com/vertex-ai/docs/generative-ai/embeddings/get-multimodal-embeddings
 """
+import base64
+from concurrent.futures import ThreadPoolExecutor
 import unittest
+from unittest import mock
+import caching
 import config
 import embeddings
 
@@ -59,5 +63,115 @@ class EmbeddingsTest(unittest.TestCase):
     self.assertEqual(len(res.text_embedding), 1408)
     self.assertEqual(len(res.image_embedding), 1408)
 
+class EmbeddingsCacheTest(unittest.TestCase):
+  """Offline tests of the embedding cache using a stub prediction client."""
+
+  def setUp(self):
+    self.client = mock.Mock()
+    self.client.get_embedding.side_effect = lambda text=None, image=None, base64=False: \
+      embeddings.EmbeddingResponse(
+        text_embedding=[1.0] * 1408 if text else None,
+        image_embedding=[2.0] * 1408 if image else None)
+    self.cache = caching.tiered_cache(1024**2)
+    mock.patch.object(embeddings, 'get_client', return_value=self.client).start()
+    get_cache = mock.patch.object(embeddings, 'get_cache', return_value=self.cache).start()
+    get_cache.peek.return_value = self.cache
+    self.addCleanup(mock.patch.stopall)
+
+  def test_cache_hit(self):
+    embeddings.embed('This is a test description')
+    res = embeddings.embed('This is a test description')
+    self.assertEqual(self.client.get_embedding.call_count, 1)
+    self.assertEqual(len(res.text_embedding), 1408)
+    self.assertIsNone(res.image_embedding)
+
+  def test_partial_hit_only_embeds_image(self):
+    image_base64 = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNk+A8AAQUBAScY42YAAAAASUVORK5CYII='
+    embeddings.embed('This is a test description')
+    res = embeddings.embed('This is a test description', image_base64, base64=True)
+    self.client.get_embedding.assert_called_with(text=None, image=image_base64, base64=True)
+    self.assertEqual(res.text_embedding[0], 1.0)
+    self.assertEqual(res.image_embedding[0], 2.0)
+
+  def test_truncated_text_shares_key(self):
+    embeddings.embed('x' * 2000)
+    embeddings.embed('x' * 1500)
+    self.assertEqual(self.client.get_embedding.call_count, 1)
+    self.assertEqual(embeddings.cache_stats()['memory_hits'], 1)
+
+  def test_stats_do_not_create_cache(self):
+    mock.patch.stopall()
+    embeddings.get_cache.cache_clear()
+    self.addCleanup(embeddings.get_cache.cache_clear)
+    self.assertEqual(embeddings.cache_stats(), {})
+    self.assertIsNone(embeddings.get_cache.peek())
+
+  def test_raw_image_shares_key_with_base64(self):
+    image_base64 = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNk+A8AAQUBAScY42YAAAAASUVORK5CYII='
+    image = base64.b64decode(image_base64)
+    with mock.patch.object(config, 'IMAGE_NORMALIZATION', False):
+      embeddings.embed('This is a test description', image)
+      embeddings.embed('This is a test description', image_base64, base64=True)
+    self.client.get_embedding.assert_called_once_with(text='This is a test description', image=image, base64=False)
+    instance = embeddings.EmbeddingPredictionClient._instance(embeddings.EmbeddingRequest(image=image))
+    self.assertEqual(instance.fields['image'].struct_value.fields['bytesBase64Encoded'].string_value, image_base64)
+
+class EmbeddingsBatchingTest(unittest.TestCase):
+  """Offline tests of request coalescing using a stub gRPC client."""
+
+  def setUp(self):
+    self.predict = mock.Mock(side_effect=lambda endpoint, instances: mock.Mock(
+      predictions=[{'textEmbedding': [float(len(i.fields['text'].string_value))] * 1408}
+                   for i in instances]))
+    gapic = mock.patch.object(embeddings.aiplatform.gapic, 'PredictionServiceClient').start()
+    gapic.return_value.predict = self.predict
+    mock.patch.object(config, 'BATCHING_ENABLED', True).start()
+    mock.patch.object(config, 'BATCH_WINDOW_MS', 50).start()
+    self.addCleanup(mock.patch.stopall)
+
+  def test_concurrent_calls_share_predict(self):
+    client = embeddings.EmbeddingPredictionClient('project')
+    texts = ['a' * i for i in range(1, 9)]
+    with ThreadPoolExecutor(8) as pool:
+      res = list(pool.map(lambda t: client.get_embedding(text=t), texts))
+    self.assertEqual([r.text_embedding[0] for r in res], [float(len(t)) for t in texts])
+    self.assertLess(self.predict.call_count, len(texts))
+
+  def test_invalid_item_only_fails_itself(self):
+    def predict(endpoint, instances):
+      if any(i.fields['text'].string_value == 'invalid' for i in instances):
+        raise ValueError('400 invalid instance')
+      return mock.Mock(predictions=[
+        {'textEmbedding': [float(len(i.fields['text'].string_value))] * 1408} for i in instances])
+    self.predict.side_effect = predict
+    client = embeddings.EmbeddingPredictionClient('project')
+    def embed(text):
+      try:
+        return client.get_embedding(text=text).text_embedding[0]
+      except Exception as e:
+        return type(e)
+    texts = ['a', 'invalid', 'bbb', 'cc']
+    with ThreadPoolExecutor(len(texts)) as pool:
+      res = list(pool.map(embed, texts))
+    self.assertEqual(res, [1.0, ValueError, 3.0, 2.0])
+    self.assertGreater(self.predict.call_count, len(texts))
+
+  def test_unreadable_local_image_only_fails_itself(self):
+    client = embeddings.EmbeddingPredictionClient('project')
+    with ThreadPoolExecutor(2) as pool:
+      ok = pool.submit(client.get_embedding, text='abc')
+      bad = pool.submit(client.get_embedding, text='a', image='/nonexistent/image.jpg')
+      self.assertEqual(ok.result().text_embedding[0], 3.0)
+      with self.assertRaises(FileNotFoundError):
+        bad.result()
+
+  def test_get_embeddings(self):
+    client = embeddings.EmbeddingPredictionClient('project')
+    requests = [embeddings.EmbeddingRequest(text='a' * i) for i in range(1, 21)]
+    res = client.get_embeddings(requests)
+    self.assertEqual(len(res), 20)
+    self.assertEqual(res[-1].text_embedding[0], 20.0)
+    self.assertEqual(self.predict.call_count, 2)
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -0,0 +1,253 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Full product enrichment sharing a single retrieval across tasks.
+
+Categories and attributes are both grounded on the nearest neighbors of the
+product, so the product is embedded once, the vector store is queried once
+and the reference table is joined once. The category ranking and attribute
+generation LLM calls then run concurrently.
+
+The batch functions share retrieval across products in the same way: all
+products are embedded in batched predict calls, searched with one index call
+per distinct filter and joined against the reference table in one lookup.
+"""
+import asyncio
+import time
+from typing import NamedTuple, Optional, Union
+
+import attributes
+import category
+import config
+import embeddings
+import marketing
+import metrics
+import nearest_neighbors
+import reference_store
+import taxonomy
+import utils
+
+
+@metrics.timed('reference_join')
+async def join_reference_async(ids: list[str]) -> dict[str:dict]:
+    """Gets categories, attributes and description for product IDs in one query.
+
+    Returns:
+        dict mapping product IDs to a dict with the following keys:
+            category: e.g. ['level 1 category', 'level 2 category']
+            attributes: e.g. {'color':'green', 'pattern': striped}
+            description: e.g. 'This is a description'
+    """
+    store = reference_store.get_store()
+    if store:
+        rows = await store.rows_async(ids)
+    else:
+        rows = list(await utils.query_async(reference_store.reference_query(ids)))
+    categories = category.parse_categories(rows, config.ALLOW_TRAILING_NULLS)
+    attributes_desc = attributes.parse_attributes_desc(rows)
+    return {id: {'category': categories[id], **attributes_desc[id]} for id in attributes_desc}
+
+
+class _Timer:
+    """Records the wall time of named stages in milliseconds."""
+    def __init__(self):
+        self.timings = {}
+
+    async def time(self, stage: str, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.timings[stage] = (time.perf_counter() - start) * 1000
+
+
+async def enrich_async(
+    desc: str,
+    image: Union[str, bytes, None] = None,
+    base64: bool = False,
+    num_neighbors: int = config.NUM_NEIGHBORS,
+    filters: list[str] = [],
+    include_marketing_copy: bool = False) -> dict:
+    """Suggest categories and attributes, and optionally marketing copy.
+
+    Args:
+        desc: user provided description of product
+        image: can be local file path, GCS URI, base64 encoded image or image
+          bytes
+        base64: True indicates image is base64. False (default) will be 
+          interpreted as image path (either local or GCS)
+        num_neigbhors: number of nearest neighbors to return for EACH embedding
+        filters: category prefix to restrict results to
+        include_marketing_copy: also generate marketing copy from the
+          description and generated attributes
+
+    Returns:
+        dict with the following keys:
+            categories: ranked categories, see category.retrieve_and_rank()
+            attributes: see attributes.retrieve_and_generate_attributes()
+            marketing_copy: see marketing.generate_marketing_copy(), None
+              unless include_marketing_copy is set
+            timings_ms: wall time of each stage in milliseconds
+    """
+    timer = _Timer()
+    start = time.perf_counter()
+    result = {'categories': [], 'attributes': {}, 'marketing_copy': None, 'timings_ms': timer.timings}
+    if not taxonomy.matches(filters):
+        result['categories'] = [['ERROR: No existing products match that category']]
+        result['attributes'] = {'error':'ERROR: no existing products match that category'}
+        timer.timings['total'] = (time.perf_counter() - start) * 1000
+        return result
+
+    res = await timer.time('embedding', embeddings.embed_async(desc, image, base64))
+    embeds = [res.text_embedding, res.image_embedding] if res.image_embedding else [res.text_embedding]
+    neighbors = await timer.time('nearest_neighbors', nearest_neighbors.get_nn_async(embeds, filters, num_neighbors))
+    if not neighbors:
+        if filters:
+            result['categories'] = [['ERROR: No existing products match that category']]
+            result['attributes'] = {'error':'ERROR: no existing products match that category'}
+        timer.timings['total'] = (time.perf_counter() - start) * 1000
+        return result
+
+    ids = [n.id[:-2] for n in neighbors] # last 3 chars are not part of product ID
+    reference = await timer.time('reference_join', join_reference_async(ids))
+    candidates = category.prune(sorted(
+        [{**reference[n.id[:-2]], 'id': n.id, 'distance': n.distance} for n in neighbors],
+        key=lambda d: d['distance']), embeds, filters)
+
+    if config.RANK_MODE == 'centroid':
+        ranked = timer.time('rank', category.classify_async(embeds, filters))
+    else:
+        ranked = timer.time('rank', category.rank_candidates_async(desc, candidates))
+    result['categories'], result['attributes'] = await timer.time('llm', asyncio.gather(
+        ranked,
+        timer.time('attributes', attributes.generate_attributes_with_fallback_async(desc, candidates))))
+    if include_marketing_copy:
+        result['marketing_copy'] = await timer.time(
+            'marketing', marketing.generate_marketing_copy_async(desc, result['attributes']))
+    timer.timings['total'] = (time.perf_counter() - start) * 1000
+    return result
+
+
+class BatchItem(NamedTuple):
+    """A product of a batch call."""
+    description: str
+    image: Union[str, bytes, None] = None # see enrich_async()
+    base64: bool = False
+    filters: list[str] = []
+
+
+def _embeds(res: embeddings.EmbeddingResponse) -> list[list[float]]:
+    return [res.text_embedding, res.image_embedding] if res.image_embedding else [res.text_embedding]
+
+
+async def _embed_batch(items: list[BatchItem]) -> list[Union[embeddings.EmbeddingResponse, Exception, None]]:
+    """Embed the items, but those with category filters no product matches (None)."""
+    valid = [i for i, item in enumerate(items) if taxonomy.matches(item.filters)]
+    embedded = await embeddings.embed_batch_async(
+        [embeddings.EmbeddingRequest(items[i].description, items[i].image, items[i].base64) for i in valid])
+    responses = [None] * len(items)
+    for i, res in zip(valid, embedded):
+        responses[i] = res
+    return responses
+
+
+async def retrieve_batch_async(
+    items: list[BatchItem],
+    num_neighbors: int = config.NUM_NEIGHBORS) -> list[Union[list[dict], Exception]]:
+    """Retrieve the grounding candidates of many products at once.
+
+    Returns:
+        one list of candidates per item, in order, or the exception raised
+        while retrieving them. Candidates are sorted by embedding distance
+        and have the keys of join_reference_async() plus id and distance
+    """
+    responses = await _embed_batch(items)
+    results = [[] if res is None else res for res in responses]
+    groups = {} # filters -> indexes of the items to search with them
+    for i, res in enumerate(responses):
+        if res is not None and not isinstance(res, Exception):
+            groups.setdefault(tuple(items[i].filters), []).append(i)
+    searches = await asyncio.gather(*(
+        nearest_neighbors.get_nn_batch_async([_embeds(responses[i]) for i in indexes], list(filters), num_neighbors)
+        for filters, indexes in groups.items()), return_exceptions=True)
+    neighbors = {}
+    for indexes, found in zip(groups.values(), searches):
+        for n, i in enumerate(indexes):
+            if isinstance(found, Exception):
+                results[i] = found
+            else:
+                neighbors[i] = found[n]
+
+    ids = list(dict.fromkeys(n.id[:-2] for found in neighbors.values() for n in found))
+    try:
+        reference = await join_reference_async(ids) if ids else {}
+    except Exception as e:
+        reference = e
+    for i, found in neighbors.items():
+        if isinstance(reference, Exception) and found:
+            results[i] = reference
+            continue
+        results[i] = category.prune(sorted(
+            [{**reference[n.id[:-2]], 'id': n.id, 'distance': n.distance} for n in found],
+            key=lambda d: d['distance']), _embeds(responses[i]), items[i].filters)
+    return results
+
+
+async def suggest_categories_batch_async(
+    items: list[BatchItem],
+    num_neighbors: int = config.NUM_NEIGHBORS) -> list[Union[list[list[str]], Exception]]:
+    """category.retrieve_and_rank_async() for many products.
+
+    Returns:
+        the ranked categories of each item, in order, or the exception
+        raised while suggesting them
+    """
+    async def rank(item: BatchItem, candidates: Union[list[dict], Exception]) -> list[list[str]]:
+        if isinstance(candidates, Exception):
+            raise candidates
+        if item.filters and not candidates:
+            return [['ERROR: No existing products match that category']]
+        return await category.rank_candidates_async(item.description, candidates)
+
+    if config.RANK_MODE == 'centroid':
+        results = []
+        for item, res in zip(items, await _embed_batch(items)):
+            if res is None:
+                res = [['ERROR: No existing products match that category']]
+            elif not isinstance(res, Exception):
+                res = category.classify(_embeds(res), item.filters)
+            results.append(res)
+        return results
+    retrieved = await retrieve_batch_async(items, num_neighbors)
+    return await asyncio.gather(*(rank(*args) for args in zip(items, retrieved)), return_exceptions=True)
+
+
+async def suggest_attributes_batch_async(
+    items: list[BatchItem],
+    num_neighbors: int = config.NUM_NEIGHBORS) -> list[Union[dict[str,str], Exception]]:
+    """attributes.retrieve_and_generate_attributes_async() for many products.
+
+    Returns:
+        the attributes of each item, in order, or the exception raised while
+        generating them
+    """
+    async def generate(item: BatchItem, candidates: Union[list[dict], Exception]) -> dict[str,str]:
+        if isinstance(candidates, Exception):
+            raise candidates
+        if item.filters and not candidates:
+            return {'error':'ERROR: no existing products match that category'}
+        return await attributes.generate_attributes_with_fallback_async(item.description, candidates)
+
+    retrieved = await retrieve_batch_async(items, num_neighbors)
+    return await asyncio.gather(*(generate(*args) for args in zip(items, retrieved)), return_exceptions=True)
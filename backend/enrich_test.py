@@ -0,0 +1,115 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Enrichment Integration Tests.
+
+These tests assume:
+-The appropriate variables have been set in config.py
+-The test is run from an environment that has permission to call cloud APIs
+
+EnrichBatchTest runs fully offline against the fakes of fakes.py.
+"""
+import logging; logging.basicConfig(level=logging.INFO)
+import asyncio
+import unittest
+from unittest import mock
+
+import category
+import config
+import embeddings
+import enrich
+import fakes
+import nearest_neighbors
+
+class EnrichTest(unittest.TestCase):
+
+  def test_join_reference(self):
+    res = asyncio.run(enrich.join_reference_async([config.TEST_PRODUCT_ID]))
+    logging.info(res)
+    self.assertEqual(set(res[config.TEST_PRODUCT_ID].keys()), {'category','attributes','description'})
+
+  def test_enrich(self):
+    res = asyncio.run(enrich.enrich_async(
+        'This is a test description',
+        config.TEST_GCS_IMAGE,
+        include_marketing_copy=True
+    ))
+    logging.info(res)
+    self.assertGreater(len(res['categories']),0)
+    self.assertGreater(len(res['attributes']),0)
+    self.assertIsInstance(res['marketing_copy'], str)
+    self.assertIn('total', res['timings_ms'])
+
+  def test_enrich_with_bad_filter(self):
+    res = asyncio.run(enrich.enrich_async(
+        'This is a test description',
+        config.TEST_GCS_IMAGE,
+        filters=['XYZunknowncategory']
+    ))
+    logging.info(res)
+    self.assertIn('error', res['attributes'])
+    self.assertIsNone(res['marketing_copy'])
+
+class EnrichBatchTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.catalog = fakes.Catalog(200)
+
+  def setUp(self):
+    embeddings.get_cache.cache_clear()
+    self.fakes = fakes.installed(self.catalog)
+    self.f = self.fakes.__enter__()
+    self.addCleanup(self.fakes.__exit__, None, None, None)
+    self.searches = mock.patch.object(
+      nearest_neighbors, 'find_neighbors_async', wraps=nearest_neighbors.find_neighbors_async).start()
+    self.addCleanup(mock.patch.stopall)
+
+  def test_categories_share_calls(self):
+    items = [enrich.BatchItem(self.catalog.description(i)) for i in range(20)]
+    res = asyncio.run(enrich.suggest_categories_batch_async(items))
+    self.assertEqual(self.f.embedding.calls, 2) # config.EMBEDDING_BATCH_MAX_SIZE per call
+    self.assertEqual(self.searches.call_count, 1)
+    self.assertEqual(self.f.bigquery.queries, 1)
+    self.assertEqual(len(res), 20)
+    for item, categories in zip(items[:3], res):
+      self.assertEqual(categories, asyncio.run(category.retrieve_and_rank_async(item.description)))
+
+  def test_one_search_per_filter(self):
+    items = [enrich.BatchItem(self.catalog.description(i), filters=[f'Category {i % 2 + 1}']) for i in range(6)]
+    items.append(enrich.BatchItem('no match', filters=['XYZunknowncategory']))
+    res = asyncio.run(enrich.suggest_attributes_batch_async(items))
+    self.assertEqual(self.searches.call_count, 2) # the unknown category is rejected by the taxonomy
+    self.assertIn('color', res[0])
+    self.assertEqual(res[-1], {'error':'ERROR: no existing products match that category'})
+
+  def test_errors_per_item(self):
+    predict = embeddings.EmbeddingPredictionClient._predict_async
+    async def fail_on_text(client, requests):
+      if any(r.text == 'fail' for r in requests):
+        raise ValueError('invalid instance')
+      return await predict(client, requests)
+
+    items = [enrich.BatchItem(self.catalog.description(i)) for i in range(4)]
+    items[1] = enrich.BatchItem('fail')
+    items[2] = enrich.BatchItem('missing image', '/nonexistent/image.png')
+    with mock.patch.object(embeddings.EmbeddingPredictionClient, '_predict_async', fail_on_text):
+      res = asyncio.run(enrich.suggest_categories_batch_async(items))
+    self.assertIsInstance(res[1], ValueError)
+    self.assertIsInstance(res[2], FileNotFoundError)
+    self.assertEqual(len(res[0][0]), 4)
+    self.assertEqual(len(res[3][0]), 4)
+
+if __name__ == '__main__':
+  unittest.main()
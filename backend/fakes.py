@@ -0,0 +1,347 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deterministic local stand-ins for the upstream services.
+
+Fakes of the embedding API, the vector index, BigQuery and the LLM, serving
+a synthetic catalog with configurable latency. They let benchmark.py and
+offline tests run the full request path, including caching, batching and
+rate limiting, without GCP:
+
+    with fakes.installed(profile='vertex'):
+        await enrich.enrich_async('Blue denim jacket')
+
+Responses only depend on the request and the catalog seed. Latencies are
+sampled from seeded distributions, so runs differ only by scheduling noise.
+"""
+import asyncio
+from collections import Counter
+import contextlib
+import datetime
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Iterator, Optional
+from unittest import mock
+
+import numpy as np
+
+import config
+import embeddings
+import local_index
+import nearest_neighbors
+import taxonomy
+import utils
+
+DIMENSIONS = 1408
+WORDS = ['soft', 'cotton', 'slim', 'classic', 'printed', 'casual', 'warm', 'light',
+         'leather', 'denim', 'striped', 'solid', 'premium', 'durable', 'stretch', 'round']
+COLORS = ['black', 'white', 'blue', 'red', 'green', 'grey', 'brown', 'pink']
+
+
+def _seed(*parts) -> int:
+    return int.from_bytes(hashlib.sha256('\0'.join(map(str, parts)).encode()).digest()[:8], 'little')
+
+
+class Latency:
+    """Log-normal latency distribution given by its median and 99th percentile.
+
+    Constant if p99_ms is None or equal to median_ms, zero if median_ms is 0.
+
+    Args:
+        median_ms: median latency in milliseconds
+        p99_ms: 99th percentile latency in milliseconds
+        seed: random seed of the samples
+    """
+    Z99 = 2.3263 # standard normal 99th percentile
+
+    def __init__(self, median_ms: float = 0, p99_ms: Optional[float] = None, seed: int = 0):
+        self.median_ms = median_ms
+        self.p99_ms = p99_ms
+        self.sigma = math.log(p99_ms / median_ms) / self.Z99 if median_ms and p99_ms and p99_ms > median_ms else 0.0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def scaled(self, factor: float) -> 'Latency':
+        p99_ms = self.p99_ms * factor if self.p99_ms else None
+        return Latency(self.median_ms * factor, p99_ms, self._random.randrange(2**32))
+
+    def sample(self) -> float:
+        """A latency in seconds."""
+        if not self.median_ms:
+            return 0.0
+        with self._lock:
+            z = self._random.gauss(0, 1) if self.sigma else 0.0
+        return self.median_ms * math.exp(self.sigma * z) / 1000
+
+    def sleep(self):
+        if delay := self.sample():
+            time.sleep(delay)
+
+    async def sleep_async(self):
+        if delay := self.sample():
+            await asyncio.sleep(delay)
+
+
+PROFILES = { # latency per upstream, in the order of a request
+    'zero': {},
+    'vertex': { # rough figures for us-central1, measure yours with /metrics
+        'embedding': (120, 400),
+        'vector_search': (25, 90),
+        'bigquery': (600, 1800),
+        'llm': (1200, 4000),
+    },
+}
+
+
+def latencies(profile: str = 'zero', scale: float = 1.0, seed: int = 0) -> dict[str, Latency]:
+    """Latency of each upstream in a PROFILES entry, multiplied by scale."""
+    return {
+        upstream: Latency(*PROFILES[profile].get(upstream, (0, None)), seed=_seed(seed, upstream)).scaled(scale)
+        for upstream in ('embedding', 'vector_search', 'bigquery', 'llm')}
+
+
+class Catalog:
+    """Synthetic products in a 4 level category tree.
+
+    Embeddings are clustered by leaf category, so nearest neighbors of a
+    product's embedding share its category.
+
+    Args:
+        num_products: number of products
+        seed: random seed
+        branching: children per category at each level
+    """
+    def __init__(self, num_products: int = 1000, seed: int = 0, branching: tuple[int] = (4, 4, 3, 3)):
+        rng = np.random.default_rng(seed)
+        self.seed = seed
+        paths = [()]
+        for n in branching:
+            paths = [path + (i + 1,) for path in paths for i in range(n)]
+        # e.g. ('Category 1', 'Category 1.2', 'Category 1.2.3', 'Category 1.2.3.1')
+        self.leaves = [tuple('Category ' + '.'.join(map(str, path[:level + 1])) for level in range(len(path)))
+                       for path in paths]
+        self.centroids = local_index.normalize(rng.standard_normal((len(self.leaves), DIMENSIONS), dtype=np.float32))
+        self.products = {}
+        for i in range(num_products):
+            leaf = int(rng.integers(len(self.leaves)))
+            words = rng.choice(WORDS, size=6)
+            self.products[f'{i:032x}'] = {
+                'leaf': leaf,
+                'description': f"{' '.join(words)} {self.leaves[leaf][-1]}",
+                'attributes': {'color': str(rng.choice(COLORS)), 'material': str(words[0]), 'fit': str(words[1])},
+            }
+
+    def embed(self, key: str, leaf: Optional[int] = None) -> list[float]:
+        """Embedding of text or an image: near the centroid of a leaf category.
+
+        The leaf is derived from key unless given.
+        """
+        rng = np.random.default_rng(_seed(self.seed, key))
+        if leaf is None:
+            leaf = int(rng.integers(len(self.leaves)))
+        vector = self.centroids[leaf] + 0.03 * rng.standard_normal(DIMENSIONS, dtype=np.float32)
+        return local_index.normalize(vector[None])[0].tolist()
+
+    def description(self, i: int) -> str:
+        """A query description like those of the catalog."""
+        rng = random.Random(_seed(self.seed, 'query', i))
+        return f"{' '.join(rng.choices(WORDS, k=6))} {rng.choice(self.leaves)[-1]} {i}"
+
+    def row(self, id: str) -> dict:
+        """Reference table row of a product."""
+        product = self.products[id]
+        row = {config.COLUMN_ID: id,
+               config.COLUMN_ATTRIBUTES: json.dumps(product['attributes']),
+               config.COLUMN_DESCRIPTION: product['description']}
+        row.update(zip(config.COLUMN_CATEGORIES, self.leaves[product['leaf']]))
+        return row
+
+    def datapoints(self) -> list[dict]:
+        """Text and image datapoints of every product in JSONL record format."""
+        records = []
+        for id, product in self.products.items():
+            restricts = [{'namespace': n, 'allow': [c]}
+                         for n, c in zip(config.FILTER_CATEGORIES, self.leaves[product['leaf']])]
+            for suffix in ('_T', '_I'):
+                records.append({'id': id + suffix, 'embedding': self.embed(id + suffix, product['leaf']),
+                                'restricts': restricts})
+        return records
+
+
+class FakePredictionService:
+    """Multimodal embedding PredictionServiceClient.predict() with sync and async variants."""
+    def __init__(self, catalog: Catalog, latency: Latency):
+        self.catalog = catalog
+        self.latency = latency
+        self.calls = 0
+        self.instances = 0
+
+    def _response(self, instances) -> SimpleNamespace:
+        self.calls += 1
+        self.instances += len(instances)
+        predictions = []
+        for instance in instances:
+            prediction = {}
+            if 'text' in instance.fields:
+                prediction['textEmbedding'] = self.catalog.embed(instance.fields['text'].string_value)
+            if 'image' in instance.fields:
+                image = instance.fields['image'].struct_value
+                key = image.fields['gcsUri'].string_value or image.fields['bytesBase64Encoded'].string_value
+                prediction['imageEmbedding'] = self.catalog.embed(key)
+            predictions.append(prediction)
+        return SimpleNamespace(predictions=predictions)
+
+    def predict(self, endpoint: str, instances: list):
+        self.latency.sleep()
+        return self._response(instances)
+
+    @property
+    def async_client(self) -> SimpleNamespace:
+        async def predict(endpoint: str, instances: list):
+            await self.latency.sleep_async()
+            return self._response(instances)
+        return SimpleNamespace(predict=predict)
+
+
+class FakeIndex(local_index.ExactIndex):
+    """Exact search over the catalog, slowed down to the latency of a remote index."""
+    def __init__(self, catalog: Catalog, latency: Latency):
+        super().__init__(local_index.Datapoints.from_records(catalog.datapoints()))
+        self.latency = latency
+
+    def find_neighbors(self, **kwargs):
+        self.latency.sleep()
+        return super().find_neighbors(**kwargs)
+
+
+class _FakeJob:
+    def __init__(self, rows: list[dict], delay: float):
+        self.rows = rows
+        self.ready_at = time.monotonic() + delay
+
+    def done(self) -> bool:
+        return time.monotonic() >= self.ready_at
+
+    def result(self) -> list[dict]:
+        time.sleep(max(0.0, self.ready_at - time.monotonic()))
+        return self.rows
+
+
+class FakeBigQueryClient:
+    """Answers reference table queries by product ID, and the taxonomy query.
+
+    See reference_store.reference_query() and taxonomy.taxonomy_query().
+    The table was last modified when the client was created.
+    """
+    def __init__(self, catalog: Catalog, latency: Latency):
+        self.catalog = catalog
+        self.latency = latency
+        self.queries = 0
+        self.modified = datetime.datetime.now(datetime.timezone.utc)
+
+    def get_table(self, table: str) -> SimpleNamespace:
+        return SimpleNamespace(modified=self.modified)
+
+    def query(self, query: str, job_config=None) -> _FakeJob:
+        self.queries += 1
+        if 'GROUP BY' in query: # see taxonomy.taxonomy_query()
+            counts = Counter(product['leaf'] for product in self.catalog.products.values())
+            rows = [{**dict(zip(config.COLUMN_CATEGORIES, self.catalog.leaves[leaf])), 'product_count': count}
+                    for leaf, count in counts.items()]
+            return _FakeJob(rows, self.latency.sample())
+        match = re.search(rf'{config.COLUMN_ID} IN \((.*?)\)', query, re.S)
+        ids = re.findall(r"'([^']*)'", match.group(1)) if match else []
+        rows = [self.catalog.row(id) for id in dict.fromkeys(ids) if id in self.catalog.products]
+        return _FakeJob(rows, self.latency.sample())
+
+
+class FakeLLM:
+    """Text model answering the rank, attributes and marketing prompts in the expected format."""
+    def __init__(self, latency: Latency, response_chars: int = 400):
+        self.latency = latency
+        self.response_chars = response_chars
+        self.calls = 0
+
+    def _answer(self, prompt: str) -> str:
+        self.calls += 1
+        if 'Rank the following categories' in prompt:
+            block = prompt.split('most relevant to least:')[1].split('Do not include')[0]
+            return '\n'.join(line.strip() for line in block.strip().splitlines())
+        if 'Generate attributes' in prompt:
+            return re.search(r'\nAttributes:\n(.+)', prompt).group(1) # first example's
+        words = random.Random(_seed(prompt)).choices(WORDS, k=self.response_chars // 6)
+        return ' '.join(words)[:self.response_chars]
+
+    def predict(self, prompt: str, **params) -> utils.LLMResponse:
+        self.latency.sleep()
+        return utils.LLMResponse(self._answer(prompt))
+
+    async def predict_async(self, prompt: str, **params) -> utils.LLMResponse:
+        await self.latency.sleep_async()
+        return utils.LLMResponse(self._answer(prompt))
+
+    def predict_streaming(self, prompt: str, **params) -> Iterator[utils.LLMResponse]:
+        text, chunks = self._answer(prompt), 8
+        size = max(1, math.ceil(len(text) / chunks))
+        for i in range(0, len(text), size):
+            time.sleep(self.latency.sample() / chunks)
+            yield utils.LLMResponse(text[i:i + size])
+
+
+@contextlib.contextmanager
+def installed(
+    catalog: Optional[Catalog] = None,
+    profile: str = 'zero',
+    scale: float = 1.0,
+    seed: int = 0) -> Iterator[SimpleNamespace]:
+    """Serve all upstream calls from fakes within the block.
+
+    The embedding and LLM caches and the reference snapshot are not faked,
+    they behave as configured in config.py.
+
+    Yields:
+        namespace with the catalog and the embedding, index, bigquery and llm
+        fakes, e.g. to count calls
+    """
+    catalog = catalog or Catalog(seed=seed)
+    latency = latencies(profile, scale, seed)
+    service = FakePredictionService(catalog, latency['embedding'])
+    fakes = SimpleNamespace(
+        catalog=catalog,
+        embedding=service,
+        index=FakeIndex(catalog, latency['vector_search']),
+        bigquery=FakeBigQueryClient(catalog, latency['bigquery']),
+        llm=FakeLLM(latency['llm']))
+    client = embeddings.EmbeddingPredictionClient(
+        'fake', client=service, async_client=service.async_client)
+    utils.get_cached_llm.cache_clear()
+    store = taxonomy.TaxonomyStore() if config.TAXONOMY_ENABLED else None # loaded as by the warmup
+    with mock.patch.object(embeddings, 'get_client', return_value=client), \
+         mock.patch.object(nearest_neighbors, 'get_index', return_value=fakes.index), \
+         mock.patch.object(utils, 'get_bq_client', return_value=fakes.bigquery), \
+         mock.patch.object(utils, 'get_llm', return_value=fakes.llm), \
+         mock.patch.object(taxonomy, 'get_store', return_value=store):
+        if store is not None:
+            store.refresh()
+            fakes.bigquery.queries = 0
+        try:
+            yield fakes
+        finally:
+            utils.get_cached_llm.cache_clear()
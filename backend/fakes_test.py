@@ -0,0 +1,86 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fakes Unit Tests.
+
+These tests run fully offline, and double as offline tests of the whole
+enrichment pipeline.
+"""
+import asyncio
+import statistics
+import unittest
+
+import category
+import embeddings
+import enrich
+import fakes
+
+class LatencyTest(unittest.TestCase):
+
+  def test_percentiles(self):
+    latency = fakes.Latency(100, 400, seed=1)
+    samples = sorted(latency.sample() * 1000 for _ in range(20000))
+    self.assertAlmostEqual(statistics.median(samples), 100, delta=5)
+    self.assertAlmostEqual(samples[int(0.99 * len(samples))], 400, delta=40)
+
+  def test_deterministic(self):
+    a, b = fakes.Latency(100, 400, seed=1), fakes.Latency(100, 400, seed=1)
+    self.assertEqual([a.sample() for _ in range(10)], [b.sample() for _ in range(10)])
+
+  def test_constant_and_zero(self):
+    self.assertEqual(fakes.Latency(50).sample(), 0.05)
+    self.assertEqual(fakes.Latency().sample(), 0.0)
+    self.assertEqual(fakes.Latency(50, 100).scaled(0.1).median_ms, 5)
+
+class PipelineTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.catalog = fakes.Catalog(200)
+
+  def setUp(self):
+    embeddings.get_cache.cache_clear() # other tests may have embedded the same descriptions
+
+  def test_neighbors_share_category(self):
+    id, product = next(iter(self.catalog.products.items()))
+    with fakes.installed(self.catalog) as f:
+      neighbors = f.index.find_neighbors(queries=[self.catalog.embed('query', product['leaf'])], num_neighbors=3)
+    for neighbor in neighbors[0]:
+      self.assertEqual(self.catalog.products[neighbor.id[:-2]]['leaf'], product['leaf'])
+
+  def test_enrich(self):
+    desc = self.catalog.description(1)
+    with fakes.installed(self.catalog) as f:
+      res = asyncio.run(enrich.enrich_async(desc, include_marketing_copy=True))
+      again = asyncio.run(enrich.enrich_async(desc))
+    self.assertEqual(len(res['categories'][0]), 4)
+    self.assertIn('color', res['attributes'])
+    self.assertTrue(res['marketing_copy'])
+    self.assertEqual(again['categories'], res['categories'])
+    self.assertEqual(f.embedding.calls, 1) # second call served from the embedding cache
+    self.assertEqual(f.bigquery.queries, 2)
+
+  def test_sync_path(self):
+    with fakes.installed(self.catalog) as f:
+      res = category.retrieve_and_rank(self.catalog.description(2))
+    self.assertTrue(res)
+    self.assertEqual(f.llm.calls, 1)
+
+  def test_latency_profile(self):
+    with fakes.installed(self.catalog, profile='vertex', scale=0.05):
+      res = asyncio.run(enrich.enrich_async(self.catalog.description(3)))
+    self.assertGreater(res['timings_ms']['llm'], 10)
+
+if __name__ == '__main__':
+  unittest.main()
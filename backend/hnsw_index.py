@@ -0,0 +1,294 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Approximate nearest neighbor search with a Hierarchical Navigable Small
+World (HNSW) graph.
+
+Local counterpart of the tree-AH index created in 2_create_vector_db.ipynb.
+ef_search plays the role of approximate_neighbors_count and
+leaf_nodes_to_search_percent: it bounds how many candidates are explored per
+query, trading recall for latency.
+
+The graph is built and searched by hnswlib, listed in requirements.txt.
+Other backends don't need it, so it is imported only if installed.
+
+Category restricts are applied during graph traversal: every node is used for
+navigation but only nodes matching the filter are admitted to the result set.
+When a filter is so selective that the graph would have to be walked almost
+entirely, the (small) set of matching datapoints is scanned exactly instead,
+see config.HNSW_EXACT_SEARCH_THRESHOLD.
+
+Build an index offline from the data_prep_with_restricts JSONL, and compare
+its recall and latency to exact search with:
+
+    python hnsw_index.py build sample.json hnsw_index/
+    python hnsw_index.py benchmark hnsw_index/
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import numpy as np
+from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import MatchNeighbor, Namespace
+
+import config
+import local_index
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+class HNSWIndex:
+    """HNSW graph over a local_index.Datapoints matrix.
+
+    Exposes the same find_neighbors() signature as
+    aiplatform.MatchingEngineIndexEndpoint so it can be swapped in by
+    nearest_neighbors.get_index(). Graph node labels are datapoint rows.
+
+    Args:
+        datapoints: datapoints to index. Embeddings must be L2 normalized
+        m: max number of links per node on upper layers, 2*m on layer 0
+        ef_construction: candidate list size while inserting
+        ef_search: default candidate list size while querying
+        seed: seed for level assignment
+    """
+    def __init__(
+        self,
+        datapoints: local_index.Datapoints,
+        m: int = config.HNSW_M,
+        ef_construction: int = config.HNSW_EF_CONSTRUCTION,
+        ef_search: int = config.HNSW_EF_SEARCH,
+        seed: int = 0):
+        if hnswlib is None:
+            raise ImportError('The hnsw backend needs hnswlib, pip install hnswlib')
+        self.datapoints = datapoints
+        self.m = m
+        self.ef_construction = ef_construction
+        self.graph = hnswlib.Index(space='ip', dim=datapoints.embeddings.shape[1])
+        self.graph.init_index(
+            max_elements=max(len(datapoints), 1), M=m, ef_construction=ef_construction, random_seed=seed)
+        self.ef_search = ef_search
+
+    @property
+    def ef_search(self) -> int:
+        return self.graph.ef
+
+    @ef_search.setter
+    def ef_search(self, ef: int):
+        self.graph.set_ef(ef) # hnswlib searches with max(ef, num_neighbors)
+
+    @property
+    def _embeddings(self) -> np.ndarray:
+        return self.datapoints.embeddings
+
+    @classmethod
+    def build(cls, datapoints: local_index.Datapoints, **kwargs) -> 'HNSWIndex':
+        """Create an index and insert all datapoints."""
+        index = cls(datapoints, **kwargs)
+        if len(datapoints):
+            start = time.perf_counter()
+            index.graph.add_items(index._embeddings, np.arange(len(datapoints)))
+            logging.info(f'Inserted {len(datapoints)} datapoints in {time.perf_counter() - start:.1f}s')
+        return index
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        mask: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+        """Approximate top k of normalized queries.
+
+        Returns:
+            rows and cosine distances, both of shape (num_queries, k), closest
+            first
+
+        Raises:
+            RuntimeError: if fewer than k datapoints admitted by mask were
+                reached
+        """
+        if mask is None:
+            return self.graph.knn_query(queries, k=k)
+        # The filter calls back into Python for every node, which holds the
+        # GIL, so extra threads would only contend for it
+        return self.graph.knn_query(queries, k=k, num_threads=1, filter=lambda row: bool(mask[row]))
+
+    def find_neighbors(
+        self,
+        *,
+        queries: list[list[float]],
+        num_neighbors: int = 10,
+        filter: Optional[list[Namespace]] = [],
+        deployed_index_id: Optional[str] = None) -> list[list[MatchNeighbor]]:
+        """Find approximate nearest neighbors by cosine distance.
+
+        Args:
+            queries: list of query embeddings
+            num_neighbors: number of neighbors to return for EACH query
+            filter: list of Namespace restricts, ANDed together
+            deployed_index_id: ignored, accepted for API compatibility
+
+        Returns:
+            One list of MatchNeighbor per query, closest first. Distance is
+            the cosine distance i.e. 1 - cosine similarity
+        """
+        if not queries:
+            return []
+        queries = local_index.normalize(np.asarray(queries, dtype=np.float32))
+        mask = self.datapoints.filter_mask(filter)
+        rows = np.flatnonzero(mask) if mask is not None else np.arange(len(self.datapoints))
+        # Graph traversal only pays off when matches are not too sparse: the
+        # sparser they are, the more nodes the filter callback visits
+        if mask is not None and len(rows) <= max(config.HNSW_EXACT_SEARCH_THRESHOLD, num_neighbors):
+            return self._exact_search(queries, num_neighbors, rows)
+        k = min(num_neighbors, len(rows))
+        if not k:
+            return [[] for _ in queries]
+        try:
+            labels, distances = self.search(queries, k, mask)
+        except RuntimeError: # graph walk reached fewer than k matches
+            return self._exact_search(queries, num_neighbors, rows)
+        ids = self.datapoints.ids
+        return [
+            [MatchNeighbor(ids[n], float(d)) for n, d in zip(row_labels.tolist(), row_distances.tolist())]
+            for row_labels, row_distances in zip(labels, distances)
+        ]
+
+    def _exact_search(
+        self,
+        queries: np.ndarray,
+        num_neighbors: int,
+        rows: np.ndarray) -> list[list[MatchNeighbor]]:
+        if not len(rows):
+            return [[] for _ in queries]
+        idx, sims = local_index.top_k(queries @ self._embeddings[rows].T, num_neighbors)
+        ids = self.datapoints.ids
+        return [
+            [MatchNeighbor(ids[rows[i]], float(1.0 - s)) for i, s in zip(row_idx, row_sims)]
+            for row_idx, row_sims in zip(idx, sims)
+        ]
+
+    def save(self, path: str):
+        """Write the index to a directory.
+
+        Datapoints are written alongside the graph so an index directory can
+        also be loaded by local_index.ExactIndex.
+        """
+        self.datapoints.save(path)
+        self.graph.save_index(os.path.join(path, 'hnsw.bin'))
+        with open(os.path.join(path, 'hnsw.json'), 'w') as f:
+            json.dump({'m': self.m, 'ef_construction': self.ef_construction, 'ef_search': self.ef_search}, f)
+
+    @classmethod
+    def load(cls, path: str, ef_search: Optional[int] = None) -> 'HNSWIndex':
+        """Load an index written by save().
+
+        Vectors are memory-mapped for exact search of selective filters, the
+        graph is read into memory.
+        """
+        with open(os.path.join(path, 'hnsw.json')) as f:
+            meta = json.load(f)
+        index = cls(
+            local_index.Datapoints.load(path),
+            m=meta['m'],
+            ef_construction=meta['ef_construction'])
+        index.graph.load_index(os.path.join(path, 'hnsw.bin'), max_elements=max(len(index.datapoints), 1))
+        index.ef_search = ef_search or meta['ef_search']
+        return index
+
+
+def benchmark(
+    datapoints: local_index.Datapoints,
+    num_queries: int = 200,
+    num_neighbors: int = config.NUM_NEIGHBORS,
+    ef_searches: tuple[int, ...] = (50, 100, config.HNSW_EF_SEARCH),
+    index: Optional[HNSWIndex] = None,
+    seed: int = 0) -> list[dict]:
+    """Recall and latency of HNSW search relative to exact search.
+
+    Queries are datapoints with a little noise added, so each has close but
+    not identical neighbors, and are sent one at a time like API requests.
+
+    Args:
+        datapoints: datapoints to index
+        num_queries: number of queries to run
+        num_neighbors: neighbors per query, recall is measured at this k
+        ef_searches: ef_search settings to measure
+        index: index over datapoints, built if not given
+        seed: seed for the queries
+
+    Returns:
+        one dict per setting (exact search first, with ef_search None) with
+        recall, ms_per_query and speedup over exact search
+    """
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(datapoints.embeddings[rng.choice(len(datapoints), num_queries)])
+    queries = (sample + rng.normal(scale=0.01, size=sample.shape)).tolist()
+
+    def run(index):
+        start = time.perf_counter()
+        res = [index.find_neighbors(queries=[q], num_neighbors=num_neighbors)[0] for q in queries]
+        return res, (time.perf_counter() - start) * 1000 / num_queries
+
+    exact, exact_ms = run(local_index.ExactIndex(datapoints))
+    report = [{'ef_search': None, 'recall': 1.0, 'ms_per_query': exact_ms, 'speedup': 1.0}]
+    index = index or HNSWIndex.build(datapoints)
+    for ef in ef_searches:
+        index.ef_search = ef
+        res, ms = run(index)
+        recall = np.mean([len({n.id for n in r} & {n.id for n in e}) / max(len(e), 1) for r, e in zip(res, exact)])
+        report.append({'ef_search': ef, 'recall': float(recall), 'ms_per_query': ms, 'speedup': exact_ms / ms})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or benchmark an HNSW index.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='build an index from JSONL datapoints')
+    build.add_argument('input', help='JSONL file of id, embedding and category restricts')
+    build.add_argument('output', help='directory to write the index to')
+    build.add_argument('--m', type=int, default=config.HNSW_M)
+    build.add_argument('--ef_construction', type=int, default=config.HNSW_EF_CONSTRUCTION)
+    build.add_argument('--ef_search', type=int, default=config.HNSW_EF_SEARCH)
+    bench = subparsers.add_parser('benchmark', help='report recall and latency against exact search')
+    bench.add_argument('input', help='index directory written by build')
+    bench.add_argument('--queries', type=int, default=200)
+    bench.add_argument('--num_neighbors', type=int, default=config.NUM_NEIGHBORS)
+    bench.add_argument('--ef_search', type=int, nargs='+', default=[50, 100, config.HNSW_EF_SEARCH])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'build':
+        index = HNSWIndex.build(
+            local_index.Datapoints.from_jsonl(args.input),
+            m=args.m,
+            ef_construction=args.ef_construction,
+            ef_search=args.ef_search)
+        index.save(args.output)
+        logging.info(f'Wrote index to {args.output}')
+    else:
+        index = HNSWIndex.load(args.input)
+        report = benchmark(index.datapoints, args.queries, args.num_neighbors, args.ef_search, index)
+        print(f"{'ef_search':>9} {'recall':>7} {'ms/query':>9} {'speedup':>8}")
+        for r in report:
+            ef = 'exact' if r['ef_search'] is None else r['ef_search']
+            print(f"{ef:>9} {r['recall']:>7.3f} {r['ms_per_query']:>9.2f} {r['speedup']:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
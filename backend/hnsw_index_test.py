@@ -0,0 +1,93 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""HNSW Index Unit Tests.
+
+These tests run fully offline against a small synthetic index and compare
+results to the exact local index.
+"""
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace
+
+import config
+import hnsw_index
+import local_index
+
+def recall(approx, exact):
+  hits = [len({n.id for n in a} & {n.id for n in e}) / len(e) for a, e in zip(approx, exact)]
+  return sum(hits) / len(hits)
+
+@unittest.skipIf(hnsw_index.hnswlib is None, 'hnswlib is not installed')
+class HNSWIndexTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(500, 32))
+    records = [
+      {'id': f'{i}_T', 'embedding': v.tolist(), 'L0': 'A' if i % 4 else 'B'}
+      for i, v in enumerate(vectors)]
+    cls.datapoints = local_index.Datapoints.from_records(records)
+    cls.index = hnsw_index.HNSWIndex.build(cls.datapoints, m=8, ef_construction=64, ef_search=64)
+    cls.exact = local_index.ExactIndex(cls.datapoints)
+    cls.queries = rng.normal(size=(20, 32)).tolist()
+
+  def test_recall_no_filter(self):
+    res = self.index.find_neighbors(queries=self.queries, num_neighbors=5)
+    self.assertEqual(len(res), len(self.queries))
+    self.assertEqual(len(res[0]), 5)
+    self.assertGreaterEqual(recall(res, self.exact.find_neighbors(queries=self.queries, num_neighbors=5)), 0.9)
+
+  def test_filtered_graph_search(self):
+    filters = [Namespace('L0', ['B'])]
+    with mock.patch.object(config, 'HNSW_EXACT_SEARCH_THRESHOLD', 0):
+      res = self.index.find_neighbors(queries=self.queries, num_neighbors=5, filter=filters)
+    for neighbors in res:
+      self.assertEqual(len(neighbors), 5)
+      self.assertTrue(all(int(n.id[:-2]) % 4 == 0 for n in neighbors))
+    exact = self.exact.find_neighbors(queries=self.queries, num_neighbors=5, filter=filters)
+    self.assertGreaterEqual(recall(res, exact), 0.9)
+
+  def test_filtered_exact_search(self):
+    filters = [Namespace('L0', ['B'])]
+    res = self.index.find_neighbors(queries=self.queries, num_neighbors=5, filter=filters)
+    exact = self.exact.find_neighbors(queries=self.queries, num_neighbors=5, filter=filters)
+    self.assertEqual(recall(res, exact), 1.0)
+
+  def test_save_and_load(self):
+    with tempfile.TemporaryDirectory() as d:
+      self.index.save(d)
+      loaded = hnsw_index.HNSWIndex.load(d)
+      res = loaded.find_neighbors(queries=self.queries, num_neighbors=5)
+    expected = self.index.find_neighbors(queries=self.queries, num_neighbors=5)
+    self.assertEqual([[n.id for n in r] for r in res], [[n.id for n in r] for r in expected])
+
+  def test_distances_match_exact(self):
+    res = self.index.find_neighbors(queries=self.queries[:1], num_neighbors=3)[0]
+    exact = {n.id: n.distance for n in self.exact.find_neighbors(queries=self.queries[:1], num_neighbors=3)[0]}
+    for n in res:
+      self.assertAlmostEqual(n.distance, exact[n.id], places=5)
+
+  def test_benchmark(self):
+    report = hnsw_index.benchmark(self.datapoints, num_queries=20, num_neighbors=5, ef_searches=(64,), index=self.index)
+    self.assertEqual([r['ef_search'] for r in report], [None, 64])
+    self.assertGreaterEqual(report[1]['recall'], 0.9)
+    self.assertGreater(report[1]['ms_per_query'], 0)
+
+if __name__ == '__main__':
+  unittest.main()
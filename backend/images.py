@@ -0,0 +1,163 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Image normalization before embedding.
+
+The multimodal embedding model works at 512x512 pixels, so larger images
+only cost upload bytes and latency. normalize() decodes an image, applies
+its EXIF orientation, downsizes it to config.IMAGE_MAX_SIDE and re-encodes it
+as JPEG. Phone photos of several megabytes typically shrink 10-50x.
+
+It also computes a perceptual hash that is unchanged by resizing,
+recompression and small edits: a difference hash (dHash) of the grayscale
+image, which captures its structure, plus a coarse color signature, since
+color variants of a product photo share their structure. Keying the
+embedding cache on it, so near-identical images reuse one embedding, is
+opt-in (config.IMAGE_PERCEPTUAL_CACHE_KEY): distinct products shot alike,
+e.g. differing only in a small print or logo, can share a hash and would be
+given each other's embedding. By default only identical images do, before or
+after normalization.
+
+Report bytes saved and the embedding latency delta on sample images:
+
+    python images.py photo1.jpg photo2.png --embed
+"""
+import argparse
+import base64
+import io
+import logging
+import time
+from typing import NamedTuple
+
+from PIL import Image, ImageOps
+from prometheus_client import Counter, Histogram
+
+import config
+import metrics
+
+HASH_SIZE = 8 # dHash of HASH_SIZE**2 bits
+COLOR_GRID = 4 # color signature of the mean color of COLOR_GRID**2 cells,
+COLOR_BITS = 3 # quantized to COLOR_BITS per channel
+
+IMAGE_BYTES = Histogram(
+    'catalog_image_bytes', 'Size of images before and after normalization', ('kind',),
+    buckets=metrics.BYTES_BUCKETS)
+IMAGE_BYTES_SAVED = Counter(
+    'catalog_image_bytes_saved', 'Bytes removed from images by normalization')
+
+
+class NormalizedImage(NamedTuple):
+    data: bytes # JPEG, or the original bytes if re-encoding didn't make them smaller
+    dhash: str # hex difference hash of the grayscale image
+    colors: str # hex color signature, see color_signature()
+    original_size: int # bytes
+    size: int # bytes
+    seconds: float # time taken to normalize
+
+    @property
+    def phash(self) -> str:
+        """Perceptual hash: structure and colors."""
+        return f'{self.dhash}-{self.colors}'
+
+
+def dhash(image: Image.Image, size: int = HASH_SIZE) -> str:
+    """Difference hash: whether each pixel of a small grayscale copy is
+    brighter than its right neighbor."""
+    pixels = image.convert('L').resize((size + 1, size), Image.Resampling.BILINEAR).tobytes()
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            i = row * (size + 1) + col
+            bits = bits << 1 | (pixels[i] > pixels[i + 1])
+    return f'{bits:0{size * size // 4}x}'
+
+
+def color_signature(image: Image.Image, grid: int = COLOR_GRID, bits: int = COLOR_BITS) -> str:
+    """Mean color of each cell of a grid over the image, coarsely quantized.
+
+    Tells apart color variants of a photo, which dhash() does not see.
+    """
+    pixels = image.convert('RGB').resize((grid, grid), Image.Resampling.BOX).tobytes()
+    return ''.join(f'{value >> (8 - bits):x}' for value in pixels)
+
+
+def _to_rgb(image: Image.Image) -> Image.Image:
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def normalize(
+    data: bytes,
+    max_side: int = config.IMAGE_MAX_SIDE,
+    quality: int = config.IMAGE_JPEG_QUALITY) -> NormalizedImage:
+    """Downsize and re-encode an image, and compute its perceptual hash.
+
+    Args:
+        data: encoded image, any format Pillow reads
+        max_side: max width and height in pixels, the aspect ratio is kept
+        quality: JPEG quality
+
+    Raises:
+        PIL.UnidentifiedImageError if data is not an image
+    """
+    start = time.perf_counter()
+    image = Image.open(io.BytesIO(data))
+    image.draft('RGB', (max_side, max_side)) # JPEGs are decoded at reduced scale
+    image = _to_rgb(ImageOps.exif_transpose(image))
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    hashes = dhash(image), color_signature(image)
+    out = io.BytesIO()
+    image.save(out, format='JPEG', quality=quality, optimize=True)
+    normalized = out.getvalue() if out.tell() < len(data) else data
+    result = NormalizedImage(normalized, *hashes, len(data), len(normalized), time.perf_counter() - start)
+    IMAGE_BYTES.labels('original').observe(result.original_size)
+    IMAGE_BYTES.labels('normalized').observe(result.size)
+    IMAGE_BYTES_SAVED.inc(result.original_size - result.size)
+    metrics.STAGE_SECONDS.labels('image_normalization').observe(result.seconds)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report bytes saved and embedding latency delta of normalization.')
+    parser.add_argument('paths', nargs='+', help='image files')
+    parser.add_argument('--embed', action='store_true', help='also time embedding the original and normalized image')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.embed:
+        import embeddings # needs GCP credentials
+        client = embeddings.get_client(config.PROJECT)
+
+    def embed_ms(data: bytes) -> float:
+        start = time.perf_counter()
+        client.get_embedding(image=base64.b64encode(data).decode(), base64=True)
+        return (time.perf_counter() - start) * 1000
+
+    for path in args.paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        result = normalize(data)
+        line = (f'{path}: {result.original_size} -> {result.size} bytes '
+                f'({1 - result.size / result.original_size:.0%} saved) in {result.seconds * 1000:.1f}ms, phash {result.phash}')
+        if args.embed:
+            original_ms, normalized_ms = embed_ms(data), embed_ms(result.data)
+            line += f', embedding {original_ms:.0f}ms -> {normalized_ms:.0f}ms'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Image Normalization Unit Tests.
+
+These tests run fully offline, images are generated with Pillow.
+"""
+import asyncio
+import base64
+import io
+import unittest
+from unittest import mock
+
+import httpx
+from PIL import Image, ImageDraw, UnidentifiedImageError
+
+import api
+import caching
+import config
+import embeddings
+import images
+
+def _photo(width: int, height: int, fmt: str = 'PNG', color: tuple = (200, 30, 30), **kwargs) -> bytes:
+  """Gradients, a shape and sensor noise, so it compresses like a photo."""
+  image = Image.radial_gradient('L').resize((width, height))
+  image = Image.merge('RGB', (image, image.rotate(90), image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+  image.paste(color, (width // 4, height // 4, width // 2, height // 2))
+  noise = Image.effect_noise((width, height), 20).convert('RGB')
+  image = Image.blend(image, noise, 0.2)
+  if fmt == 'PNG':
+    kwargs.setdefault('compress_level', 1)
+  out = io.BytesIO()
+  image.save(out, format=fmt, **kwargs)
+  return out.getvalue()
+
+def _product(color: tuple) -> bytes:
+  """A product shot: a shirt of the given color on a white background."""
+  image = Image.new('RGB', (800, 800), (255, 255, 255))
+  draw = ImageDraw.Draw(image)
+  draw.polygon([(250, 200), (550, 200), (650, 320), (560, 380), (560, 650), (240, 650), (240, 380), (150, 320)], fill=color)
+  out = io.BytesIO()
+  image.save(out, format='JPEG', quality=90)
+  return out.getvalue()
+
+class NormalizeTest(unittest.TestCase):
+
+  def test_downsizes_large_image(self):
+    data = _photo(2000, 1500)
+    res = images.normalize(data, max_side=512)
+    with Image.open(io.BytesIO(res.data)) as image:
+      self.assertEqual(image.format, 'JPEG')
+      self.assertEqual(image.size, (512, 384))
+    self.assertLess(res.size, res.original_size / 10)
+
+  def test_keeps_original_if_not_smaller(self):
+    data = _photo(1, 1)
+    res = images.normalize(data)
+    self.assertEqual(res.data, data)
+
+  def test_phash_stable_across_resize_and_recompression(self):
+    a = images.normalize(_photo(2000, 1500))
+    b = images.normalize(_photo(1000, 750, 'JPEG', quality=70))
+    self.assertEqual(a.phash, b.phash)
+    self.assertEqual(len(a.dhash), 16)
+
+  def test_dhash_differs_for_different_images(self):
+    flipped = io.BytesIO()
+    Image.open(io.BytesIO(_photo(600, 600))).transpose(Image.Transpose.FLIP_LEFT_RIGHT).save(flipped, format='PNG')
+    self.assertNotEqual(images.normalize(_photo(600, 600)).dhash, images.normalize(flipped.getvalue()).dhash)
+
+  def test_phash_differs_for_color_variants(self):
+    variants = [_product(color) for color in ((200, 30, 30), (30, 30, 200), (30, 160, 30), (20, 20, 20))]
+    hashes = [images.normalize(v) for v in variants]
+    self.assertEqual(hashes[0].dhash, hashes[1].dhash) # grayscale structure alone can't tell them apart
+    self.assertEqual(len({h.phash for h in hashes}), len(variants))
+
+  def test_alpha_composited_on_white(self):
+    image = Image.new('RGBA', (600, 600), (0, 0, 0, 0))
+    out = io.BytesIO()
+    image.save(out, format='PNG')
+    res = images.normalize(out.getvalue(), max_side=64)
+    with Image.open(io.BytesIO(res.data)) as normalized:
+      self.assertEqual(normalized.mode, 'RGB')
+      self.assertGreater(min(normalized.getpixel((0, 0))), 250)
+
+  def test_not_an_image(self):
+    with self.assertRaises(UnidentifiedImageError):
+      images.normalize(b'not an image')
+
+class EmbedNormalizationTest(unittest.TestCase):
+  """embed() sends normalized images and caches them by content or perceptual hash."""
+
+  def setUp(self):
+    self.client = mock.Mock()
+    self.client.get_embedding.side_effect = lambda text=None, image=None, base64=False: \
+      embeddings.EmbeddingResponse(
+        text_embedding=[1.0] * 1408 if text else None,
+        image_embedding=[2.0] * 1408 if image else None)
+    mock.patch.object(embeddings, 'get_client', return_value=self.client).start()
+    mock.patch.object(embeddings, 'get_cache', return_value=caching.tiered_cache(1024**2)).start()
+    self.addCleanup(mock.patch.stopall)
+
+  def test_sends_normalized_image(self):
+    data = _photo(2000, 1500)
+    embeddings.embed('desc', base64.b64encode(data).decode(), base64=True)
+    sent = self.client.get_embedding.call_args.kwargs['image']
+    self.assertIsInstance(sent, bytes) # base64 encoded once, in the request to the API
+    self.assertLess(len(sent), len(data) / 10)
+
+  def test_near_identical_images_hit_cache(self):
+    with mock.patch.object(config, 'IMAGE_PERCEPTUAL_CACHE_KEY', True):
+      embeddings.embed('desc', base64.b64encode(_photo(2000, 1500)).decode(), base64=True)
+      embeddings.embed('desc', base64.b64encode(_photo(1000, 750, 'JPEG', quality=70)).decode(), base64=True)
+    self.assertEqual(self.client.get_embedding.call_count, 1)
+
+  def test_color_variants_do_not_share_embedding(self):
+    for perceptual in (False, True):
+      with mock.patch.object(config, 'IMAGE_PERCEPTUAL_CACHE_KEY', perceptual), \
+           mock.patch.object(embeddings, 'get_cache', return_value=caching.tiered_cache(1024**2)):
+        for color in ((200, 30, 30), (30, 30, 200), (20, 20, 20)):
+          embeddings.embed('desc', _product(color))
+    self.assertEqual(self.client.get_embedding.call_count, 6)
+
+  def test_repeated_image_not_normalized(self):
+    image = base64.b64encode(_photo(2000, 1500)).decode()
+    with mock.patch.object(images, 'normalize', wraps=images.normalize) as normalize:
+      embeddings.embed('desc', image, base64=True)
+      embeddings.embed('other desc', image, base64=True)
+      asyncio.run(embeddings.embed_async('desc', image, base64=True))
+    self.assertEqual(normalize.call_count, 1)
+    self.assertEqual(self.client.get_embedding.call_count, 2) # the second text only
+
+  def test_raw_bytes(self):
+    data = _photo(2000, 1500)
+    embeddings.embed('desc', data)
+    embeddings.embed('desc', base64.b64encode(data).decode(), base64=True)
+    self.assertEqual(self.client.get_embedding.call_count, 1)
+    self.assertLess(len(self.client.get_embedding.call_args.kwargs['image']), len(data) / 10)
+
+  def test_small_image_sent_as_is(self):
+    image = base64.b64encode(_photo(1, 1)).decode()
+    embeddings.embed('desc', image, base64=True)
+    self.client.get_embedding.assert_called_with(text='desc', image=image, base64=True)
+
+  def test_undecodable_image_sent_as_is(self):
+    image = base64.b64encode(b'not an image').decode()
+    embeddings.embed('desc', image, base64=True)
+    self.client.get_embedding.assert_called_with(text='desc', image=image, base64=True)
+
+  def test_gcs_uri_not_normalized(self):
+    embeddings.embed('desc', 'gs://bucket/image.jpg')
+    self.client.get_embedding.assert_called_with(text='desc', image='gs://bucket/image.jpg', base64=False)
+
+class UploadTest(unittest.TestCase):
+
+  def test_chunked_upload_over_limit(self):
+    sent = []
+    async def body():
+      for _ in range(10):
+        sent.append(1024)
+        yield b'x' * 1024
+    async def run():
+      async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url='http://test') as client:
+        return await client.post('/v1/categories:upload', params={'description': 'd'}, content=body(),
+                                 headers={'Content-Type': 'application/octet-stream'})
+    with mock.patch.object(config, 'UPLOAD_MAX_BYTES', 3000):
+      res = asyncio.run(run())
+    self.assertEqual(res.status_code, 413)
+    self.assertLess(len(sent), 10) # the rest of the body was never read
+
+if __name__ == '__main__':
+  unittest.main()
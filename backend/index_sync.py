@@ -0,0 +1,283 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incrementally sync the vector index with the product reference table.
+
+Each product is hashed in BigQuery from its config.COLUMN_EMBEDDING_HASH
+(maintained by embedding_backfill.py) and its category columns. Hashes are
+compared with those recorded at the last sync in config.SYNC_STATE_PATH to
+find added, changed and deleted products. Only the rows of added and changed
+products are read, and their `<id>_T` and `<id>_I` datapoints, with L0-L3
+restricts as in data_prep_with_restricts.ipynb, are pushed in batched
+upsert and remove calls.
+
+Products without an embedding hash have not been embedded yet and are
+skipped until they are.
+
+Run once, or continuously so catalog changes are searchable within
+config.SYNC_INTERVAL_SECONDS:
+
+    python index_sync.py --interval 60
+
+With config.VECTOR_SEARCH_BACKEND = 'exact' the local index is updated
+instead, which makes the sync testable without a deployed index. Updates go
+through the index searches are served from, and are saved to
+config.LOCAL_INDEX_PATH after every chunk so servers running in other
+processes reload them within config.LOCAL_INDEX_RELOAD_SECONDS.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Iterable, Optional
+
+from google.cloud import aiplatform_v1, bigquery
+
+import config
+import local_index
+import nearest_neighbors
+import utils
+
+FETCH_SIZE = 10000 # product IDs per query for rows of changed products
+
+
+def sync_hash_sql() -> str:
+    """BigQuery expression hashing everything that ends up in the index."""
+    columns = [config.COLUMN_EMBEDDING_HASH] + config.COLUMN_CATEGORIES[:len(config.FILTER_CATEGORIES)]
+    fields = ', '.join(f"IFNULL({c}, '')" for c in columns)
+    return f"TO_HEX(SHA256(ARRAY_TO_STRING([{fields}], '\\n')))"
+
+
+def hashes_query(table: str = config.PRODUCT_REFERENCE_TABLE) -> str:
+    return f"""
+    SELECT
+        {config.COLUMN_ID},
+        {sync_hash_sql()} AS sync_hash
+    FROM
+        `{table}`
+    WHERE
+        {config.COLUMN_EMBEDDING_HASH} IS NOT NULL
+    """
+
+
+def rows_query(table: str = config.PRODUCT_REFERENCE_TABLE) -> str:
+    """Query rows to index for the IDs in the @ids array parameter."""
+    return f"""
+    SELECT
+        {config.COLUMN_ID},
+        {config.COLUMN_TEXT_EMBEDDING},
+        {config.COLUMN_IMAGE_EMBEDDING},
+        {','.join(config.COLUMN_CATEGORIES[:len(config.FILTER_CATEGORIES)])},
+        {sync_hash_sql()} AS sync_hash
+    FROM
+        `{table}`
+    WHERE
+        {config.COLUMN_ID} IN UNNEST(@ids)
+    """
+
+
+def restricts(row) -> list[dict]:
+    """Category restricts of a row, down to its first null level."""
+    res = []
+    for namespace, col in zip(config.FILTER_CATEGORIES, config.COLUMN_CATEGORIES):
+        if not row[col]:
+            break
+        res.append({'namespace': namespace, 'allow': [row[col]]})
+    return res
+
+
+def datapoints(row) -> list[dict]:
+    """Text and, if available, image datapoints of a row in JSONL record format."""
+    id, res = row[config.COLUMN_ID], []
+    for suffix, col in (('_T', config.COLUMN_TEXT_EMBEDDING), ('_I', config.COLUMN_IMAGE_EMBEDDING)):
+        if row[col]:
+            res.append({'id': id + suffix, 'embedding': list(row[col]), 'restricts': restricts(row)})
+    return res
+
+
+class VertexIndexWriter:
+    """Pushes datapoints to a Vertex Vector Search STREAM_UPDATE index."""
+    def __init__(
+        self,
+        index_id: str = config.INDEX_ID,
+        project: str = config.PROJECT,
+        location: str = config.LOCATION):
+        self.index = f'projects/{project}/locations/{location}/indexes/{index_id}'
+        self.client = aiplatform_v1.IndexServiceClient(
+            client_options={'api_endpoint': f'{location}-aiplatform.googleapis.com'})
+
+    def upsert_datapoints(self, datapoints: list[dict]):
+        self.client.upsert_datapoints(aiplatform_v1.UpsertDatapointsRequest(
+            index=self.index,
+            datapoints=[aiplatform_v1.IndexDatapoint(
+                datapoint_id=d['id'],
+                feature_vector=d['embedding'],
+                restricts=[aiplatform_v1.IndexDatapoint.Restriction(
+                    namespace=r['namespace'], allow_list=r['allow']) for r in d['restricts']])
+                for d in datapoints]))
+
+    def remove_datapoints(self, datapoint_ids: list[str]):
+        self.client.remove_datapoints(aiplatform_v1.RemoveDatapointsRequest(
+            index=self.index, datapoint_ids=datapoint_ids))
+
+    def flush(self):
+        pass # streaming updates are applied by Vertex as they are made
+
+
+class LocalIndexWriter:
+    """Updates a local_index.ExactIndex and saves it for other processes."""
+    def __init__(self, index: local_index.ExactIndex, path: str = config.LOCAL_INDEX_PATH):
+        if os.path.isfile(path):
+            raise ValueError(
+                f'{path} is a JSONL file, index_sync.py needs a directory, convert it with '
+                'local_index.Datapoints.from_jsonl(path).save(directory)')
+        self.index = index
+        self.path = path
+
+    def upsert_datapoints(self, datapoints: list[dict]):
+        self.index.upsert_datapoints(datapoints)
+
+    def remove_datapoints(self, datapoint_ids: list[str]):
+        self.index.remove_datapoints(datapoint_ids)
+
+    def flush(self):
+        self.index.save(self.path)
+
+
+def get_writer(backend: str = config.VECTOR_SEARCH_BACKEND):
+    """Index to sync, with upsert_datapoints(), remove_datapoints() and flush() methods."""
+    if backend == 'vertex':
+        return VertexIndexWriter()
+    if backend == 'exact':
+        index = nearest_neighbors.get_index()
+        if not isinstance(index, local_index.ExactIndex):
+            raise ValueError(f'Searches are served from {config.VECTOR_SEARCH_BACKEND}, not the exact backend')
+        return LocalIndexWriter(index, config.LOCAL_INDEX_PATH) # same instance searches are served from
+    raise ValueError(f'Backend {backend} does not support incremental updates, rebuild the index instead')
+
+
+class SyncState:
+    """Hash of each product in the index as of the last sync, persisted as JSON."""
+    def __init__(self, path: Optional[str] = config.SYNC_STATE_PATH):
+        self.path = path
+        self.hashes = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.hashes = json.load(f)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.hashes, f)
+        os.replace(tmp_path, self.path)
+
+
+def _batches(items: list, size: int) -> Iterable[list]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def sync(
+    writer=None,
+    state: Optional[SyncState] = None,
+    table: str = config.PRODUCT_REFERENCE_TABLE,
+    batch_size: int = config.SYNC_BATCH_SIZE) -> dict:
+    """Push products added, changed or deleted since the last sync.
+
+    The state is saved after every chunk of products, so an interrupted sync
+    resumes without repeating completed work.
+
+    Args:
+        writer: index to update, see get_writer()
+        state: hashes as of the last sync
+        table: reference table
+        batch_size: max datapoints per upsert or remove call
+
+    Returns:
+        dict with the number of products added or changed and deleted, the
+        number of upsert and remove calls, and the duration in seconds
+    """
+    writer = writer or get_writer()
+    state = state or SyncState()
+    client = utils.get_bq_client()
+    start = time.perf_counter()
+
+    current = {row[config.COLUMN_ID]: row['sync_hash'] for row in client.query(hashes_query(table)).result()}
+    changed = [id for id, h in current.items() if state.hashes.get(id) != h]
+    deleted = [id for id in state.hashes if id not in current]
+    stats = {'changed': len(changed), 'deleted': len(deleted), 'upsert_calls': 0, 'remove_calls': 0}
+    logging.info(f'{len(changed)} products added or changed, {len(deleted)} deleted')
+
+    for ids in _batches(changed, FETCH_SIZE):
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter('ids', 'STRING', ids)])
+        rows = list(client.query(rows_query(table), job_config=job_config).result())
+        records, stale = [], []
+        for row in rows:
+            records += datapoints(row)
+            if not row[config.COLUMN_IMAGE_EMBEDDING]:
+                stale.append(row[config.COLUMN_ID] + '_I') # in case the image was removed
+        for batch in _batches(records, batch_size):
+            writer.upsert_datapoints(batch)
+            stats['upsert_calls'] += 1
+        for batch in _batches(stale, batch_size):
+            writer.remove_datapoints(batch)
+            stats['remove_calls'] += 1
+        writer.flush() # before the state, so a failed save is retried by the next sync
+        state.hashes.update({row[config.COLUMN_ID]: row['sync_hash'] for row in rows})
+        state.save()
+
+    for ids in _batches(deleted, max(1, batch_size // 2)):
+        writer.remove_datapoints([id + suffix for id in ids for suffix in ('_T', '_I')])
+        stats['remove_calls'] += 1
+        writer.flush()
+        for id in ids:
+            del state.hashes[id]
+        state.save()
+
+    stats['seconds'] = time.perf_counter() - start
+    logging.info(f'Index sync done: {stats}')
+    return stats
+
+
+def run(interval: float = config.SYNC_INTERVAL_SECONDS, **kwargs):
+    """Sync every interval seconds until interrupted."""
+    writer, state = get_writer(), SyncState()
+    while True:
+        start = time.monotonic()
+        try:
+            sync(writer, state, **kwargs)
+        except Exception as e:
+            logging.error(f'Index sync failed: {e}')
+        time.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync the vector index with the reference table.')
+    parser.add_argument('--table', default=config.PRODUCT_REFERENCE_TABLE)
+    parser.add_argument('--batch_size', type=int, default=config.SYNC_BATCH_SIZE)
+    parser.add_argument('--interval', type=float, help='keep syncing every INTERVAL seconds')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.interval:
+        run(args.interval, table=args.table, batch_size=args.batch_size)
+    else:
+        sync(table=args.table, batch_size=args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Index Sync Unit Tests.
+
+These tests sync a fake reference table into the local exact index so no
+cloud APIs are called.
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace
+
+import config
+import index_sync
+import local_index
+import nearest_neighbors
+
+def product(id, embedding, categories, image_embedding=None, version=0):
+  row = {
+    config.COLUMN_ID: id,
+    config.COLUMN_TEXT_EMBEDDING: embedding,
+    config.COLUMN_IMAGE_EMBEDDING: image_embedding or [],
+    'sync_hash': f'{id}-{version}-{categories}',
+  }
+  for i, col in enumerate(config.COLUMN_CATEGORIES):
+    row[col] = categories[i] if i < len(categories) else None
+  return row
+
+class FakeBigQuery:
+  """Answers the hashes query and the rows query from a list of products."""
+  def __init__(self, products):
+    self.products = products
+    self.queries = []
+
+  def query(self, query, job_config=None):
+    self.queries.append(query)
+    if job_config is None:
+      rows = [{config.COLUMN_ID: p[config.COLUMN_ID], 'sync_hash': p['sync_hash']} for p in self.products]
+    else:
+      ids = set(job_config.query_parameters[0].values)
+      rows = [p for p in self.products if p[config.COLUMN_ID] in ids]
+    return mock.Mock(result=mock.Mock(return_value=rows))
+
+class IndexSyncTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.dir.cleanup)
+    self.state_path = os.path.join(self.dir.name, 'state.json')
+    self.index_path = os.path.join(self.dir.name, 'index')
+    local_index.Datapoints.from_records([]).save(self.index_path)
+    self.index = local_index.ExactIndex.load(self.index_path)
+    self.bq = FakeBigQuery([
+      product('a', [1, 0, 0], ['Clothing', 'Mens'], image_embedding=[0.9, 0.1, 0]),
+      product('b', [0, 1, 0], ['Footwear']),
+      product('c', [0, 0, 1], ['Clothing', 'Womens']),
+    ])
+    patcher = mock.patch.object(index_sync.utils, 'get_bq_client', return_value=self.bq)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def sync(self, batch_size=2):
+    writer = index_sync.LocalIndexWriter(self.index, self.index_path)
+    return index_sync.sync(writer, index_sync.SyncState(self.state_path), 'p.d.t', batch_size)
+
+  def search(self, query, filter=[]):
+    return [n.id for n in self.index.find_neighbors(queries=[query], num_neighbors=10, filter=filter)[0]]
+
+  def test_initial_sync(self):
+    stats = self.sync()
+    self.assertEqual((stats['changed'], stats['deleted']), (3, 0))
+    self.assertEqual(stats['upsert_calls'], 2) # 4 datapoints in batches of 2
+    self.assertEqual(sorted(self.index.datapoints.ids), ['a_I', 'a_T', 'b_T', 'c_T'])
+    self.assertEqual(self.search([1, 0, 0], [Namespace('L1', ['Mens'])]), ['a_T', 'a_I'])
+
+  def test_no_changes(self):
+    self.sync()
+    stats = self.sync()
+    self.assertEqual((stats['changed'], stats['deleted']), (0, 0))
+    self.assertEqual(len(self.bq.queries), 3) # second sync only ran the hashes query
+
+  def test_incremental_sync(self):
+    self.sync()
+    self.bq.products = [
+      product('a', [1, 0, 0], ['Clothing', 'Mens'], version=1), # image removed
+      product('b', [0, 1, 0], ['Clothing', 'Kids']), # recategorized
+      product('d', [1, 1, 0], ['Footwear']), # added, c deleted
+    ]
+    stats = self.sync()
+    self.assertEqual((stats['changed'], stats['deleted']), (3, 1))
+    self.assertEqual(sorted(self.index.datapoints.ids), ['a_T', 'b_T', 'd_T'])
+    self.assertEqual(self.search([0, 1, 0], [Namespace('L0', ['Footwear'])]), ['d_T'])
+    self.assertEqual(self.search([0, 1, 0], [Namespace('L1', ['Kids'])]), ['b_T'])
+    self.assertEqual(set(index_sync.SyncState(self.state_path).hashes), {'a', 'b', 'd'})
+
+  def test_served_index_updated(self):
+    with mock.patch.object(nearest_neighbors, 'get_index', return_value=self.index), \
+         mock.patch.object(config, 'LOCAL_INDEX_PATH', self.index_path):
+      index_sync.sync(index_sync.get_writer('exact'), index_sync.SyncState(self.state_path), 'p.d.t')
+      neighbors = nearest_neighbors.find_neighbors([[0, 0, 1]], ['Clothing'], 1)
+    self.assertEqual([n.id for n in neighbors[0]], ['c_T'])
+
+  def test_other_processes_reload(self):
+    server = local_index.ExactIndex.load(self.index_path)
+    self.sync()
+    self.assertEqual(len(server.datapoints), 0)
+    self.assertTrue(server.refresh(interval=0))
+    self.assertEqual(sorted(server.datapoints.ids), ['a_I', 'a_T', 'b_T', 'c_T'])
+    self.assertFalse(server.refresh(interval=0)) # unchanged since
+    self.assertEqual(server.version, 1)
+
+  def test_jsonl_path_rejected(self):
+    path = os.path.join(self.dir.name, 'index.json')
+    open(path, 'w').close()
+    with self.assertRaises(ValueError):
+      index_sync.LocalIndexWriter(self.index, path)
+
+  def test_restricts_stop_at_null(self):
+    row = product('a', [1], ['Clothing', None, 'Jeans'])
+    self.assertEqual(index_sync.restricts(row), [{'namespace': 'L0', 'allow': ['Clothing']}])
+
+if __name__ == '__main__':
+  unittest.main()
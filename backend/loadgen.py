@@ -0,0 +1,275 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Open-loop load generator with SLO reporting for the REST API.
+
+Requests are sent at scheduled arrival times, at a constant rate or as a
+Poisson process, whether or not earlier requests have completed. Latency is
+measured from the scheduled arrival, not from when the request was actually
+sent, so a stalled server shows up as latency instead of silently lowering
+the request rate (coordinated omission).
+
+By default the API runs in-process over httpx.ASGITransport, with upstream
+services replaced by the fakes of fakes.py. Note the load generator then
+shares the event loop with the API, keep its own overhead in mind at very
+high rates. Use --url to load a deployed instance instead.
+
+Step through increasing rates to find the saturation point, the first rate
+at which p99 latency exceeds the SLO, the error rate exceeds its budget or
+the server falls behind the offered rate:
+
+    python loadgen.py --rates 5 10 20 40 --duration 30 --profile vertex
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import random
+import struct
+import time
+import zlib
+
+import httpx
+import numpy as np
+
+import config
+import fakes
+
+DEFAULT_MIX = {
+    'endpoints': {'/v1/categories/': 0.5, '/v1/attributes/': 0.5}, # share of requests
+    'description_words': (3, 60), # uniform range of description lengths
+    'image_probability': 0.3, # share of requests with a base64 image
+    'image_size': (64, 512), # uniform range of image width and height in pixels
+    'filter_probability': 0.2, # share of requests with a category filter
+}
+WORDS = fakes.WORDS + fakes.COLORS + ['shirt', 'dress', 'kurta', 'jeans', 'shoes', 'watch', 'bag', 'men', 'women']
+
+
+def png(width: int, height: int, rng: random.Random) -> bytes:
+    """Noise image, compressing about as badly as a photo."""
+    rows = b''.join(b'\0' + rng.randbytes(width * 3) for _ in range(height))
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0) # 8 bit RGB
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+class Workload:
+    """Generates a reproducible mix of requests.
+
+    Args:
+        mix: see DEFAULT_MIX
+        filters: category prefixes to draw filters from
+        seed: random seed
+        images: number of distinct images to draw from
+    """
+    def __init__(
+        self,
+        mix: dict = DEFAULT_MIX,
+        filters: list[list[str]] = [[config.TEST_CATEGORY_L0]],
+        seed: int = 0,
+        images: int = 20):
+        self.mix = mix
+        self.filters = filters
+        self.rng = random.Random(seed)
+        self.endpoints = list(mix['endpoints'])
+        self.weights = list(mix['endpoints'].values())
+        self.images = [base64.b64encode(png(self.rng.randint(*mix['image_size']),
+                                             self.rng.randint(*mix['image_size']), self.rng)).decode()
+                       for _ in range(images if mix['image_probability'] else 0)]
+
+    def request(self) -> tuple[str, dict]:
+        """Endpoint and JSON body of the next request."""
+        endpoint = self.rng.choices(self.endpoints, self.weights)[0]
+        words = self.rng.choices(WORDS, k=self.rng.randint(*self.mix['description_words']))
+        body = {'description': ' '.join(words)}
+        if self.images and self.rng.random() < self.mix['image_probability']:
+            body['main_image_base64'] = self.rng.choice(self.images)
+        if self.filters and self.rng.random() < self.mix['filter_probability']:
+            filter = self.rng.choice(self.filters)
+            body['category'] = filter[:self.rng.randint(1, len(filter))]
+        return endpoint, body
+
+
+def arrivals(rate: float, duration: float, poisson: bool = True, seed: int = 0) -> list[float]:
+    """Arrival times in seconds from the start, constant rate or Poisson process."""
+    if not poisson:
+        return [i / rate for i in range(int(rate * duration))]
+    rng = random.Random(seed)
+    times, t = [], rng.expovariate(rate)
+    while t < duration:
+        times.append(t)
+        t += rng.expovariate(rate)
+    return times
+
+
+async def run_step(
+    client: httpx.AsyncClient,
+    workload: Workload,
+    rate: float,
+    duration: float,
+    poisson: bool = True,
+    timeout: float = 60.0,
+    seed: int = 0) -> dict:
+    """Offer rate requests per second for duration seconds.
+
+    Returns:
+        dict with the offered and achieved rates, and latency percentiles in
+        milliseconds and error counts, overall and per endpoint
+    """
+    results = [] # (endpoint, latency, error)
+
+    async def send(scheduled: float, endpoint: str, body: dict):
+        error = None
+        try:
+            response = await client.post(endpoint, json=body, timeout=timeout)
+            if response.status_code >= 400:
+                error = f'HTTP {response.status_code}'
+        except httpx.HTTPError as e:
+            error = type(e).__name__
+        results.append((endpoint, time.perf_counter() - scheduled, error))
+
+    requests = [workload.request() for _ in arrivals(rate, duration, poisson, seed)]
+    start = time.perf_counter()
+    tasks = []
+    for offset, (endpoint, body) in zip(arrivals(rate, duration, poisson, seed), requests):
+        scheduled = start + offset
+        if (delay := scheduled - time.perf_counter()) > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(scheduled, endpoint, body)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    def summarize(rows: list[tuple]) -> dict:
+        latencies = np.array([latency for _, latency, _ in rows]) * 1000
+        errors = [error for _, _, error in rows if error]
+        p50, p90, p99, p999 = np.percentile(latencies, [50, 90, 99, 99.9]) if len(rows) else [0.0] * 4
+        return {
+            'requests': len(rows),
+            'error_rate': round(len(errors) / len(rows), 4) if rows else 0.0,
+            'errors': {e: errors.count(e) for e in sorted(set(errors))},
+            'p50_ms': round(p50, 1),
+            'p90_ms': round(p90, 1),
+            'p99_ms': round(p99, 1),
+            'p999_ms': round(p999, 1),
+            'max_ms': round(float(latencies.max()), 1) if len(rows) else 0.0,
+        }
+
+    ok = sum(1 for _, _, error in results if not error)
+    return {
+        'offered_rps': rate,
+        'goodput_rps': round(ok / duration, 2),
+        'drain_s': round(max(0.0, elapsed - duration), 2), # time to complete requests after the last arrival
+        **summarize(results),
+        'endpoints': {e: summarize([r for r in results if r[0] == e]) for e in workload.endpoints},
+    }
+
+
+def check_slo(step: dict, slo_p99_ms: float, max_error_rate: float) -> list[str]:
+    """Reasons a step violates the SLO, empty if it meets it.
+
+    A server that can't keep up queues requests, so latency keeps growing
+    over the step and the p99 check catches it.
+    """
+    reasons = []
+    if step['p99_ms'] > slo_p99_ms:
+        reasons.append(f"p99 {step['p99_ms']}ms > {slo_p99_ms}ms")
+    if step['error_rate'] > max_error_rate:
+        reasons.append(f"error rate {step['error_rate']:.2%} > {max_error_rate:.2%}")
+    return reasons
+
+
+async def run(
+    rates: list[float],
+    duration: float,
+    client: httpx.AsyncClient,
+    workload: Workload,
+    poisson: bool = True,
+    slo_p99_ms: float = config.LOADTEST_SLO_P99_MS,
+    max_error_rate: float = config.LOADTEST_MAX_ERROR_RATE,
+    stop_at_saturation: bool = True) -> dict:
+    """Run each rate in increasing order.
+
+    Returns:
+        report with the result of each step, the highest rate meeting the
+        SLO and the first rate violating it (the saturation point), if any
+    """
+    report = {'slo': {'p99_ms': slo_p99_ms, 'max_error_rate': max_error_rate},
+              'steps': [], 'max_rps_within_slo': None, 'saturation_rps': None}
+    for i, rate in enumerate(sorted(rates)):
+        step = await run_step(client, workload, rate, duration, poisson, seed=i)
+        step['slo_violations'] = check_slo(step, slo_p99_ms, max_error_rate)
+        report['steps'].append(step)
+        logging.info(f'{rate}/s: {step}')
+        if step['slo_violations']:
+            report['saturation_rps'] = report['saturation_rps'] or rate
+            if stop_at_saturation:
+                break
+        elif report['saturation_rps'] is None:
+            report['max_rps_within_slo'] = rate
+    return report
+
+
+def print_report(report: dict):
+    print(f"{'offered/s':>10}{'goodput/s':>10}{'drain s':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'p99.9 ms':>10}{'errors':>8}  SLO")
+    for s in report['steps']:
+        slo = '; '.join(s['slo_violations']) or 'ok'
+        print(f"{s['offered_rps']:>10}{s['goodput_rps']:>10}{s['drain_s']:>8}{s['p50_ms']:>9}{s['p90_ms']:>9}"
+              f"{s['p99_ms']:>9}{s['p999_ms']:>10}{s['error_rate']:>8.2%}  {slo}")
+    print(f"Max rate within SLO: {report['max_rps_within_slo']}/s, saturation at: {report['saturation_rps']}/s")
+
+
+async def _main(args):
+    if args.url:
+        # Unbounded pool: requests queued in the client would be reported as server latency
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(base_url=args.url, limits=limits) as client:
+            return await run(args.rates, args.duration, client, Workload(seed=args.seed),
+                             not args.constant, args.slo_p99_ms, args.max_error_rate)
+    import api # imported here so --url works without the backend dependencies configured
+    catalog = fakes.Catalog(args.products)
+    filters = [list(leaf) for leaf in catalog.leaves]
+    with fakes.installed(catalog, args.profile, args.scale):
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://loadgen') as client:
+            return await run(args.rates, args.duration, client, Workload(filters=filters, seed=args.seed),
+                             not args.constant, args.slo_p99_ms, args.max_error_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Open-loop load test of the REST API.')
+    parser.add_argument('--rates', type=float, nargs='+', default=[5, 10, 20, 40, 80], help='requests/sec per step')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per step')
+    parser.add_argument('--constant', action='store_true', help='constant instead of Poisson arrivals')
+    parser.add_argument('--url', help='load this deployed API instead of an in-process one with fake upstreams')
+    parser.add_argument('--profile', default='vertex', choices=sorted(fakes.PROFILES), help='fake upstream latency')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply fake upstream latencies')
+    parser.add_argument('--products', type=int, default=1000, help='size of the fake catalog')
+    parser.add_argument('--slo_p99_ms', type=float, default=config.LOADTEST_SLO_P99_MS)
+    parser.add_argument('--max_error_rate', type=float, default=config.LOADTEST_MAX_ERROR_RATE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='also write the report as JSON to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    report = asyncio.run(_main(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load Generator Unit Tests.
+
+These tests run fully offline against small in-process apps.
+"""
+import asyncio
+import base64
+import unittest
+import zlib
+
+from fastapi import FastAPI
+import httpx
+
+import loadgen
+
+def _client(app: FastAPI) -> httpx.AsyncClient:
+  return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test')
+
+def _serial_app(service_time: float) -> FastAPI:
+  """Serves one request at a time."""
+  app, lock = FastAPI(), asyncio.Lock()
+  @app.post('/v1/categories/')
+  async def categories(body: dict):
+    async with lock:
+      await asyncio.sleep(service_time)
+    return []
+  return app
+
+class ArrivalsTest(unittest.TestCase):
+
+  def test_constant(self):
+    times = loadgen.arrivals(10, 2, poisson=False)
+    self.assertEqual(len(times), 20)
+    self.assertAlmostEqual(times[1] - times[0], 0.1)
+
+  def test_poisson(self):
+    times = loadgen.arrivals(100, 100, seed=1)
+    self.assertAlmostEqual(len(times), 10000, delta=300)
+    self.assertEqual(times, loadgen.arrivals(100, 100, seed=1))
+    self.assertTrue(all(0 < t < 100 for t in times))
+
+class WorkloadTest(unittest.TestCase):
+
+  def test_mix(self):
+    workload = loadgen.Workload(filters=[['A', 'B', 'C']], seed=1, images=2)
+    requests = [workload.request() for _ in range(2000)]
+    endpoints = [endpoint for endpoint, _ in requests]
+    self.assertAlmostEqual(endpoints.count('/v1/categories/') / 2000, 0.5, delta=0.05)
+    self.assertAlmostEqual(sum('main_image_base64' in b for _, b in requests) / 2000, 0.3, delta=0.05)
+    filters = [b['category'] for _, b in requests if 'category' in b]
+    self.assertAlmostEqual(len(filters) / 2000, 0.2, delta=0.05)
+    self.assertTrue(all(f == ['A', 'B', 'C'][:len(f)] for f in filters))
+
+  def test_reproducible(self):
+    a, b = loadgen.Workload(seed=3, images=1), loadgen.Workload(seed=3, images=1)
+    self.assertEqual([a.request() for _ in range(20)], [b.request() for _ in range(20)])
+
+  def test_png(self):
+    workload = loadgen.Workload(seed=1, images=1)
+    png = base64.b64decode(workload.images[0])
+    self.assertTrue(png.startswith(b'\x89PNG'))
+    idat = png.index(b'IDAT')
+    length = int.from_bytes(png[idat - 4:idat], 'big')
+    self.assertGreater(len(zlib.decompress(png[idat + 4:idat + 4 + length])), 0)
+
+class RunTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workload = loadgen.Workload({**loadgen.DEFAULT_MIX, 'endpoints': {'/v1/categories/': 1}}, seed=1, images=0)
+
+  def test_counts_queueing_delay(self):
+    # 40 req/s offered to a server handling 20 req/s: a closed-loop client
+    # would measure ~50ms per request, open-loop latency grows with the queue
+    async def run():
+      async with _client(_serial_app(0.05)) as client:
+        return await loadgen.run_step(client, self.workload, 40, 0.5, poisson=False)
+    step = asyncio.run(run())
+    self.assertEqual(step['requests'], 20)
+    self.assertGreater(step['p99_ms'], 400)
+    self.assertGreater(step['drain_s'], 0.3)
+    self.assertEqual(step['error_rate'], 0)
+
+  def test_errors(self):
+    app = FastAPI()
+    @app.post('/v1/categories/')
+    async def fail(body: dict):
+      raise ValueError('upstream down')
+    async def run():
+      async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app, raise_app_exceptions=False),
+                                   base_url='http://test') as client:
+        return await loadgen.run_step(client, self.workload, 20, 0.25, poisson=False)
+    step = asyncio.run(run())
+    self.assertEqual(step['error_rate'], 1.0)
+    self.assertEqual(step['errors'], {'HTTP 500': 5})
+
+  def test_saturation(self):
+    async def run():
+      async with _client(_serial_app(0.02)) as client:
+        return await loadgen.run(
+          [10, 200, 20], 0.5, client, self.workload, poisson=False, slo_p99_ms=200, max_error_rate=0)
+    report = asyncio.run(run())
+    self.assertEqual(report['max_rps_within_slo'], 20)
+    self.assertEqual(report['saturation_rps'], 200)
+    self.assertEqual([s['offered_rps'] for s in report['steps']], [10, 20, 200])
+
+  def test_check_slo(self):
+    step = {'p99_ms': 500, 'error_rate': 0.02}
+    self.assertEqual(loadgen.check_slo(step, 1000, 0.05), [])
+    self.assertEqual(len(loadgen.check_slo(step, 100, 0.01)), 2)
+
+if __name__ == '__main__':
+  unittest.main()
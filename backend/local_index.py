@@ -0,0 +1,371 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process exact vector search.
+
+Drop-in replacement for a Vertex Vector Search index endpoint when the catalog
+fits in memory. Datapoints are loaded from the same JSONL format produced by
+the data_prep_with_restricts notebook, i.e. one record per line with an `id`,
+an `embedding` and the category restricts, either as a `restricts` list:
+
+    {"id": "abc_T", "embedding": [...], "restricts": [{"namespace": "L0", "allow": ["Clothing"]}]}
+
+or as one column per category level:
+
+    {"id": "abc_T", "embedding": [...], "L0": "Clothing", "L1": "Women's Clothing", ...}
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Iterable, Optional
+
+import numpy as np
+from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import MatchNeighbor, Namespace
+
+import config
+
+MISSING = -1 # restrict code for datapoints without a value at that level
+
+
+def _parse_restricts(record: dict, namespaces: list[str]) -> list[Optional[str]]:
+    """Extract one category token per namespace from a JSONL record."""
+    tokens = {}
+    for restrict in record.get('restricts') or []:
+        allow = restrict.get('allow') or restrict.get('allow_list') or []
+        if allow:
+            tokens[restrict['namespace']] = allow[0]
+    for namespace in namespaces:
+        if record.get(namespace):
+            tokens[namespace] = record[namespace]
+    return [tokens.get(namespace) for namespace in namespaces]
+
+
+class Datapoints:
+    """Columnar, in-memory representation of index datapoints.
+
+    Attributes:
+        ids: list of datapoint IDs e.g. '<product id>_T'
+        embeddings: contiguous float32 matrix of shape (len(ids), dimensions),
+            L2 normalized so that a dot product is the cosine similarity.
+            May be memory-mapped when loaded from disk
+        namespaces: restrict namespaces e.g. config.FILTER_CATEGORIES
+        vocab: per namespace dict mapping a token to its integer code
+        codes: int32 matrix of shape (len(ids), len(namespaces)) holding the
+            token code of each datapoint for each namespace, MISSING if unset
+    """
+    def __init__(
+        self,
+        ids: list[str],
+        embeddings: np.ndarray,
+        codes: np.ndarray,
+        vocab: list[dict[str, int]],
+        namespaces: list[str] = config.FILTER_CATEGORIES):
+        self.ids = ids
+        self.embeddings = embeddings
+        self.codes = codes
+        self.vocab = vocab
+        self.namespaces = list(namespaces)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_records(
+        cls,
+        records: Iterable[dict],
+        namespaces: list[str] = config.FILTER_CATEGORIES) -> 'Datapoints':
+        ids, embeddings, restricts = [], [], []
+        for record in records:
+            ids.append(record['id'])
+            embeddings.append(record['embedding'])
+            restricts.append(_parse_restricts(record, namespaces))
+        dim = len(embeddings[0]) if embeddings else 0
+        matrix = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), dim)
+        vocab = [{} for _ in namespaces]
+        codes = np.full((len(ids), len(namespaces)), MISSING, dtype=np.int32)
+        for row, tokens in enumerate(restricts):
+            for col, token in enumerate(tokens):
+                if token is not None:
+                    codes[row, col] = vocab[col].setdefault(token, len(vocab[col]))
+        return cls(ids, normalize(matrix), codes, vocab, namespaces)
+
+    @classmethod
+    def from_jsonl(
+        cls,
+        path: str,
+        namespaces: list[str] = config.FILTER_CATEGORIES) -> 'Datapoints':
+        with open(path) as f:
+            records = (json.loads(line) for line in f if line.strip())
+            datapoints = cls.from_records(records, namespaces)
+        logging.info(f'Loaded {len(datapoints)} datapoints from {path}')
+        return datapoints
+
+    def save(self, path: str):
+        """Write datapoints to a directory of .npy files."""
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'ids.npy'), np.asarray(self.ids, dtype=str))
+        np.save(os.path.join(path, 'embeddings.npy'), self.embeddings)
+        np.save(os.path.join(path, 'codes.npy'), self.codes)
+        with open(os.path.join(path, 'datapoints.json'), 'w') as f:
+            json.dump({'namespaces': self.namespaces, 'vocab': self.vocab}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = 'r') -> 'Datapoints':
+        """Load datapoints written by save().
+
+        Embeddings and restrict codes are memory-mapped by default so loading
+        is near instant and pages are only read from disk as they are used.
+        """
+        with open(os.path.join(path, 'datapoints.json')) as f:
+            meta = json.load(f)
+        return cls(
+            np.load(os.path.join(path, 'ids.npy')).tolist(),
+            np.load(os.path.join(path, 'embeddings.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, 'codes.npy'), mmap_mode=mmap_mode),
+            meta['vocab'],
+            meta['namespaces'])
+
+    def upsert(self, records: Iterable[dict]) -> 'Datapoints':
+        """Copy of these datapoints with records added or replaced by ID."""
+        new = Datapoints.from_records(records, self.namespaces)
+        if not len(self):
+            return new
+        vocab = [dict(v) for v in self.vocab]
+        codes = new.codes.copy()
+        for col, new_vocab in enumerate(new.vocab):
+            for token, code in new_vocab.items():
+                codes[new.codes[:, col] == code, col] = vocab[col].setdefault(token, len(vocab[col]))
+        keep = self._keep(new.ids)
+        return Datapoints(
+            [id for id, k in zip(self.ids, keep) if k] + new.ids,
+            np.concatenate([self.embeddings[keep], new.embeddings]),
+            np.concatenate([self.codes[keep], codes]),
+            vocab,
+            self.namespaces)
+
+    def remove(self, ids: Iterable[str]) -> 'Datapoints':
+        """Copy of these datapoints without the given IDs."""
+        keep = self._keep(ids)
+        return Datapoints(
+            [id for id, k in zip(self.ids, keep) if k],
+            self.embeddings[keep],
+            self.codes[keep],
+            self.vocab,
+            self.namespaces)
+
+    def _keep(self, ids: Iterable[str]) -> np.ndarray:
+        ids = set(ids)
+        return np.fromiter((id not in ids for id in self.ids), dtype=bool, count=len(self))
+
+    def filter_mask(self, filter: list[Namespace]) -> Optional[np.ndarray]:
+        """Boolean mask of datapoints eligible under the given restricts.
+
+        Follows Vertex semantics: a datapoint matches a namespace if it has one
+        of the allow tokens and none of the deny tokens. The overall filter is
+        an AND across namespaces.
+
+        Returns:
+            None if no filter is applied, otherwise a boolean array of len(self)
+        """
+        if not filter:
+            return None
+        mask = np.ones(len(self), dtype=bool)
+        for namespace in filter:
+            if namespace.name not in self.namespaces:
+                raise ValueError(f'Unknown restrict namespace {namespace.name}')
+            col = self.namespaces.index(namespace.name)
+            vocab = self.vocab[col]
+            if namespace.allow_tokens:
+                allowed = [vocab[t] for t in namespace.allow_tokens if t in vocab]
+                mask &= np.isin(self.codes[:, col], allowed)
+            if namespace.deny_tokens:
+                denied = [vocab[t] for t in namespace.deny_tokens if t in vocab]
+                mask &= ~np.isin(self.codes[:, col], denied)
+        return mask
+
+
+def load_datapoints(path: str) -> Datapoints:
+    """Load datapoints from a JSONL file or a directory written by save()."""
+    if os.path.isdir(path):
+        return Datapoints.load(path)
+    return Datapoints.from_jsonl(path)
+
+
+def _stamp(path: Optional[str]) -> Optional[tuple[int, int]]:
+    """Identifies a datapoints directory written by save(), None for JSONL files."""
+    try:
+        info = os.stat(os.path.join(path, 'datapoints.json'))
+    except (TypeError, OSError):
+        return None
+    return info.st_ino, info.st_mtime_ns
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2 normalize rows into a C-contiguous float32 matrix."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0 # leave zero vectors as is instead of dividing by 0
+    return vectors / norms
+
+
+def top_k(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Row-wise top k of a (num_queries, num_datapoints) score matrix.
+
+    Returns:
+        indices and scores, both of shape (num_queries, k), sorted by
+        descending score
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty
+    if k < scores.shape[1]:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+class ExactIndex:
+    """Brute force cosine search over a Datapoints matrix.
+
+    Exposes the same find_neighbors() signature as
+    aiplatform.MatchingEngineIndexEndpoint so it can be swapped in by
+    nearest_neighbors.get_index(). All queries of a call are answered with a
+    single matrix multiplication.
+
+    An index loaded from a directory reloads it when another process, e.g.
+    index_sync.py, replaces it with save(), see refresh().
+    """
+    def __init__(self, datapoints: Datapoints, path: Optional[str] = None):
+        self.datapoints = datapoints
+        self.version = 0 # incremented by every update
+        self.path = path
+        self._stamp = _stamp(path)
+        self._checked = time.monotonic()
+        self._refresh_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> 'ExactIndex':
+        return cls(load_datapoints(path), path)
+
+    def save(self, path: Optional[str] = None):
+        """Write the datapoints to a directory, by default the one loaded from.
+
+        The directory is written next to path and swapped in with renames, so
+        processes reloading it never see a partially written index.
+        """
+        path = path or self.path
+        tmp, old = path + '.tmp', path + '.old'
+        shutil.rmtree(tmp, ignore_errors=True)
+        shutil.rmtree(old, ignore_errors=True)
+        self.datapoints.save(tmp)
+        if os.path.isdir(path):
+            os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old, ignore_errors=True) # memory-mapped files stay readable until unmapped
+        if path == self.path:
+            self._stamp = _stamp(path)
+
+    def refresh(self, interval: float = config.LOCAL_INDEX_RELOAD_SECONDS) -> bool:
+        """Reload the datapoints if the directory was replaced since loading.
+
+        Checked at most every interval seconds. Searches are not blocked, they
+        keep using the current datapoints while the new ones are loaded.
+
+        Returns:
+            True if the datapoints were reloaded
+        """
+        if self._stamp is None or time.monotonic() - self._checked < interval:
+            return False
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            self._checked = time.monotonic()
+            stamp = _stamp(self.path)
+            if stamp is None or stamp == self._stamp:
+                return False
+            self.datapoints = Datapoints.load(self.path)
+            self._stamp = stamp
+            self.version += 1
+            logging.info(f'Reloaded {len(self.datapoints)} datapoints from {self.path}')
+            return True
+        except Exception as e:
+            logging.warning(f'Failed to reload datapoints from {self.path}: {e}')
+            return False
+        finally:
+            self._refresh_lock.release()
+
+    def upsert_datapoints(self, datapoints: list[dict]):
+        """Add or replace datapoints, in the JSONL record format.
+
+        Local stand-in for the Vertex streaming update API. The datapoints are
+        swapped in atomically, so concurrent searches see either the old or
+        the new set.
+        """
+        self.datapoints = self.datapoints.upsert(datapoints)
+        self.version += 1
+
+    def remove_datapoints(self, datapoint_ids: list[str]):
+        """Remove datapoints by ID, unknown IDs are ignored."""
+        self.datapoints = self.datapoints.remove(datapoint_ids)
+        self.version += 1
+
+    def find_neighbors(
+        self,
+        *,
+        queries: list[list[float]],
+        num_neighbors: int = 10,
+        filter: Optional[list[Namespace]] = [],
+        deployed_index_id: Optional[str] = None) -> list[list[MatchNeighbor]]:
+        """Find nearest neighbors by cosine distance.
+
+        Args:
+            queries: list of query embeddings
+            num_neighbors: number of neighbors to return for EACH query
+            filter: list of Namespace restricts, ANDed together
+            deployed_index_id: ignored, accepted for API compatibility
+
+        Returns:
+            One list of MatchNeighbor per query, closest first. Distance is
+            the cosine distance i.e. 1 - cosine similarity
+        """
+        self.refresh()
+        datapoints = self.datapoints # local reference in case of a concurrent update
+        if not queries or not len(datapoints):
+            return [[] for _ in queries]
+        mask = datapoints.filter_mask(filter)
+        embeddings = datapoints.embeddings
+        rows = None
+        if mask is not None:
+            rows = np.flatnonzero(mask)
+            if not len(rows):
+                return [[] for _ in queries]
+            embeddings = embeddings[rows]
+        scores = normalize(np.asarray(queries, dtype=np.float32)) @ embeddings.T
+        idx, sims = top_k(scores, num_neighbors)
+        if rows is not None:
+            idx = rows[idx]
+        ids = datapoints.ids
+        return [
+            [MatchNeighbor(ids[i], float(1.0 - s)) for i, s in zip(row_idx, row_sims)]
+            for row_idx, row_sims in zip(idx, sims)
+        ]
@@ -0,0 +1,113 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local Exact Index Unit Tests.
+
+These tests run fully offline against a small synthetic index.
+"""
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace
+
+import local_index
+
+RECORDS = [
+  {'id': 'a_T', 'embedding': [1, 0, 0], 'L0': 'Clothing', 'L1': 'Mens'},
+  {'id': 'b_T', 'embedding': [0.9, 0.1, 0], 'L0': 'Clothing', 'L1': 'Womens'},
+  {'id': 'c_T', 'embedding': [0, 1, 0], 'restricts': [
+      {'namespace': 'L0', 'allow': ['Footwear']}]},
+  {'id': 'd_T', 'embedding': [0, 0, 1], 'L0': 'Clothing'},
+]
+
+class LocalIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.index = local_index.ExactIndex(local_index.Datapoints.from_records(RECORDS))
+
+  def test_from_jsonl(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'index.json')
+      with open(path, 'w') as f:
+        f.write('\n'.join(json.dumps(r) for r in RECORDS))
+      index = local_index.ExactIndex.load(path)
+    self.assertEqual(len(index.datapoints), len(RECORDS))
+    self.assertEqual(index.datapoints.embeddings.dtype, np.float32)
+    self.assertTrue(index.datapoints.embeddings.flags['C_CONTIGUOUS'])
+
+  def test_save_and_load(self):
+    with tempfile.TemporaryDirectory() as d:
+      self.index.datapoints.save(d)
+      index = local_index.ExactIndex.load(d)
+      res = index.find_neighbors(
+        queries=[[1, 0, 0]], num_neighbors=1, filter=[Namespace('L0', ['Footwear'])])
+    self.assertEqual(res[0][0].id, 'c_T')
+
+  def test_find_neighbors_no_filter(self):
+    res = self.index.find_neighbors(queries=[[1, 0, 0], [0, 1, 0]], num_neighbors=2)
+    self.assertEqual(len(res), 2)
+    self.assertEqual([n.id for n in res[0]], ['a_T', 'b_T'])
+    self.assertAlmostEqual(res[0][0].distance, 0.0, places=5)
+    self.assertEqual(res[1][0].id, 'c_T')
+
+  def test_find_neighbors_with_filter(self):
+    res = self.index.find_neighbors(
+      queries=[[1, 0, 0]],
+      num_neighbors=5,
+      filter=[Namespace('L0', ['Clothing']), Namespace('L1', ['Womens'])])
+    self.assertEqual([n.id for n in res[0]], ['b_T'])
+
+  def test_find_neighbors_with_deny(self):
+    res = self.index.find_neighbors(
+      queries=[[1, 0, 0]],
+      num_neighbors=5,
+      filter=[Namespace('L0', ['Clothing'], ['Clothing'])])
+    self.assertEqual(res, [[]])
+
+  def test_find_neighbors_unknown_category(self):
+    res = self.index.find_neighbors(
+      queries=[[1, 0, 0]],
+      num_neighbors=5,
+      filter=[Namespace('L0', ['XYZunknowncategory'])])
+    self.assertEqual(res, [[]])
+
+  def test_upsert_datapoints(self):
+    self.index.upsert_datapoints([
+      {'id': 'a_T', 'embedding': [0, 1, 0], 'L0': 'Footwear'},
+      {'id': 'e_T', 'embedding': [1, 0, 0], 'L0': 'Jewellery'},
+    ])
+    self.assertEqual(len(self.index.datapoints), 5)
+    res = self.index.find_neighbors(queries=[[1, 0, 0]], num_neighbors=2)
+    self.assertEqual([n.id for n in res[0]], ['e_T', 'b_T'])
+    res = self.index.find_neighbors(
+      queries=[[1, 0, 0]], num_neighbors=5, filter=[Namespace('L0', ['Footwear'])])
+    self.assertEqual(sorted(n.id for n in res[0]), ['a_T', 'c_T'])
+
+  def test_upsert_datapoints_empty_index(self):
+    index = local_index.ExactIndex(local_index.Datapoints.from_records([]))
+    index.upsert_datapoints(RECORDS)
+    res = index.find_neighbors(queries=[[1, 0, 0]], num_neighbors=1)
+    self.assertEqual(res[0][0].id, 'a_T')
+
+  def test_remove_datapoints(self):
+    self.index.remove_datapoints(['a_T', 'unknown_T'])
+    self.assertEqual(len(self.index.datapoints), 3)
+    res = self.index.find_neighbors(queries=[[1, 0, 0]], num_neighbors=1)
+    self.assertEqual(res[0][0].id, 'b_T')
+
+if __name__ == '__main__':
+  unittest.main()
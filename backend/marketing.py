@@ -13,11 +13,39 @@
 # limitations under the License.
 
 """Functions to generate marketing copy."""
+import asyncio
+import json
+import logging
+import threading
+import time
+from typing import AsyncIterator
+
 import config
+import metrics
 import utils
 
-llm = utils.get_llm()
+def _prompt(desc: str, attributes: dict[str,str]) -> str:
+    return f"""
+      Generate a compelling and accurate product description
+      for a product with the following description and attributes.
+
+      Description:
+      {desc}
+
+      Attributes:
+      {attributes}
+    """
+
+def _cache_key(desc: str, attributes: dict[str,str]) -> str:
+    """LLM cache key of a prompt, the same for any order of the attributes."""
+    return json.dumps([desc, sorted(attributes.items())])
+
+LLM_PARAMETERS = {
+  "max_output_tokens": 1024,
+  "temperature": 0.5,
+}
 
+@metrics.timed('marketing')
 def generate_marketing_copy(desc: str, attributes: dict[str,str]) -> str:
     """Given list of product IDs, join category names.
     
@@ -28,22 +56,82 @@ def generate_marketing_copy(desc: str, attributes: dict[str,str]) -> str:
     Returns:
         Marketing copy that can be used for a product page
     """
-    prompt = f"""
-      Generate a compelling and accurate product description
-      for a product with the following description and attributes.
-
-      Description:
-      {desc}
+    prompt = _prompt(desc, attributes)
+    response = utils.get_cached_llm().predict(
+        prompt,
+        cache_key=_cache_key(desc, attributes),
+        **LLM_PARAMETERS
+    )
+    metrics.observe_llm('marketing', prompt, response.text)
+    return response.text
 
-      Attributes:
-      {attributes}
-    """
-    llm_parameters = {
-      "max_output_tokens": 1024,
-      "temperature": 0.5,
-    }
-    response = llm.predict(
+@metrics.timed('marketing')
+async def generate_marketing_copy_async(desc: str, attributes: dict[str,str]) -> str:
+    """Async version of generate_marketing_copy()."""
+    prompt = _prompt(desc, attributes)
+    response = await utils.get_cached_llm().predict_async(
         prompt,
-        **llm_parameters
+        cache_key=_cache_key(desc, attributes),
+        **LLM_PARAMETERS
     )
-    return response.text
\ No newline at end of file
+    metrics.observe_llm('marketing', prompt, response.text)
+    return response.text
+
+
+_DONE = object()
+
+
+async def stream_marketing_copy(desc: str, attributes: dict[str,str]) -> AsyncIterator[str]:
+    """Streaming version of generate_marketing_copy_async().
+
+    The model's streaming predict API is blocking so it is consumed in a
+    worker thread and chunks are handed to the event loop as they arrive.
+    Closing or cancelling the iterator (e.g. when the client disconnects)
+    stops the upstream generation at the next chunk.
+
+    Yields:
+        Chunks of marketing copy in order
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    start = time.perf_counter()
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError: # loop closed, nobody is listening anymore
+            stop.set()
+
+    def produce():
+        try:
+            responses = utils.get_cached_llm().predict_streaming(_prompt(desc, attributes), **LLM_PARAMETERS)
+            try:
+                for response in responses:
+                    if stop.is_set():
+                        logging.info('Marketing copy stream cancelled')
+                        break
+                    put(response.text)
+            finally:
+                responses.close()
+        except Exception as e:
+            put(e)
+        finally:
+            put(_DONE)
+
+    producer = loop.run_in_executor(None, produce)
+    first = True
+    try:
+        while (item := await queue.get()) is not _DONE:
+            if isinstance(item, Exception):
+                raise item
+            if first:
+                elapsed = time.perf_counter() - start
+                metrics.STAGE_SECONDS.labels('marketing_first_chunk').observe(elapsed)
+                logging.info(f'Marketing copy first chunk after {elapsed * 1000:.0f}ms')
+                first = False
+            if item:
+                yield item
+    finally:
+        stop.set()
+        producer.cancel() # only has an effect if the thread hasn't started yet
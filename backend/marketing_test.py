@@ -13,7 +13,10 @@
 # limitations under the License.
 
 import logging; logging.basicConfig(level=logging.INFO)
+import asyncio
+import time
 import unittest
+from unittest import mock
 
 import marketing
 import config
@@ -27,5 +30,46 @@ class MarketingTest(unittest.TestCase):
     self.assertIsInstance(res, str)
     logging.info(res)
 
+  def test_generate_marketing_copy_async(self):
+    desc = "Men’s Hooded Puffer Jacket"
+    attributes = {'color':'green', 'pattern': 'striped', 'material': 'down'}
+    res = asyncio.run(marketing.generate_marketing_copy_async(desc, attributes))
+    self.assertIsInstance(res, str)
+    logging.info(res)
+
+  def test_prompt_keeps_attribute_order(self):
+    attributes = {'pattern': 'striped', 'color': 'green'}
+    self.assertIn(str(attributes), marketing._prompt('desc', attributes))
+    self.assertEqual(marketing._cache_key('desc', attributes),
+                     marketing._cache_key('desc', {'color': 'green', 'pattern': 'striped'}))
+
+  def test_stream_marketing_copy(self):
+    desc = "Men’s Hooded Puffer Jacket"
+    attributes = {'color':'green', 'pattern': 'striped', 'material': 'down'}
+    async def collect():
+      return [chunk async for chunk in marketing.stream_marketing_copy(desc, attributes)]
+    res = asyncio.run(collect())
+    self.assertGreater(len(res), 0)
+    self.assertIsInstance(''.join(res), str)
+    logging.info(''.join(res))
+
+  def test_stream_marketing_copy_cancel(self):
+    produced = []
+    def predict_streaming(prompt, **kwargs):
+      for i in range(100):
+        time.sleep(0.01)
+        produced.append(i)
+        yield mock.Mock(text=f'chunk {i} ')
+    async def first_chunk():
+      stream = marketing.stream_marketing_copy('desc', {})
+      chunk = await anext(stream)
+      await stream.aclose()
+      await asyncio.sleep(0.1)
+      return chunk
+    llm = mock.Mock(predict_streaming=predict_streaming)
+    with mock.patch.object(marketing.utils, 'get_cached_llm', return_value=llm):
+      self.assertEqual(asyncio.run(first_chunk()), 'chunk 0 ')
+    self.assertLess(len(produced), 100)
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -0,0 +1,170 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Latency, size and fallback metrics, exported with prometheus_client.
+
+Metrics are registered in the default prometheus_client REGISTRY, which the
+API serves at /metrics. Values read from stats functions at scrape time,
+e.g. cache counters, are registered with collected(). Stages of the request
+path are timed with timed(), which also opens an OpenTelemetry span per
+stage when config.TRACING_ENABLED is set and opentelemetry-api is
+installed. Spans are only exported if the application configures an
+OpenTelemetry SDK.
+
+Throughput is the rate of a histogram's _count, e.g. in PromQL:
+
+    rate(catalog_stage_duration_seconds_count{stage="embedding"}[1m])
+"""
+import functools
+import inspect
+import logging
+import time
+from typing import Callable
+
+from prometheus_client import REGISTRY, Counter, Histogram, disable_created_metrics
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+import config
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+disable_created_metrics() # no _created series next to every counter and histogram
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = tuple(2**i for i in range(8, 25, 2)) # 256B to 16MiB
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+CHARS_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+
+
+class Collected:
+    """Collector reading a metric at scrape time from a stats function, e.g.
+    cache hit counters.
+
+    Args:
+        collect: returns a dict mapping tuples of label values to values
+        type: 'counter' or 'gauge'
+    """
+    def __init__(self, name: str, help: str, labelnames: tuple[str], collect: Callable[[], dict], type: str = 'gauge'):
+        self.name = name
+        self.help = help
+        self.labelnames = list(labelnames)
+        self.stats = collect
+        self.type = type
+
+    def _family(self):
+        family = CounterMetricFamily if self.type == 'counter' else GaugeMetricFamily
+        return family(self.name, self.help, labels=self.labelnames)
+
+    def describe(self):
+        return [self._family()] # registering doesn't call the stats function
+
+    def collect(self):
+        family = self._family()
+        try:
+            collected = self.stats()
+        except Exception as e: # don't fail the whole scrape
+            logging.warning(f'Collecting metric {self.name} failed: {e}')
+            collected = {}
+        for values, value in sorted(collected.items()):
+            family.add_metric([str(v) for v in values], value)
+        yield family
+
+
+def collected(name: str, help: str, labelnames: tuple[str], collect: Callable[[], dict], type: str = 'gauge') -> Collected:
+    """Register a Collected metric in REGISTRY."""
+    collector = Collected(name, help, labelnames, collect, type)
+    REGISTRY.register(collector)
+    return collector
+
+
+STAGE_SECONDS = Histogram(
+    'catalog_stage_duration_seconds', 'Latency of each stage of the request path', ('stage',),
+    buckets=LATENCY_BUCKETS)
+STAGE_ERRORS = Counter(
+    'catalog_stage_errors', 'Stages that raised an exception', ('stage',))
+HTTP_SECONDS = Histogram(
+    'catalog_http_request_duration_seconds', 'Latency of API requests', ('method', 'route', 'status'),
+    buckets=LATENCY_BUCKETS)
+PAYLOAD_BYTES = Histogram(
+    'catalog_payload_bytes', 'Size of requests sent to upstream APIs', ('upstream',), buckets=BYTES_BUCKETS)
+BATCH_SIZE = Histogram(
+    'catalog_batch_size', 'Items per upstream API call', ('upstream',), buckets=COUNT_BUCKETS)
+NEIGHBORS = Histogram(
+    'catalog_neighbors', 'Neighbors returned per nearest neighbor search', buckets=COUNT_BUCKETS)
+LLM_CHARS = Histogram(
+    'catalog_llm_chars', 'Characters in LLM prompts and responses', ('task', 'kind'), buckets=CHARS_BUCKETS)
+REQUEST_IMAGE_BYTES = Histogram(
+    'catalog_request_image_bytes', 'Size of images in API requests as received', ('encoding',),
+    buckets=BYTES_BUCKETS)
+FALLBACKS = Counter(
+    'catalog_fallbacks', 'Times a stage fell back to a degraded answer', ('stage', 'reason'))
+
+
+def observe_llm(task: str, prompt: str, response: str):
+    """Record the sizes of an LLM call's prompt and response."""
+    LLM_CHARS.labels(task, 'prompt').observe(len(prompt))
+    LLM_CHARS.labels(task, 'response').observe(len(response or ''))
+
+
+class timed:
+    """Time a stage into STAGE_SECONDS, counting exceptions into STAGE_ERRORS.
+
+    Use as a context manager or as a decorator of sync or async functions:
+
+        with metrics.timed('reference_join'):
+            ...
+
+        @metrics.timed('embedding')
+        async def embed_async(...):
+            ...
+
+    Also opens an OpenTelemetry span named after the stage if
+    config.TRACING_ENABLED is set.
+    """
+    def __init__(self, stage: str):
+        self.stage = stage
+        self._start = None
+        self._span = None
+
+    def __enter__(self):
+        if config.TRACING_ENABLED and trace:
+            self._span = trace.get_tracer(__name__).start_as_current_span(self.stage)
+            self._span.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.labels(self.stage).observe(time.perf_counter() - self._start)
+        if exc_type is not None:
+            STAGE_ERRORS.labels(self.stage).inc()
+        if self._span:
+            self._span.__exit__(exc_type, exc, tb)
+        return False
+
+    def __call__(self, fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with timed(self.stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(self.stage):
+                return fn(*args, **kwargs)
+        return wrapper
@@ -0,0 +1,102 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Metrics Unit Tests.
+
+These tests run fully offline.
+"""
+import asyncio
+import unittest
+from unittest import mock
+
+import httpx
+from prometheus_client import CollectorRegistry, generate_latest
+
+import api
+import config
+import metrics
+
+class CollectedTest(unittest.TestCase):
+
+  def setUp(self):
+    self.registry = CollectorRegistry()
+
+  def render(self):
+    return generate_latest(self.registry).decode()
+
+  def test_collected(self):
+    calls = []
+    collect = lambda: calls.append(1) or {('hits',): 3}
+    self.registry.register(metrics.Collected('cache', 'Cache stats', ('stat',), collect))
+    self.assertEqual(calls, []) # not called until scraped
+    self.assertIn('cache{stat="hits"} 3.0', self.render())
+
+  def test_collected_counter(self):
+    self.registry.register(metrics.Collected('outcomes', 'Outcomes', ('outcome',), lambda: {('a',): 2}, 'counter'))
+    text = self.render()
+    self.assertIn('# TYPE outcomes_total counter', text)
+    self.assertIn('outcomes_total{outcome="a"} 2.0', text)
+
+  def test_collect_error_does_not_fail_scrape(self):
+    self.registry.register(metrics.Collected('broken', 'Broken', (), lambda: 1 / 0))
+    self.registry.register(metrics.Collected('cache', 'Cache stats', ('stat',), lambda: {('hits',): 3}))
+    text = self.render()
+    self.assertIn('# TYPE broken gauge', text)
+    self.assertIn('cache{stat="hits"} 3.0', text)
+
+  def test_endpoint(self):
+    metrics.FALLBACKS.labels('test_stage', 'test_reason').inc()
+    async def run():
+      async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url='http://test') as client:
+        return await client.get('/metrics')
+    res = asyncio.run(run())
+    self.assertEqual(res.status_code, 200)
+    self.assertIn('catalog_fallbacks_total{reason="test_reason",stage="test_stage"} 1.0', res.text)
+    self.assertIn('# TYPE catalog_stage_duration_seconds histogram', res.text)
+
+class TimedTest(unittest.TestCase):
+
+  def count(self, stage):
+    return metrics.REGISTRY.get_sample_value('catalog_stage_duration_seconds_count', {'stage': stage})
+
+  def test_decorates_sync_and_async(self):
+    @metrics.timed('test_sync')
+    def sync():
+      return 1
+    @metrics.timed('test_async')
+    async def run():
+      return 2
+    self.assertEqual(sync(), 1)
+    self.assertEqual(asyncio.run(run()), 2)
+    self.assertEqual(self.count('test_sync'), 1)
+    self.assertEqual(self.count('test_async'), 1)
+
+  def test_counts_errors(self):
+    with self.assertRaises(KeyError):
+      with metrics.timed('test_error'):
+        raise KeyError('missing')
+    self.assertEqual(self.count('test_error'), 1)
+    self.assertEqual(metrics.REGISTRY.get_sample_value('catalog_stage_errors_total', {'stage': 'test_error'}), 1)
+
+  def test_span(self):
+    tracer = mock.MagicMock()
+    with mock.patch.object(config, 'TRACING_ENABLED', True), \
+        mock.patch.object(metrics, 'trace') as trace:
+      trace.get_tracer.return_value = tracer
+      with metrics.timed('test_span'):
+        pass
+    tracer.start_as_current_span.assert_called_once_with('test_span')
+
+if __name__ == '__main__':
+  unittest.main()
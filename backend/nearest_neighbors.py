@@ -13,27 +13,287 @@
 # limitations under the License.
 
 """Functions for Vertex Vector Search."""
+import asyncio
 from collections import namedtuple
+from functools import cache
+import threading
+import time
+from typing import Hashable, Optional
 from google.cloud import aiplatform
-from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace
+from google.cloud import aiplatform_v1beta1
+from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import MatchNeighbor, Namespace
 
+import batching
 import config
+import hnsw_index
+import local_index
 import logging
+import metrics
+import neighbor_cache
+import quantized_index
+import ratelimit
+import utils
 
 Neighbor = namedtuple('Neighbor',['id', 'distance'])
-index_endpoint = aiplatform.MatchingEngineIndexEndpoint(
-    index_endpoint_name=config.ENDPOINT_ID,
-    project=config.PROJECT,
-    location=config.LOCATION
-)
 
+@utils.lazy
+def get_index(backend: str = config.VECTOR_SEARCH_BACKEND):
+    """Returns the index selected by config.VECTOR_SEARCH_BACKEND.
+
+    All backends expose a find_neighbors() method with the signature of
+    aiplatform.MatchingEngineIndexEndpoint.find_neighbors.
+    """
+    if backend == 'vertex':
+        return aiplatform.MatchingEngineIndexEndpoint(
+            index_endpoint_name=config.ENDPOINT_ID,
+            project=config.PROJECT,
+            location=config.LOCATION
+        )
+    if backend == 'exact':
+        return local_index.ExactIndex.load(config.LOCAL_INDEX_PATH)
+    if backend == 'hnsw':
+        return hnsw_index.HNSWIndex.load(config.HNSW_INDEX_PATH)
+    if backend == 'quantized':
+        return quantized_index.QuantizedIndex.load(config.QUANTIZED_INDEX_PATH)
+    raise ValueError(f'Unknown vector search backend {backend}')
+
+@utils.lazy
+def get_cache() -> Optional[neighbor_cache.NeighborCache]:
+    """Returns the neighbor cache, or None if disabled in config.py."""
+    if not config.NEIGHBOR_CACHE_ENABLED:
+        return None
+    return neighbor_cache.NeighborCache(
+        tables=config.NEIGHBOR_CACHE_TABLES,
+        bits=config.NEIGHBOR_CACHE_BITS,
+        min_similarity=config.NEIGHBOR_CACHE_MIN_SIMILARITY,
+        max_entries=config.NEIGHBOR_CACHE_MAX_ENTRIES)
+
+def cache_stats() -> dict[str, float]:
+    """Hit/miss counters of the neighbor cache."""
+    c = get_cache.peek()
+    return c.stats() if c is not None else {}
+
+metrics.collected(
+    'catalog_neighbor_cache', 'Neighbor cache counters, see neighbor_cache.NeighborCache.stats()',
+    ('stat',), lambda: {(k,): v for k, v in cache_stats().items()})
+
+_vertex_version = {'value': None, 'checked': None}
+_vertex_version_lock = threading.Lock()
+
+def _vertex_index_update_time(endpoint: aiplatform.MatchingEngineIndexEndpoint):
+    for deployed in endpoint.deployed_indexes:
+        if deployed.id == config.DEPLOYED_INDEX:
+            # includes streaming updates to the contents of the index
+            return aiplatform.MatchingEngineIndex(deployed.index).update_time
+    raise ValueError(f'Index {config.DEPLOYED_INDEX} is not deployed to {endpoint.resource_name}')
+
+def index_version() -> Optional[Hashable]:
+    """A value that changes whenever the contents of the index change.
+
+    In-process indexes count their updates, and a local index reloads its
+    directory here if another process replaced it, as cache hits never reach
+    its find_neighbors(). For Vertex Vector Search it is
+    the update time of the deployed index, checked at most every
+    config.NEIGHBOR_CACHE_VERSION_SECONDS.
+
+    Returns:
+        the version, or None if it can't be determined
+    """
+    index = get_index()
+    if not isinstance(index, aiplatform.MatchingEngineIndexEndpoint):
+        if hasattr(index, 'refresh'):
+            index.refresh(config.LOCAL_INDEX_RELOAD_SECONDS)
+        return id(index), getattr(index, 'version', 0)
+    with _vertex_version_lock:
+        checked = _vertex_version['checked']
+        if checked is None or time.monotonic() - checked >= config.NEIGHBOR_CACHE_VERSION_SECONDS:
+            try:
+                _vertex_version['value'] = _vertex_index_update_time(index)
+            except Exception as e:
+                logging.warning(f'Neighbor cache bypassed, index version unknown: {e}')
+                _vertex_version['value'] = None
+            _vertex_version['checked'] = time.monotonic()
+        return _vertex_version['value']
+
+def _filters_to_namespaces(filters: list[str]) -> list[Namespace]:
+    if len(filters) > config.CATEGORY_DEPTH:
+        logging.warning(f'''Number of category filters {len(filters)} is greater
+         than supported category depth {config.CATEGORY_DEPTH}. Truncating''')
+        filters = filters[:config.CATEGORY_DEPTH]
+    return [Namespace(config.FILTER_CATEGORIES[i],[f]) for i,f in enumerate(filters)]
+
+async def _vertex_find_neighbors_async(
+    endpoint: aiplatform.MatchingEngineIndexEndpoint,
+    queries: list[list[float]],
+    num_neighbors: int,
+    filter: list[Namespace]) -> list[list[MatchNeighbor]]:
+    """Same request as MatchingEngineIndexEndpoint.find_neighbors, over async gRPC."""
+    request = aiplatform_v1beta1.FindNeighborsRequest(
+        index_endpoint=endpoint.resource_name,
+        deployed_index_id=config.DEPLOYED_INDEX)
+    restricts = [
+        aiplatform_v1beta1.IndexDatapoint.Restriction(
+            namespace=namespace.name,
+            allow_list=namespace.allow_tokens,
+            deny_list=namespace.deny_tokens)
+        for namespace in filter]
+    for query in queries:
+        request.queries.append(aiplatform_v1beta1.FindNeighborsRequest.Query(
+            neighbor_count=num_neighbors,
+            datapoint=aiplatform_v1beta1.IndexDatapoint(
+                feature_vector=query, restricts=restricts)))
+    api_endpoint = endpoint.public_endpoint_domain_name
+    client = utils.get_loop_client(
+        ('match', api_endpoint),
+        lambda: aiplatform_v1beta1.MatchServiceAsyncClient(
+            client_options={'api_endpoint': api_endpoint}))
+    response = await ratelimit.call_async('vector_search', client.find_neighbors, request)
+    return [
+        [MatchNeighbor(id=n.datapoint.datapoint_id, distance=n.distance) for n in neighbors.neighbors]
+        for neighbors in response.nearest_neighbors
+    ]
+
+def _to_neighbors(queries: list[list[float]], response) -> list[list[Neighbor]]:
+    metrics.BATCH_SIZE.labels('vector_search').observe(len(queries))
+    for neighbors in response:
+        metrics.NEIGHBORS.observe(len(neighbors))
+    return [[Neighbor(r.id, r.distance) for r in neighbor] for neighbor in response]
+
+def _search(
+    queries: list[list[float]],
+    filters: list[str],
+    num_neighbors: int) -> list[list[Neighbor]]:
+    index = get_index()
+    kwargs = dict(
+        deployed_index_id=config.DEPLOYED_INDEX,
+        queries=queries,
+        num_neighbors=num_neighbors,
+        filter=_filters_to_namespaces(filters)
+    )
+    if isinstance(index, aiplatform.MatchingEngineIndexEndpoint):
+        response = ratelimit.call('vector_search', index.find_neighbors, **kwargs)
+    else:
+        response = index.find_neighbors(**kwargs)
+    return _to_neighbors(queries, response)
+
+def _from_cache(
+    c: neighbor_cache.NeighborCache,
+    queries: list[list[float]],
+    filters: list[str],
+    num_neighbors: int,
+    version: Hashable) -> list[Optional[list[Neighbor]]]:
+    return [c.get(q, (tuple(filters), num_neighbors), version) for q in queries]
+
+def _merge(
+    c: neighbor_cache.NeighborCache,
+    queries: list[list[float]],
+    filters: list[str],
+    num_neighbors: int,
+    version: Hashable,
+    cached: list[Optional[list[Neighbor]]],
+    response: list[list[Neighbor]]) -> list[list[Neighbor]]:
+    """Fill the cache misses with the index response, caching it."""
+    response = iter(response)
+    results = []
+    for query, neighbors in zip(queries, cached):
+        if neighbors is None:
+            neighbors = next(response)
+            c.put(query, (tuple(filters), num_neighbors), version, neighbors)
+        results.append(neighbors)
+    return results
+
+def find_neighbors(
+    queries: list[list[float]],
+    filters: list[str] = [],
+    num_neighbors: int = config.NUM_NEIGHBORS) -> list[list[Neighbor]]:
+    """Fetch nearest neighbors for each query with a single index call.
+
+    When config.NEIGHBOR_CACHE_ENABLED is set, queries nearly identical to
+    a recent one reuse its neighbors instead, see neighbor_cache.py.
+
+    Args:
+        queries: list of embeddings to find nearest neighbors
+        filters: category prefix to restrict results to, see get_nn()
+        num_neigbhors: number of nearest neighbors to return for EACH embedding
+
+    Returns:
+        One list of Neighbor per query, in the order of queries
+    """
+    c = get_cache()
+    version = index_version() if c is not None else None
+    if version is None:
+        return _search(queries, filters, num_neighbors)
+    cached = _from_cache(c, queries, filters, num_neighbors, version)
+    missing = [q for q, neighbors in zip(queries, cached) if neighbors is None]
+    response = _search(missing, filters, num_neighbors) if missing else []
+    return _merge(c, queries, filters, num_neighbors, version, cached, response)
+
+async def find_neighbors_async(
+    queries: list[list[float]],
+    filters: list[str] = [],
+    num_neighbors: int = config.NUM_NEIGHBORS) -> list[list[Neighbor]]:
+    """Async version of find_neighbors().
+
+    Vertex Vector Search is queried over async gRPC. In-process indexes are
+    CPU bound so they are searched in a worker thread.
+    """
+    index = get_index()
+    if not isinstance(index, aiplatform.MatchingEngineIndexEndpoint):
+        return await asyncio.to_thread(find_neighbors, queries, filters, num_neighbors)
+
+    async def search(queries: list[list[float]]) -> list[list[Neighbor]]:
+        response = await _vertex_find_neighbors_async(
+            index, queries, num_neighbors, _filters_to_namespaces(filters))
+        return _to_neighbors(queries, response)
+
+    c = get_cache()
+    version = await asyncio.to_thread(index_version) if c is not None else None
+    if version is None:
+        return await search(queries)
+    cached = _from_cache(c, queries, filters, num_neighbors, version)
+    missing = [q for q, neighbors in zip(queries, cached) if neighbors is None]
+    response = await search(missing) if missing else []
+    return _merge(c, queries, filters, num_neighbors, version, cached, response)
+
+def _split(response: list[list[Neighbor]], sizes: list[int]) -> list[list[list[Neighbor]]]:
+    """Split per-query results into consecutive groups of the given sizes."""
+    results, start = [], 0
+    for size in sizes:
+        results.append(response[start:start + size])
+        start += size
+    return results
+
+def _find_neighbors_batch(
+    requests: list[tuple[list[list[float]], tuple[str], int]]) -> list[list[list[Neighbor]]]:
+    """Answer several get_nn() calls sharing filters and num_neighbors at once."""
+    _, filters, num_neighbors = requests[0]
+    queries = [q for embeds, _, _ in requests for q in embeds]
+    response = find_neighbors(queries, list(filters), num_neighbors)
+    return _split(response, [len(embeds) for embeds, _, _ in requests])
+
+@cache
+def get_batcher() -> batching.MicroBatcher:
+    """Coalesces concurrent get_nn() calls into a single find_neighbors call.
+
+    Only calls with the same filters and num_neighbors can share a call.
+    """
+    return batching.MicroBatcher(
+        _find_neighbors_batch,
+        max_batch_size=config.NN_BATCH_MAX_SIZE,
+        max_wait_ms=config.BATCH_WINDOW_MS,
+        key=lambda request: request[1:],
+        name='nn-batcher')
+
+@metrics.timed('nearest_neighbors')
 def get_nn(
     embeds: list[list[float]], 
     filters: list[str] = [], 
     num_neighbors: int = config.NUM_NEIGHBORS) -> list[Neighbor]:
     """Fetch nearest neigbhors in vector store.
 
-    Neighbors are fetched independently for each embedding then unioned.
+    Neighbors are fetched independently for each embedding then unioned. All
+    embeddings are sent to the index in a single call. When
+    config.BATCHING_ENABLED is set, concurrent calls are coalesced as well.
 
     Args:
         embeds: list of embeddings to find neareast neighbors
@@ -50,16 +310,40 @@ def get_nn(
             id: unique item identifier, usually used to join to a reference DB
             distance: the embedding distance
     """
-    if len(filters) > config.CATEGORY_DEPTH:
-        logging.warning(f'''Number of category filters {len(filters)} is greater
-         than supported category depth {config.CATEGORY_DEPTH}. Truncating''')
-        filters = filters[:config.CATEGORY_DEPTH]
+    if config.BATCHING_ENABLED:
+        response = get_batcher()((embeds, tuple(filters), num_neighbors))
+    else:
+        response = find_neighbors(embeds, filters, num_neighbors)
+    return [neighbor for neighbors in response for neighbor in neighbors]
 
-    filters = [Namespace(config.FILTER_CATEGORIES[i],[f]) for i,f in enumerate(filters)]
-    response = index_endpoint.find_neighbors(
-        deployed_index_id=config.DEPLOYED_INDEX,
-        queries=embeds,
-        num_neighbors=num_neighbors,
-        filter=filters
-    )
-    return [Neighbor(r.id, r.distance) for neighbor in response for r in neighbor]
+@metrics.timed('nearest_neighbors')
+async def get_nn_async(
+    embeds: list[list[float]], 
+    filters: list[str] = [], 
+    num_neighbors: int = config.NUM_NEIGHBORS) -> list[Neighbor]:
+    """Async version of get_nn()."""
+    if config.BATCHING_ENABLED:
+        response = await asyncio.wrap_future(
+            get_batcher().submit((embeds, tuple(filters), num_neighbors)))
+    else:
+        response = await find_neighbors_async(embeds, filters, num_neighbors)
+    return [neighbor for neighbors in response for neighbor in neighbors]
+
+@metrics.timed('nearest_neighbors_batch')
+async def get_nn_batch_async(
+    embeds: list[list[list[float]]],
+    filters: list[str] = [],
+    num_neighbors: int = config.NUM_NEIGHBORS) -> list[list[Neighbor]]:
+    """get_nn_async() for many products with a single index call.
+
+    Args:
+        embeds: one list of embeddings per product
+        filters: category prefix to restrict results of all products to
+        num_neigbhors: number of nearest neighbors to return for EACH embedding
+
+    Returns:
+        One list of neighbors per product, as returned by get_nn()
+    """
+    response = await find_neighbors_async([q for e in embeds for q in e], filters, num_neighbors)
+    return [[neighbor for neighbors in group for neighbor in neighbors]
+            for group in _split(response, [len(e) for e in embeds])]
@@ -23,7 +23,10 @@ in config.py
 https://cloud.google.com/vertex-ai/docs/vector-search/overview
 """
 import logging; logging.basicConfig(level=logging.INFO)
+from concurrent.futures import ThreadPoolExecutor
 import unittest
+from unittest import mock
+import local_index
 import nearest_neighbors
 import config
 
@@ -49,5 +52,29 @@ class NearestNeighborsTest(unittest.TestCase):
     self.assertEqual(len(res), len(embeds) * num_neigbhors)
     self.assertEqual(res[0]._fields, ('id','distance'))
 
+class LocalNearestNeighborsTest(unittest.TestCase):
+  """Offline tests of get_nn against an in-process index."""
+
+  def setUp(self):
+    records = [
+      {'id': f'{i}_T', 'embedding': [i, 1, 0], 'L0': 'A' if i % 2 else 'B'}
+      for i in range(10)]
+    index = local_index.ExactIndex(local_index.Datapoints.from_records(records))
+    mock.patch.object(nearest_neighbors, 'get_index', return_value=index).start()
+    self.addCleanup(mock.patch.stopall)
+
+  def test_nn_with_filter(self):
+    res = nearest_neighbors.get_nn([[1, 1, 0], [3, 1, 0]], ['A'], 2)
+    self.assertEqual(len(res), 4)
+    self.assertEqual(res[0]._fields, ('id','distance'))
+    self.assertEqual(res[0].id, '1_T')
+
+  def test_nn_batched(self):
+    mock.patch.object(config, 'BATCHING_ENABLED', True).start()
+    args = [([[i, 1, 0]], ['A'] if i % 2 else [], 1) for i in range(8)]
+    with ThreadPoolExecutor(8) as pool:
+      res = list(pool.map(lambda a: nearest_neighbors.get_nn(*a), args))
+    self.assertEqual(res, [nearest_neighbors.find_neighbors(*a)[0] for a in args])
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -0,0 +1,153 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Semantic cache of nearest neighbor results.
+
+Near-duplicate products, e.g. the same kurta in another color, have almost
+identical embeddings and therefore the same neighbors. Each query embedding
+is hashed with SimHash, the signs of random projections, a locality
+sensitive hash under which vectors of high cosine similarity likely
+collide. Several independent hash tables raise the chance that a near
+duplicate collides in at least one of them.
+
+The bucket key also includes the category filters and number of neighbors,
+so only searches with the same restricts can share results. A collision is
+only a candidate: a cached result is reused if the cosine similarity of its
+query to the new one is at least min_similarity.
+
+Every entry belongs to an index version, see
+nearest_neighbors.index_version(). A lookup or insert with a different
+version empties the cache.
+"""
+from collections import OrderedDict
+import itertools
+import threading
+from typing import Hashable, Optional
+
+import numpy as np
+
+import local_index
+
+
+class NeighborCache:
+    """LRU cache of neighbor lists keyed by query similarity.
+
+    Args:
+        tables: number of independent hash tables
+        bits: random projections per table. More bits make buckets smaller,
+            fewer make more near duplicates collide
+        min_similarity: min cosine similarity of a cached query to reuse its
+            neighbors
+        max_entries: evict least recently used entries beyond this
+        bucket_size: max entries per bucket, the oldest are dropped from the
+            bucket, bounding the cost of verification
+        seed: seed of the random projections
+    """
+    def __init__(
+        self,
+        tables: int = 4,
+        bits: int = 12,
+        min_similarity: float = 0.97,
+        max_entries: int = 10000,
+        bucket_size: int = 8,
+        seed: int = 0):
+        self.tables = tables
+        self.bits = bits
+        self.min_similarity = min_similarity
+        self.max_entries = max_entries
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.version = None
+        self._planes = None # (tables * bits, dimensions), created on first use
+        self._powers = 1 << np.arange(bits, dtype=np.int64)
+        self._entries = OrderedDict() # id -> (vector, neighbors, bucket keys)
+        self._buckets = {} # bucket key -> list of entry ids, oldest first
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'rejected': 0, 'invalidations': 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _keys(self, vector: np.ndarray, scope: Hashable) -> list[tuple]:
+        if self._planes is None or self._planes.shape[1] != len(vector):
+            rng = np.random.default_rng(self.seed)
+            self._planes = rng.standard_normal((self.tables * self.bits, len(vector))).astype(np.float32)
+        signs = (self._planes @ vector > 0).reshape(self.tables, self.bits)
+        return [(table, int(code), scope) for table, code in enumerate(signs @ self._powers)]
+
+    def _check_version(self, version: Hashable):
+        if version != self.version:
+            if self._entries:
+                self._stats['invalidations'] += 1
+            self._entries.clear()
+            self._buckets.clear()
+            self.version = version
+
+    def get(self, query: list[float], scope: Hashable, version: Hashable) -> Optional[list]:
+        """Neighbors of the most similar cached query, or None.
+
+        Args:
+            query: query embedding
+            scope: filters and number of neighbors, only entries of the same
+                scope are considered
+            version: current index version
+        """
+        vector = local_index.normalize(query)[0]
+        with self._lock:
+            self._check_version(version)
+            ids = {id for key in self._keys(vector, scope) for id in self._buckets.get(key, ())}
+            if not ids:
+                self._stats['misses'] += 1
+                return None
+            ids = list(ids)
+            similarities = np.stack([self._entries[id][0] for id in ids]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.min_similarity:
+                self._stats['misses'] += 1
+                self._stats['rejected'] += 1
+                return None
+            self._stats['hits'] += 1
+            self._entries.move_to_end(ids[best])
+            return self._entries[ids[best]][1]
+
+    def put(self, query: list[float], scope: Hashable, version: Hashable, neighbors: list):
+        """Cache the neighbors of a query, see get()."""
+        vector = local_index.normalize(query)[0]
+        with self._lock:
+            self._check_version(version)
+            id = next(self._ids)
+            keys = self._keys(vector, scope)
+            self._entries[id] = (vector, neighbors, keys)
+            for key in keys:
+                bucket = self._buckets.setdefault(key, [])
+                bucket.append(id)
+                if len(bucket) > self.bucket_size:
+                    self._remove(bucket[0])
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, id: int):
+        _, _, keys = self._entries.pop(id)
+        for key in keys:
+            bucket = self._buckets[key]
+            bucket.remove(id)
+            if not bucket:
+                del self._buckets[key]
+
+    def stats(self) -> dict[str, float]:
+        """Hit, miss and invalidation counters. Misses include rejected
+        candidates, hash collisions below min_similarity."""
+        with self._lock:
+            return {**self._stats, 'entries': len(self._entries)}
@@ -0,0 +1,171 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Neighbor Cache Unit Tests.
+
+These tests run fully offline on random vectors and the fakes of fakes.py.
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import config
+import fakes
+import local_index
+import nearest_neighbors
+import neighbor_cache
+
+DIMENSIONS = 1408
+SCOPE = (('Clothing',), 7)
+
+def _unit(rng: np.random.Generator) -> np.ndarray:
+  v = rng.standard_normal(DIMENSIONS)
+  return v / np.linalg.norm(v)
+
+def _near(v: np.ndarray, similarity: float, rng: np.random.Generator) -> np.ndarray:
+  """A unit vector with the given cosine similarity to unit vector v."""
+  noise = _unit(rng)
+  noise -= noise.dot(v) * v
+  noise /= np.linalg.norm(noise)
+  return similarity * v + np.sqrt(1 - similarity**2) * noise
+
+class NeighborCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.rng = np.random.default_rng(0)
+
+  def test_near_duplicates_hit(self):
+    cache = neighbor_cache.NeighborCache(max_entries=1000)
+    queries = [_unit(self.rng) for _ in range(200)]
+    for i, q in enumerate(queries):
+      cache.put(q.tolist(), SCOPE, 1, [i])
+    hits = [cache.get(_near(q, 0.99, self.rng).tolist(), SCOPE, 1) for q in queries]
+    self.assertGreater(sum(h is not None for h in hits) / len(hits), 0.9)
+    self.assertTrue(all(h == [i] for i, h in enumerate(hits) if h is not None))
+
+  def test_dissimilar_collision_rejected(self):
+    cache = neighbor_cache.NeighborCache(tables=1, bits=0) # every query collides
+    q = _unit(self.rng)
+    cache.put(q.tolist(), SCOPE, 1, ['a'])
+    self.assertIsNone(cache.get(_near(q, 0.9, self.rng).tolist(), SCOPE, 1))
+    self.assertEqual(cache.get(_near(q, 0.98, self.rng).tolist(), SCOPE, 1), ['a'])
+    self.assertEqual(cache.stats()['rejected'], 1)
+    self.assertEqual(cache.stats()['hits'], 1)
+
+  def test_scope(self):
+    cache = neighbor_cache.NeighborCache()
+    q = _unit(self.rng).tolist()
+    cache.put(q, SCOPE, 1, ['a'])
+    self.assertIsNone(cache.get(q, (('Footwear',), 7), 1))
+    self.assertIsNone(cache.get(q, (('Clothing',), 3), 1))
+    self.assertEqual(cache.get(q, SCOPE, 1), ['a'])
+
+  def test_version_change_invalidates(self):
+    cache = neighbor_cache.NeighborCache()
+    q = _unit(self.rng).tolist()
+    cache.put(q, SCOPE, 1, ['a'])
+    self.assertIsNone(cache.get(q, SCOPE, 2))
+    self.assertEqual(len(cache), 0)
+    self.assertEqual(cache.stats()['invalidations'], 1)
+
+  def test_bounded(self):
+    cache = neighbor_cache.NeighborCache(tables=1, bits=0, max_entries=10, bucket_size=4)
+    for i in range(20):
+      cache.put(_unit(self.rng).tolist(), SCOPE, 1, [i])
+    self.assertEqual(len(cache), 4)
+    cache = neighbor_cache.NeighborCache(max_entries=10)
+    for i in range(20):
+      cache.put(_unit(self.rng).tolist(), SCOPE, 1, [i])
+    self.assertEqual(len(cache), 10)
+    self.assertLessEqual(sum(len(b) for b in cache._buckets.values()), 10 * cache.tables)
+
+class FindNeighborsCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.catalog = fakes.Catalog(200)
+    self.fakes = fakes.installed(self.catalog)
+    self.f = self.fakes.__enter__()
+    self.addCleanup(self.fakes.__exit__, None, None, None)
+    mock.patch.object(config, 'NEIGHBOR_CACHE_ENABLED', True).start()
+    self.addCleanup(mock.patch.stopall)
+    nearest_neighbors.get_cache.cache_clear()
+    self.addCleanup(nearest_neighbors.get_cache.cache_clear)
+    self.search = mock.patch.object(
+      self.f.index, 'find_neighbors', wraps=self.f.index.find_neighbors).start()
+
+  def test_near_duplicate_skips_index(self):
+    rng = np.random.default_rng(1)
+    q = np.asarray(self.catalog.embed('kurta', 0))
+    q /= np.linalg.norm(q)
+    first = nearest_neighbors.find_neighbors([q.tolist()])
+    second = nearest_neighbors.find_neighbors([_near(q, 0.995, rng).tolist(), _unit(rng).tolist()])
+    self.assertEqual(second[0], first[0])
+    self.assertEqual(self.search.call_count, 2)
+    self.assertEqual(len(self.search.call_args.kwargs['queries']), 1) # only the miss
+    self.assertEqual(nearest_neighbors.cache_stats()['hits'], 1)
+
+  def test_index_update_invalidates(self):
+    q = self.catalog.embed('kurta', 0)
+    nearest_neighbors.find_neighbors([q])
+    self.f.index.remove_datapoints([self.catalog.datapoints()[0]['id']])
+    nearest_neighbors.find_neighbors([q])
+    self.assertEqual(self.search.call_count, 2)
+
+  def test_saved_index_reloaded_under_warm_cache(self):
+    tmp = tempfile.TemporaryDirectory()
+    self.addCleanup(tmp.cleanup)
+    path = os.path.join(tmp.name, 'index')
+    self.f.index.save(path)
+    served = local_index.ExactIndex.load(path)
+    mock.patch.object(nearest_neighbors, 'get_index', return_value=served).start()
+    mock.patch.object(config, 'LOCAL_INDEX_RELOAD_SECONDS', 0).start()
+    q = self.catalog.embed('kurta', 0)
+    first = nearest_neighbors.find_neighbors([q])
+    self.assertEqual(nearest_neighbors.find_neighbors([q]), first)
+    self.assertEqual(nearest_neighbors.cache_stats()['hits'], 1)
+
+    updated = local_index.ExactIndex.load(path) # e.g. index_sync.py in another process
+    updated.remove_datapoints([first[0][0].id])
+    updated.save()
+    second = nearest_neighbors.find_neighbors([q])
+    self.assertNotIn(first[0][0].id, [n.id for n in second[0]])
+    self.assertEqual(served.version, 1)
+
+class VertexIndexVersionTest(unittest.TestCase):
+
+  def setUp(self):
+    endpoint = mock.Mock(spec=nearest_neighbors.aiplatform.MatchingEngineIndexEndpoint)
+    mock.patch.object(nearest_neighbors, 'get_index', return_value=endpoint).start()
+    self.update_time = mock.patch.object(nearest_neighbors, '_vertex_index_update_time', return_value='t1').start()
+    mock.patch.dict(nearest_neighbors._vertex_version, {'value': None, 'checked': None}).start()
+    self.addCleanup(mock.patch.stopall)
+
+  def test_polled_every_interval(self):
+    with mock.patch.object(config, 'NEIGHBOR_CACHE_VERSION_SECONDS', 60):
+      self.assertEqual(nearest_neighbors.index_version(), 't1')
+      self.update_time.return_value = 't2'
+      self.assertEqual(nearest_neighbors.index_version(), 't1')
+    with mock.patch.object(config, 'NEIGHBOR_CACHE_VERSION_SECONDS', 0):
+      self.assertEqual(nearest_neighbors.index_version(), 't2')
+    self.assertEqual(self.update_time.call_count, 2)
+
+  def test_unknown_version_bypasses_cache(self):
+    self.update_time.side_effect = RuntimeError('permission denied')
+    self.assertIsNone(nearest_neighbors.index_version())
+
+if __name__ == '__main__':
+  unittest.main()
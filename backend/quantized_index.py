@@ -0,0 +1,360 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Nearest neighbor search over quantized embeddings with exact re-ranking.
+
+Candidates are generated from compressed codes held in memory:
+
+- int8: scalar quantization, one byte per dimension (4x smaller than float32)
+- pq: product quantization, one byte per subspace of
+  config.PQ_SUBSPACES dimensions (e.g. 88 bytes for 1408 dims, 64x smaller)
+
+The best num_neighbors * config.QUANTIZED_RERANK_MULTIPLIER candidates are
+then re-scored exactly against the full precision embeddings, which are
+memory-mapped from disk so only the rows being re-ranked are paged in.
+
+Build an index from the data_prep_with_restricts JSONL, and compare the
+recall, latency and memory of each setting against exact search, with:
+
+    python quantized_index.py build sample.json quantized_index/ --method pq
+    python quantized_index.py benchmark sample.json
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import numpy as np
+from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import MatchNeighbor, Namespace
+
+import config
+import local_index
+
+
+class ScalarQuantizer:
+    """Symmetric int8 quantization with one scale per dimension."""
+    method = 'int8'
+    chunk_rows = 1024 # codes decoded to float32 at a time, small enough to stay in cache
+
+    def __init__(self, scale: np.ndarray):
+        self.scale = scale
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, **kwargs) -> 'ScalarQuantizer':
+        scale = np.abs(vectors).max(axis=0) / 127
+        scale[scale == 0] = 1.0
+        return cls(scale.astype(np.float32))
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+    def prepare(self, queries: np.ndarray) -> np.ndarray:
+        """Query side of scores(), computed once per search."""
+        return queries * self.scale
+
+    def scores(self, prepared: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """Approximate dot products of shape (len(queries), len(codes))."""
+        return prepared @ codes.astype(np.float32).T
+
+    def params(self) -> dict[str, np.ndarray]:
+        return {'scale': self.scale}
+
+
+def _kmeans(x: np.ndarray, k: int, iters: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+    for _ in range(iters):
+        dists = (x**2).sum(1, keepdims=True) - 2 * x @ centroids.T + (centroids**2).sum(1)
+        assign = dists.argmin(axis=1)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), empty.sum())] # reseed dead centroids
+    return centroids
+
+
+class ProductQuantizer:
+    """Splits vectors into subspaces, each encoded as one of 256 centroids.
+
+    Dot products are estimated with asymmetric distance computation: the
+    query stays in full precision and is compared to each subspace's
+    centroids once, then scores are sums of table lookups.
+    """
+    method = 'pq'
+    chunk_rows = 16384
+
+    def __init__(self, centroids: np.ndarray):
+        self.centroids = centroids # (subspaces, 256, subspace dims)
+
+    @property
+    def subspaces(self) -> int:
+        return self.centroids.shape[0]
+
+    @classmethod
+    def train(
+        cls,
+        vectors: np.ndarray,
+        subspaces: int = config.PQ_SUBSPACES,
+        sample: int = 20000,
+        iters: int = 20,
+        seed: int = 0) -> 'ProductQuantizer':
+        if vectors.shape[1] % subspaces:
+            raise ValueError(f'{vectors.shape[1]} dimensions are not divisible into {subspaces} subspaces')
+        rng = np.random.default_rng(seed)
+        if len(vectors) > sample:
+            vectors = vectors[np.sort(rng.choice(len(vectors), sample, replace=False))]
+        vectors = np.asarray(vectors, dtype=np.float32)
+        split = np.split(vectors, subspaces, axis=1)
+        return cls(np.stack([_kmeans(s, 256, iters, rng) for s in split]))
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        for m, sub in enumerate(np.split(np.asarray(vectors, dtype=np.float32), self.subspaces, axis=1)):
+            c = self.centroids[m]
+            codes[:, m] = ((c**2).sum(1) - 2 * sub @ c.T).argmin(axis=1)
+        return codes
+
+    def prepare(self, queries: np.ndarray) -> np.ndarray:
+        """Lookup tables of shape (len(queries), subspaces, 256) holding the dot
+        product of each query subvector with each centroid."""
+        subs = np.split(queries, self.subspaces, axis=1)
+        return np.stack([s @ c.T for s, c in zip(subs, self.centroids)], axis=1)
+
+    def scores(self, prepared: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """Approximate dot products of shape (len(queries), len(codes))."""
+        scores = np.zeros((len(prepared), len(codes)), dtype=np.float32)
+        for q, tables in enumerate(prepared):
+            for m, table in enumerate(tables):
+                scores[q] += table[codes[:, m]]
+        return scores
+
+    def params(self) -> dict[str, np.ndarray]:
+        return {'centroids': self.centroids}
+
+
+QUANTIZERS = {q.method: q for q in (ScalarQuantizer, ProductQuantizer)}
+
+
+class QuantizedIndex:
+    """Quantized candidate generation followed by exact re-ranking.
+
+    Exposes the same find_neighbors() signature as
+    aiplatform.MatchingEngineIndexEndpoint so it can be swapped in by
+    nearest_neighbors.get_index().
+
+    Args:
+        datapoints: datapoints with full precision, normalized embeddings.
+            Only rows being re-ranked are read
+        quantizer: trained ScalarQuantizer or ProductQuantizer
+        codes: quantized embeddings, encoded from datapoints if None
+        rerank_multiplier: candidates re-ranked per neighbor returned, 0 to
+            return quantized scores without re-ranking
+    """
+    def __init__(
+        self,
+        datapoints: local_index.Datapoints,
+        quantizer,
+        codes: Optional[np.ndarray] = None,
+        rerank_multiplier: int = config.QUANTIZED_RERANK_MULTIPLIER):
+        self.datapoints = datapoints
+        self.quantizer = quantizer
+        self.rerank_multiplier = rerank_multiplier
+        if codes is None:
+            codes = np.concatenate([
+                quantizer.encode(datapoints.embeddings[i:i + quantizer.chunk_rows])
+                for i in range(0, len(datapoints), quantizer.chunk_rows)])
+        self.codes = codes
+
+    @classmethod
+    def build(cls, datapoints: local_index.Datapoints, method: str = 'int8', **kwargs) -> 'QuantizedIndex':
+        """Train a quantizer on the datapoints and encode them."""
+        rerank_multiplier = kwargs.pop('rerank_multiplier', config.QUANTIZED_RERANK_MULTIPLIER)
+        quantizer = QUANTIZERS[method].train(datapoints.embeddings, **kwargs)
+        return cls(datapoints, quantizer, rerank_multiplier=rerank_multiplier)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held for candidate generation: codes and quantizer params."""
+        return self.codes.nbytes + sum(p.nbytes for p in self.quantizer.params().values())
+
+    def _approx_scores(self, queries: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        n = len(self.codes) if rows is None else len(rows)
+        chunk = self.quantizer.chunk_rows
+        prepared = self.quantizer.prepare(queries)
+        scores = np.empty((len(queries), n), dtype=np.float32)
+        for i in range(0, n, chunk):
+            codes = self.codes[i:i + chunk] if rows is None else self.codes[rows[i:i + chunk]]
+            scores[:, i:i + chunk] = self.quantizer.scores(prepared, codes)
+        return scores
+
+    def find_neighbors(
+        self,
+        *,
+        queries: list[list[float]],
+        num_neighbors: int = 10,
+        filter: Optional[list[Namespace]] = [],
+        deployed_index_id: Optional[str] = None) -> list[list[MatchNeighbor]]:
+        """Find approximate nearest neighbors by cosine distance.
+
+        Args:
+            queries: list of query embeddings
+            num_neighbors: number of neighbors to return for EACH query
+            filter: list of Namespace restricts, ANDed together
+            deployed_index_id: ignored, accepted for API compatibility
+
+        Returns:
+            One list of MatchNeighbor per query, closest first. Distance is
+            the cosine distance i.e. 1 - cosine similarity
+        """
+        if not queries or not len(self.datapoints):
+            return [[] for _ in queries]
+        queries = local_index.normalize(np.asarray(queries, dtype=np.float32))
+        mask = self.datapoints.filter_mask(filter)
+        rows = None
+        if mask is not None:
+            rows = np.flatnonzero(mask)
+            if not len(rows):
+                return [[] for _ in queries]
+        shortlist = num_neighbors * self.rerank_multiplier or num_neighbors
+        idx, sims = local_index.top_k(self._approx_scores(queries, rows), shortlist)
+        if rows is not None:
+            idx = rows[idx]
+        ids = self.datapoints.ids
+        res = []
+        for query, candidates, approx in zip(queries, idx, sims):
+            if self.rerank_multiplier:
+                candidates = np.sort(candidates) # read the memory map in order
+                exact = self.datapoints.embeddings[candidates] @ query
+                top, approx = local_index.top_k(exact[None, :], num_neighbors)
+                candidates, approx = candidates[top[0]], approx[0]
+            res.append([MatchNeighbor(ids[i], float(1.0 - s))
+                        for i, s in zip(candidates[:num_neighbors], approx[:num_neighbors])])
+        return res
+
+    def save(self, path: str):
+        """Write the index to a directory of .npy files.
+
+        Full precision datapoints are written alongside the codes so an index
+        directory can also be loaded by local_index.ExactIndex.
+        """
+        self.datapoints.save(path)
+        np.save(os.path.join(path, 'codes_quantized.npy'), self.codes)
+        np.savez(os.path.join(path, 'quantizer.npz'), **self.quantizer.params())
+        with open(os.path.join(path, 'quantized.json'), 'w') as f:
+            json.dump({'method': self.quantizer.method}, f)
+
+    @classmethod
+    def load(cls, path: str, rerank_multiplier: int = config.QUANTIZED_RERANK_MULTIPLIER) -> 'QuantizedIndex':
+        """Load an index written by save().
+
+        Codes are read into memory, full precision embeddings are
+        memory-mapped.
+        """
+        with open(os.path.join(path, 'quantized.json')) as f:
+            meta = json.load(f)
+        with np.load(os.path.join(path, 'quantizer.npz')) as params:
+            quantizer = QUANTIZERS[meta['method']](**params)
+        return cls(
+            local_index.Datapoints.load(path),
+            quantizer,
+            np.load(os.path.join(path, 'codes_quantized.npy')),
+            rerank_multiplier)
+
+
+def benchmark(
+    datapoints: local_index.Datapoints,
+    num_queries: int = 200,
+    num_neighbors: int = config.NUM_NEIGHBORS,
+    settings: Optional[list[dict]] = None,
+    seed: int = 0) -> list[dict]:
+    """Recall, latency and memory of quantized settings relative to exact search.
+
+    Queries are datapoints with a little noise added, so each has close but
+    not identical neighbors.
+
+    Args:
+        datapoints: datapoints to index
+        num_queries: number of queries to run
+        num_neighbors: neighbors per query, recall is measured at this k
+        settings: list of dicts with method, rerank_multiplier and for pq
+            subspaces. Defaults to int8 and pq with and without re-ranking
+
+    Returns:
+        one dict per setting (exact search first) with recall, ms_per_query,
+        bytes and compression (float32 bytes / bytes)
+    """
+    if settings is None:
+        settings = [{'method': m, 'rerank_multiplier': r} for m in ('int8', 'pq') for r in (0, 4, 10)]
+    rng = np.random.default_rng(seed)
+    sample = datapoints.embeddings[rng.choice(len(datapoints), num_queries)]
+    queries = (sample + rng.normal(scale=0.01, size=sample.shape)).tolist()
+
+    def run(index):
+        start = time.perf_counter()
+        res = [index.find_neighbors(queries=[q], num_neighbors=num_neighbors)[0] for q in queries]
+        return res, (time.perf_counter() - start) * 1000 / num_queries
+
+    exact, exact_ms = run(local_index.ExactIndex(datapoints))
+    float_bytes = datapoints.embeddings.nbytes
+    report = [{'method': 'float32', 'rerank_multiplier': 0, 'recall': 1.0,
+               'ms_per_query': exact_ms, 'bytes': float_bytes, 'compression': 1.0}]
+    built = {}
+    for setting in settings:
+        setting = dict(setting)
+        rerank_multiplier = setting.pop('rerank_multiplier', config.QUANTIZED_RERANK_MULTIPLIER)
+        key = json.dumps(setting, sort_keys=True)
+        if key not in built:
+            built[key] = QuantizedIndex.build(datapoints, **setting)
+        index = built[key]
+        index.rerank_multiplier = rerank_multiplier
+        res, ms = run(index)
+        recall = np.mean([len({n.id for n in r} & {n.id for n in e}) / max(len(e), 1) for r, e in zip(res, exact)])
+        report.append({**setting, 'rerank_multiplier': rerank_multiplier, 'recall': float(recall),
+                       'ms_per_query': ms, 'bytes': index.nbytes, 'compression': float_bytes / index.nbytes})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or benchmark a quantized index.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='build an index from JSONL datapoints')
+    build.add_argument('input', help='JSONL file of id, embedding and category restricts')
+    build.add_argument('output', help='directory to write the index to')
+    build.add_argument('--method', choices=sorted(QUANTIZERS), default='int8')
+    build.add_argument('--subspaces', type=int, default=config.PQ_SUBSPACES, help='pq only')
+    bench = subparsers.add_parser('benchmark', help='report recall, latency and memory per setting')
+    bench.add_argument('input', help='JSONL file or index directory of datapoints')
+    bench.add_argument('--queries', type=int, default=200)
+    bench.add_argument('--num_neighbors', type=int, default=config.NUM_NEIGHBORS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'build':
+        kwargs = {'subspaces': args.subspaces} if args.method == 'pq' else {}
+        index = QuantizedIndex.build(local_index.Datapoints.from_jsonl(args.input), args.method, **kwargs)
+        index.save(args.output)
+        logging.info(f'Wrote {args.method} index of {index.nbytes / 1024**2:.1f} MiB to {args.output}')
+    else:
+        report = benchmark(local_index.load_datapoints(args.input), args.queries, args.num_neighbors)
+        print(f"{'method':>8} {'rerank':>6} {'recall':>7} {'ms/query':>9} {'MiB':>9} {'compression':>11}")
+        for r in report:
+            print(f"{r['method']:>8} {r['rerank_multiplier']:>6} {r['recall']:>7.3f} "
+                  f"{r['ms_per_query']:>9.2f} {r['bytes'] / 1024**2:>9.1f} {r['compression']:>10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
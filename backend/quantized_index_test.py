@@ -0,0 +1,89 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Quantized Index Unit Tests.
+
+These tests run fully offline against a small synthetic index and compare
+results to the exact local index.
+"""
+import tempfile
+import unittest
+
+import numpy as np
+from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace
+
+import local_index
+import quantized_index
+
+def recall(approx, exact):
+  hits = [len({n.id for n in a} & {n.id for n in e}) / len(e) for a, e in zip(approx, exact)]
+  return sum(hits) / len(hits)
+
+class QuantizedIndexTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(20, 32))
+    vectors = centers[rng.integers(0, 20, 1000)] + rng.normal(scale=0.3, size=(1000, 32))
+    records = [
+      {'id': f'{i}_T', 'embedding': v.tolist(), 'L0': 'A' if i % 4 else 'B'}
+      for i, v in enumerate(vectors)]
+    cls.datapoints = local_index.Datapoints.from_records(records)
+    cls.exact = local_index.ExactIndex(cls.datapoints)
+    cls.queries = (vectors[:20] + rng.normal(scale=0.1, size=(20, 32))).tolist()
+    cls.expected = cls.exact.find_neighbors(queries=cls.queries, num_neighbors=5)
+
+  def test_int8(self):
+    index = quantized_index.QuantizedIndex.build(self.datapoints, 'int8', rerank_multiplier=0)
+    self.assertEqual(index.codes.dtype, np.int8)
+    res = index.find_neighbors(queries=self.queries, num_neighbors=5)
+    self.assertGreaterEqual(recall(res, self.expected), 0.9)
+
+  def test_pq_with_rerank(self):
+    index = quantized_index.QuantizedIndex.build(self.datapoints, 'pq', subspaces=8, rerank_multiplier=10)
+    self.assertEqual(index.codes.shape, (1000, 8))
+    res = index.find_neighbors(queries=self.queries, num_neighbors=5)
+    self.assertGreaterEqual(recall(res, self.expected), 0.9)
+    # re-ranked distances are exact
+    self.assertAlmostEqual(res[0][0].distance, self.expected[0][0].distance, places=5)
+
+  def test_filter(self):
+    index = quantized_index.QuantizedIndex.build(self.datapoints, 'int8')
+    filters = [Namespace('L0', ['B'])]
+    res = index.find_neighbors(queries=self.queries, num_neighbors=5, filter=filters)
+    self.assertTrue(all(int(n.id[:-2]) % 4 == 0 for neighbors in res for n in neighbors))
+    exact = self.exact.find_neighbors(queries=self.queries, num_neighbors=5, filter=filters)
+    self.assertGreaterEqual(recall(res, exact), 0.9)
+
+  def test_save_and_load(self):
+    index = quantized_index.QuantizedIndex.build(self.datapoints, 'pq', subspaces=8)
+    with tempfile.TemporaryDirectory() as d:
+      index.save(d)
+      loaded = quantized_index.QuantizedIndex.load(d)
+      self.assertIsInstance(loaded.datapoints.embeddings, np.memmap)
+      res = loaded.find_neighbors(queries=self.queries, num_neighbors=5)
+    expected = index.find_neighbors(queries=self.queries, num_neighbors=5)
+    self.assertEqual([[n.id for n in r] for r in res], [[n.id for n in r] for r in expected])
+
+  def test_benchmark(self):
+    report = quantized_index.benchmark(
+      self.datapoints, num_queries=10, num_neighbors=5,
+      settings=[{'method': 'int8', 'rerank_multiplier': 4}, {'method': 'pq', 'subspaces': 8, 'rerank_multiplier': 4}])
+    self.assertEqual([r['method'] for r in report], ['float32', 'int8', 'pq'])
+    self.assertAlmostEqual(report[1]['compression'], 4.0, delta=0.5)
+    self.assertGreater(report[2]['compression'], 1.0)
+
+if __name__ == '__main__':
+  unittest.main()
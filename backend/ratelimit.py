@@ -0,0 +1,343 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client-side rate limiting and retries for Vertex AI quotas.
+
+Each upstream (embedding, vector search, LLM) gets an Upstream controller
+combining:
+
+- a token bucket capping the request rate at the quota
+- a concurrency limit adjusted by additive increase / multiplicative decrease
+  (AIMD): +1 per limit's worth of successful calls, halved once per
+  throttling episode
+- retries of throttling and transient errors with exponential backoff and
+  full jitter, within an overall deadline
+
+Callers over the rate or concurrency limit wait in FIFO order instead of
+failing, so traffic spikes turn into queueing delay. Only calls that cannot
+complete within the deadline raise. Sync and async callers share the same
+limits.
+"""
+import asyncio
+from collections import deque
+from functools import cache
+import logging
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from google.api_core import exceptions
+
+import config
+import metrics
+
+THROTTLE_ERRORS = (exceptions.TooManyRequests, exceptions.ResourceExhausted)
+RETRYABLE_ERRORS = THROTTLE_ERRORS + (
+    exceptions.ServiceUnavailable,
+    exceptions.InternalServerError,
+    exceptions.Aborted,
+    exceptions.DeadlineExceeded,
+)
+
+
+class QueueTimeout(TimeoutError):
+    """A call could not be admitted before its deadline."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket.
+
+    Tokens are reserved ahead of time, so the bucket can go negative and each
+    caller learns how long to wait for its token. This makes waiting callers
+    FIFO without a separate queue.
+
+    Args:
+        rate: tokens added per second
+        burst: bucket capacity
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, deadline: Optional[float] = None) -> float:
+        """Take a token, returning the delay in seconds before it may be used.
+
+        Raises:
+            QueueTimeout if the token would only be available after deadline
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            delay = max(0.0, (1 - self._tokens) / self.rate)
+            if deadline is not None and now + delay > deadline:
+                raise QueueTimeout(f'rate limit wait of {delay:.1f}s exceeds deadline')
+            self._tokens -= 1
+            return delay
+
+
+class _Waiter:
+    def __init__(self, wake: Callable[[], None]):
+        self.wake = wake
+        self.granted = False
+        self.epoch = None
+
+
+class AIMDLimiter:
+    """Concurrency limit adapted with additive increase / multiplicative decrease.
+
+    A burst of throttled calls is one congestion signal, so the limit is only
+    decreased by calls admitted after the last decrease, like TCP ignores
+    losses of packets sent before it shrank its window. acquire() returns
+    the epoch a call was admitted in, to be passed back to release().
+
+    Args:
+        initial: starting limit
+        minimum: the limit never drops below this
+        maximum: the limit never grows above this
+        decrease: factor applied to the limit on throttling
+    """
+    def __init__(self, initial: float, minimum: float = 1, maximum: float = 64, decrease: float = 0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        self.epoch = 0 # incremented by every decrease
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _try_acquire(self, waiter: _Waiter) -> bool:
+        # under lock
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return True
+        self._waiters.append(waiter)
+        return False
+
+    def _cancel(self, waiter: _Waiter) -> bool:
+        """Withdraw a waiter that timed out.
+
+        Returns:
+            True if it was granted a slot concurrently and now holds it
+        """
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+            return waiter.granted
+
+    def _grant(self):
+        # under lock
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+            waiter.epoch = self.epoch
+            self.in_flight += 1
+            waiter.wake()
+
+    def acquire(self, deadline: Optional[float] = None) -> int:
+        """Block until a slot is free.
+
+        Returns:
+            the epoch the slot was granted in
+
+        Raises:
+            QueueTimeout if no slot was free before deadline
+        """
+        event = threading.Event()
+        waiter = _Waiter(event.set)
+        with self._lock:
+            if self._try_acquire(waiter):
+                return self.epoch
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not event.wait(timeout) and not self._cancel(waiter):
+            raise QueueTimeout('no concurrency slot before deadline')
+        return waiter.epoch
+
+    async def acquire_async(self, deadline: Optional[float] = None) -> int:
+        """Async version of acquire()."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+        waiter = _Waiter(wake)
+        with self._lock:
+            if self._try_acquire(waiter):
+                return self.epoch
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError as e:
+            if not self._cancel(waiter):
+                raise QueueTimeout('no concurrency slot before deadline') from e
+        except asyncio.CancelledError:
+            if self._cancel(waiter):
+                self.release()
+            raise
+        return waiter.epoch
+
+    def release(self, throttled: bool = False, epoch: Optional[int] = None):
+        """Free a slot, shrinking the limit if the call was throttled.
+
+        Args:
+            throttled: whether the call was throttled
+            epoch: returned by acquire(). Throttled calls admitted before the
+                last decrease don't decrease the limit again
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if throttled:
+                if epoch is None or epoch >= self.epoch:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.epoch += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._grant()
+
+
+class Upstream:
+    """Rate limit, concurrency limit and retry policy for one upstream API.
+
+    Args:
+        name: used in log messages
+        rate: max requests per second, None for no rate limit
+        burst: token bucket capacity, defaults to rate
+        max_concurrency: upper bound of the AIMD concurrency limit, also the
+            starting limit
+        deadline: seconds a call may spend queued and retrying in total
+        backoff: first retry delay cap in seconds, doubled per attempt
+        max_backoff: cap of the retry delay in seconds
+    """
+    def __init__(
+        self,
+        name: str,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        max_concurrency: int = 32,
+        deadline: float = config.RETRY_DEADLINE_SECONDS,
+        backoff: float = 0.1,
+        max_backoff: float = 10.0):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst or rate) if rate else None
+        self.limiter = AIMDLimiter(max_concurrency, maximum=max_concurrency)
+        self.deadline = deadline
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stats = {'calls': 0, 'throttled': 0, 'retries': 0, 'failed': 0}
+
+    def _retry_delay(self, error: Exception, attempt: int, deadline: float, epoch: int) -> Optional[float]:
+        """Delay before the next attempt, None if the error should be raised."""
+        throttled = isinstance(error, THROTTLE_ERRORS)
+        self.limiter.release(throttled, epoch)
+        if throttled:
+            self.stats['throttled'] += 1
+        if not isinstance(error, RETRYABLE_ERRORS):
+            return None
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        if time.monotonic() + delay >= deadline:
+            return None
+        self.stats['retries'] += 1
+        logging.warning(f'{self.name} call failed ({type(error).__name__}), retry {attempt + 1} in {delay:.2f}s')
+        return delay
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Call fn(*args, **kwargs) within the limits, retrying on throttling."""
+        self.stats['calls'] += 1
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            if self.bucket:
+                time.sleep(self.bucket.reserve(deadline))
+            epoch = self.limiter.acquire(deadline)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline, epoch)
+                if delay is None:
+                    self.stats['failed'] += 1
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.limiter.release()
+            return result
+
+    async def call_async(self, fn: Callable[..., Awaitable], *args, **kwargs) -> Any:
+        """Async version of call(), fn returns an awaitable."""
+        self.stats['calls'] += 1
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            if self.bucket:
+                await asyncio.sleep(self.bucket.reserve(deadline))
+            epoch = await self.limiter.acquire_async(deadline)
+            try:
+                result = await fn(*args, **kwargs)
+            except asyncio.CancelledError:
+                self.limiter.release()
+                raise
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline, epoch)
+                if delay is None:
+                    self.stats['failed'] += 1
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.limiter.release()
+            return result
+
+
+@cache
+def get_upstream(name: str) -> Upstream:
+    """Shared controller for an upstream configured in config.RATE_LIMITS."""
+    return Upstream(name, **config.RATE_LIMITS.get(name, {}))
+
+
+def _collect_stats() -> dict:
+    stats = {}
+    for name in config.RATE_LIMITS:
+        upstream = get_upstream(name)
+        stats.update({(name, k): v for k, v in upstream.stats.items()})
+        stats[(name, 'concurrency_limit')] = upstream.limiter.limit
+        stats[(name, 'in_flight')] = upstream.limiter.in_flight
+        stats[(name, 'queued')] = upstream.limiter.queued
+    return stats
+
+
+metrics.collected(
+    'catalog_upstream', 'Rate limiter counters and current limits, see Upstream.stats',
+    ('upstream', 'stat'), _collect_stats)
+
+
+def call(upstream: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Call fn through the named upstream's controller if enabled in config.py."""
+    if not config.RATE_LIMITING_ENABLED:
+        return fn(*args, **kwargs)
+    return get_upstream(upstream).call(fn, *args, **kwargs)
+
+
+async def call_async(upstream: str, fn: Callable[..., Awaitable], *args, **kwargs) -> Any:
+    """Async version of call()."""
+    if not config.RATE_LIMITING_ENABLED:
+        return await fn(*args, **kwargs)
+    return await get_upstream(upstream).call_async(fn, *args, **kwargs)
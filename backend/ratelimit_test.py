@@ -0,0 +1,192 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rate Limiting Unit Tests.
+
+These tests run fully offline.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import unittest
+
+from google.api_core import exceptions
+
+import ratelimit
+
+class TokenBucketTest(unittest.TestCase):
+
+  def test_burst_then_rate(self):
+    bucket = ratelimit.TokenBucket(rate=10, burst=2)
+    self.assertEqual(bucket.reserve(), 0)
+    self.assertEqual(bucket.reserve(), 0)
+    self.assertAlmostEqual(bucket.reserve(), 0.1, delta=0.01)
+    self.assertAlmostEqual(bucket.reserve(), 0.2, delta=0.01)
+
+  def test_deadline(self):
+    bucket = ratelimit.TokenBucket(rate=1, burst=1)
+    bucket.reserve()
+    with self.assertRaises(ratelimit.QueueTimeout):
+      bucket.reserve(deadline=time.monotonic() + 0.5)
+
+class AIMDLimiterTest(unittest.TestCase):
+
+  def test_decrease_and_increase(self):
+    limiter = ratelimit.AIMDLimiter(8, maximum=8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    self.assertEqual(limiter.limit, 4)
+    for _ in range(4):
+      limiter.acquire()
+      limiter.release()
+    self.assertAlmostEqual(limiter.limit, 5, delta=0.1)
+
+  def test_minimum(self):
+    limiter = ratelimit.AIMDLimiter(2, minimum=1)
+    for _ in range(5):
+      limiter.acquire()
+      limiter.release(throttled=True)
+    self.assertEqual(limiter.limit, 1)
+
+  def test_concurrent_throttles_decrease_once(self):
+    limiter = ratelimit.AIMDLimiter(8, maximum=8)
+    epochs = [limiter.acquire() for _ in range(8)]
+    for epoch in epochs:
+      limiter.release(throttled=True, epoch=epoch)
+    self.assertEqual(limiter.limit, 4)
+    limiter.release(throttled=True, epoch=limiter.acquire()) # admitted after the decrease
+    self.assertEqual(limiter.limit, 2)
+
+  def test_queued_call_admitted_after_decrease(self):
+    limiter = ratelimit.AIMDLimiter(2, maximum=2)
+    first, second = limiter.acquire(), limiter.acquire()
+    epochs = []
+    waiter = threading.Thread(target=lambda: epochs.append(limiter.acquire()))
+    waiter.start()
+    while not limiter.queued:
+      time.sleep(0.001)
+    limiter.release(throttled=True, epoch=first)
+    limiter.release(throttled=True, epoch=second)
+    waiter.join()
+    self.assertEqual(epochs, [1])
+    limiter.release(throttled=True, epoch=epochs[0])
+    self.assertEqual(limiter.limit, 1) # at the minimum
+    self.assertEqual(limiter.in_flight, 0)
+
+  def test_queues_fifo(self):
+    limiter = ratelimit.AIMDLimiter(1, maximum=1)
+    limiter.acquire()
+    order = []
+    def worker(i):
+      limiter.acquire()
+      order.append(i)
+      limiter.release()
+    threads = []
+    for i in range(3):
+      threads.append(threading.Thread(target=worker, args=(i,)))
+      threads[-1].start()
+      while limiter.queued < i + 1:
+        time.sleep(0.001)
+    limiter.release()
+    for t in threads:
+      t.join()
+    self.assertEqual(order, [0, 1, 2])
+    self.assertEqual(limiter.in_flight, 0)
+
+  def test_acquire_timeout(self):
+    limiter = ratelimit.AIMDLimiter(1, maximum=1)
+    limiter.acquire()
+    with self.assertRaises(ratelimit.QueueTimeout):
+      limiter.acquire(deadline=time.monotonic() + 0.05)
+    self.assertEqual(limiter.queued, 0)
+    limiter.release()
+    self.assertEqual(limiter.in_flight, 0)
+
+class UpstreamTest(unittest.TestCase):
+
+  def test_retries_throttling(self):
+    upstream = ratelimit.Upstream('test', max_concurrency=4, backoff=0.01)
+    attempts = []
+    def flaky():
+      attempts.append(1)
+      if len(attempts) < 3:
+        raise exceptions.ResourceExhausted('quota')
+      return 'ok'
+    self.assertEqual(upstream.call(flaky), 'ok')
+    self.assertEqual(len(attempts), 3)
+    self.assertEqual(upstream.stats['throttled'], 2)
+    self.assertEqual(upstream.limiter.in_flight, 0)
+    self.assertLess(upstream.limiter.limit, 4)
+
+  def test_does_not_retry_client_errors(self):
+    upstream = ratelimit.Upstream('test', backoff=0.01)
+    attempts = []
+    def invalid():
+      attempts.append(1)
+      raise exceptions.InvalidArgument('bad request')
+    with self.assertRaises(exceptions.InvalidArgument):
+      upstream.call(invalid)
+    self.assertEqual(len(attempts), 1)
+    self.assertEqual(upstream.limiter.in_flight, 0)
+
+  def test_gives_up_at_deadline(self):
+    upstream = ratelimit.Upstream('test', deadline=0.2, backoff=0.05)
+    def throttled():
+      raise exceptions.TooManyRequests('slow down')
+    start = time.monotonic()
+    with self.assertRaises(exceptions.TooManyRequests):
+      upstream.call(throttled)
+    self.assertLess(time.monotonic() - start, 0.3)
+    self.assertEqual(upstream.stats['failed'], 1)
+
+  def test_concurrency_limit(self):
+    upstream = ratelimit.Upstream('test', max_concurrency=2)
+    active, peak = [0], [0]
+    lock = threading.Lock()
+    def slow():
+      with lock:
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+      time.sleep(0.02)
+      with lock:
+        active[0] -= 1
+    with ThreadPoolExecutor(8) as pool:
+      list(pool.map(lambda _: upstream.call(slow), range(8)))
+    self.assertEqual(peak[0], 2)
+
+  def test_rate_limit(self):
+    upstream = ratelimit.Upstream('test', rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+      upstream.call(lambda: None)
+    self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+  def test_call_async(self):
+    upstream = ratelimit.Upstream('test', max_concurrency=2, backoff=0.01)
+    attempts = []
+    async def flaky(x):
+      attempts.append(x)
+      if len(attempts) == 1:
+        raise exceptions.ServiceUnavailable('unavailable')
+      await asyncio.sleep(0.01)
+      return x * 2
+    async def run():
+      return await asyncio.gather(*(upstream.call_async(flaky, i) for i in range(5)))
+    self.assertEqual(asyncio.run(run()), [0, 2, 4, 6, 8])
+    self.assertEqual(upstream.stats['retries'], 1)
+    self.assertEqual(upstream.limiter.in_flight, 0)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,209 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process snapshot of the product reference table.
+
+Joining a handful of neighbor IDs against BigQuery costs a query job per
+request. Instead the reference table is exported to an Arrow IPC file that is
+memory-mapped and indexed by config.COLUMN_ID, so lookups are a dict access
+plus a columnar take. Attributes are parsed from JSON once, when the snapshot
+is written, and stored as a map column.
+
+A background thread periodically re-exports the table and swaps the new
+snapshot in atomically. IDs missing from the snapshot (e.g. products added
+since the last refresh) are fetched from BigQuery.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import pyarrow as pa
+
+import config
+import utils
+
+
+def reference_columns() -> list[str]:
+    return ([config.COLUMN_ID]
+            + config.COLUMN_CATEGORIES[:config.CATEGORY_DEPTH]
+            + [config.COLUMN_ATTRIBUTES, config.COLUMN_DESCRIPTION])
+
+
+def reference_query(ids: Optional[list[str]] = None) -> str:
+    """Query reference columns for the given IDs, or the whole table if None."""
+    where = ''
+    if ids is not None:
+        where = f"WHERE {config.COLUMN_ID} IN {str(ids).replace('[','(').replace(']',')')}"
+    return f"""
+    SELECT
+        {','.join(reference_columns())}
+    FROM
+        `{config.PRODUCT_REFERENCE_TABLE}`
+    {where}
+    """
+
+
+def _parse_attributes(table: pa.Table) -> pa.Table:
+    """Replace the JSON attributes column with a map<string, string> column."""
+    parsed = pa.array(
+        [[(k, str(v)) for k, v in json.loads(a).items()] if a else []
+         for a in table.column(config.COLUMN_ATTRIBUTES).to_pylist()],
+        type=pa.map_(pa.string(), pa.string()))
+    i = table.schema.get_field_index(config.COLUMN_ATTRIBUTES)
+    return table.set_column(i, config.COLUMN_ATTRIBUTES, parsed)
+
+
+def write_snapshot(table: pa.Table, path: str):
+    """Write a reference table to path, atomically replacing any existing file.
+
+    Args:
+        table: reference table with the columns of reference_columns(), and
+            attributes either as JSON strings or already parsed
+        path: destination Arrow IPC file
+    """
+    if not pa.types.is_map(table.schema.field(config.COLUMN_ATTRIBUTES).type):
+        table = _parse_attributes(table)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+def export_snapshot(path: str = config.REFERENCE_SNAPSHOT_PATH):
+    """Export the BigQuery reference table to a snapshot file."""
+    start = time.time()
+    table = utils.get_bq_client().query(reference_query()).result().to_arrow()
+    write_snapshot(table, path)
+    logging.info(f'Exported {table.num_rows} reference rows to {path} in {time.time() - start:.1f}s')
+
+
+class ReferenceSnapshot:
+    """Immutable, memory-mapped snapshot of the reference table."""
+    def __init__(self, table: pa.Table, version: float = 0.0):
+        self.table = table
+        self.version = version
+        self._rows = {id: i for i, id in enumerate(table.column(config.COLUMN_ID).to_pylist())}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._rows
+
+    @classmethod
+    def load(cls, path: str) -> 'ReferenceSnapshot':
+        source = pa.memory_map(path, 'r')
+        table = pa.ipc.open_file(source).read_all() # zero-copy, backed by the mmap
+        return cls(table, os.path.getmtime(path))
+
+    def rows(self, ids: list[str]) -> list[dict]:
+        """Rows for the IDs present in the snapshot, keyed by column name.
+
+        Attributes are returned as a dict, other columns as stored.
+        """
+        indices = [self._rows[id] for id in dict.fromkeys(ids) if id in self._rows]
+        rows = self.table.take(indices).to_pylist()
+        for row in rows:
+            row[config.COLUMN_ATTRIBUTES] = dict(row[config.COLUMN_ATTRIBUTES])
+        return rows
+
+
+class ReferenceStore:
+    """Serves reference rows from a snapshot, falling back to BigQuery.
+
+    Args:
+        path: snapshot file. If it does not exist yet it is exported in the
+            background and lookups go to BigQuery in the meantime
+        refresh_seconds: re-export the snapshot at this interval, None to
+            never refresh
+    """
+    def __init__(self, path: str, refresh_seconds: Optional[float] = None):
+        self.path = path
+        self.refresh_seconds = refresh_seconds
+        self.snapshot = ReferenceSnapshot.load(path) if os.path.exists(path) else None
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self):
+        """Export a new snapshot and swap it in once fully loaded."""
+        with self._refresh_lock:
+            export_snapshot(self.path)
+            self.snapshot = ReferenceSnapshot.load(self.path)
+
+    def start(self):
+        """Start the background refresh thread."""
+        if self._thread is not None:
+            return
+        if self.snapshot is None or self.refresh_seconds:
+            self._thread = threading.Thread(target=self._refresh_loop, name='reference-refresh', daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        if self.snapshot is not None:
+            time.sleep(self.refresh_seconds)
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f'Reference snapshot refresh failed: {e}')
+            if not self.refresh_seconds:
+                return
+            time.sleep(self.refresh_seconds)
+
+    def _split(self, ids: list[str]) -> tuple[list[dict], list[str]]:
+        snapshot = self.snapshot # local reference so a concurrent swap can't mix versions
+        if snapshot is None:
+            return [], list(dict.fromkeys(ids))
+        missing = [id for id in dict.fromkeys(ids) if id not in snapshot]
+        return snapshot.rows(ids), missing
+
+    def rows(self, ids: list[str]) -> list:
+        """Reference rows for the given IDs.
+
+        Returns:
+            list of rows supporting row[column], in no particular order. IDs
+            not found anywhere are omitted
+        """
+        rows, missing = self._split(ids)
+        if missing:
+            logging.info(f'{len(missing)} IDs not in reference snapshot, querying BigQuery')
+            rows += list(utils.get_bq_client().query(reference_query(missing)).result())
+        return rows
+
+    async def rows_async(self, ids: list[str]) -> list:
+        """Async version of rows()."""
+        rows, missing = self._split(ids)
+        if missing:
+            logging.info(f'{len(missing)} IDs not in reference snapshot, querying BigQuery')
+            rows += list(await utils.query_async(reference_query(missing)))
+        return rows
+
+
+@utils.lazy
+def get_store() -> Optional[ReferenceStore]:
+    """Returns the reference store, or None if disabled in config.py."""
+    if not config.REFERENCE_SNAPSHOT_PATH:
+        return None
+    store = ReferenceStore(config.REFERENCE_SNAPSHOT_PATH, config.REFERENCE_REFRESH_SECONDS)
+    store.start()
+    return store
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    export_snapshot()
@@ -0,0 +1,80 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reference Store Unit Tests.
+
+These tests run offline against a synthetic snapshot, with BigQuery stubbed.
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pyarrow as pa
+
+import config
+import reference_store
+
+def reference_table(ids):
+  columns = {config.COLUMN_ID: ids}
+  for i, col in enumerate(config.COLUMN_CATEGORIES):
+    columns[col] = [f'L{i}' if i < 2 else None for _ in ids]
+  columns[config.COLUMN_ATTRIBUTES] = ['{"color": "red", "size": 2}' for _ in ids]
+  columns[config.COLUMN_DESCRIPTION] = [f'description {id}' for id in ids]
+  return pa.table(columns)
+
+class ReferenceStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    d = tempfile.TemporaryDirectory()
+    self.addCleanup(d.cleanup)
+    self.path = os.path.join(d.name, 'products.arrow')
+    reference_store.write_snapshot(reference_table(['a', 'b', 'c']), self.path)
+    bq_row = {config.COLUMN_ID: 'z', config.COLUMN_ATTRIBUTES: '{}', config.COLUMN_DESCRIPTION: ''}
+    self.bq = mock.Mock()
+    self.bq.query.return_value.result.return_value = [bq_row]
+    mock.patch.object(reference_store.utils, 'get_bq_client', return_value=self.bq).start()
+    self.addCleanup(mock.patch.stopall)
+
+  def test_snapshot_rows(self):
+    snapshot = reference_store.ReferenceSnapshot.load(self.path)
+    self.assertEqual(len(snapshot), 3)
+    rows = snapshot.rows(['c', 'a', 'a', 'missing'])
+    self.assertEqual([r[config.COLUMN_ID] for r in rows], ['c', 'a'])
+    self.assertEqual(rows[0][config.COLUMN_ATTRIBUTES], {'color': 'red', 'size': '2'})
+    self.assertEqual(rows[0][config.COLUMN_DESCRIPTION], 'description c')
+
+  def test_store_falls_back_to_bigquery(self):
+    store = reference_store.ReferenceStore(self.path)
+    rows = store.rows(['a', 'z'])
+    self.assertEqual({r[config.COLUMN_ID] for r in rows}, {'a', 'z'})
+    self.assertIn("('z')", self.bq.query.call_args[0][0])
+
+  def test_store_async_no_fallback_needed(self):
+    store = reference_store.ReferenceStore(self.path)
+    rows = asyncio.run(store.rows_async(['a', 'b']))
+    self.assertEqual(len(rows), 2)
+    self.bq.query.assert_not_called()
+
+  def test_refresh_swaps_snapshot(self):
+    store = reference_store.ReferenceStore(self.path)
+    self.bq.query.return_value.result.return_value = mock.Mock(
+      to_arrow=mock.Mock(return_value=reference_table(['d'])))
+    store.refresh()
+    self.assertIn('d', store.snapshot)
+    self.assertNotIn('a', store.snapshot)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,201 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cold start measurement and warmup of the API.
+
+Clients, caches and indexes are created lazily on first use (see
+utils.lazy), so importing the API needs no credentials or network. Left
+alone, the first requests would pay for their creation. Instead, the API
+runs a Warmup in the background at startup. It creates them in parallel and
+primes connections with one cheap call per upstream. /ready returns 503
+until the warmup is done, so the instance gets no traffic before then.
+
+Time is reported per dependency, both for imports (see timed_import()) and
+for initialization (see utils.init_times). To measure a cold start in a
+fresh process:
+
+    python startup.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import json
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+import config # no dependencies, other modules are imported when timed or used
+
+started = time.monotonic()
+import_times = {} # seconds spent importing each module, see timed_import()
+
+DEPENDENCIES = [ # in import order, each timed without the ones before it
+    'numpy',
+    'pyarrow',
+    'fastapi',
+    'google.cloud.bigquery',
+    'google.cloud.aiplatform',
+    'vertexai',
+    'utils',
+    'embeddings',
+    'nearest_neighbors',
+    'reference_store',
+    'category',
+    'attributes',
+    'marketing',
+    'enrich',
+]
+EMBEDDING_DIMENSIONS = 1408
+
+
+def timed_import(names: list[str]):
+    """Import modules in order, recording the time of each in import_times.
+
+    A module's time excludes modules imported before it, so list
+    dependencies before the modules using them.
+    """
+    for name in names:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        import_times.setdefault(name, time.perf_counter() - start)
+
+
+def _bigquery():
+    import utils
+    utils.get_bq_client().query('SELECT 1').result()
+
+
+def _llm():
+    import utils
+    utils.get_cached_llm()
+
+
+def _embeddings():
+    import embeddings
+    embeddings.embed('warmup')
+
+
+def _vector_search():
+    import nearest_neighbors
+    query = [1.0] + [0.0] * (EMBEDDING_DIMENSIONS - 1)
+    nearest_neighbors.find_neighbors([query], num_neighbors=1)
+
+
+def _reference_store():
+    import reference_store
+    reference_store.get_store()
+
+
+def _taxonomy():
+    import taxonomy
+    store = taxonomy.get_store()
+    if store is not None:
+        store.refresh() # requests don't wait for the background load, ready means it is done
+
+
+def _centroid_classifier():
+    import centroid_classifier
+    centroid_classifier.get_classifier()
+
+
+STEPS = {
+    'bigquery': _bigquery,
+    'llm': _llm,
+    'embeddings': _embeddings,
+    'vector_search': _vector_search,
+    'reference_store': _reference_store,
+    'taxonomy': _taxonomy,
+    'centroid_classifier': _centroid_classifier,
+}
+
+
+class Warmup:
+    """Runs warmup steps in parallel, retrying failed ones until they succeed.
+
+    Args:
+        steps: functions to run by name, defaults to STEPS
+        retry_seconds: delay before failed steps are retried, None to not retry
+    """
+    def __init__(
+        self,
+        steps: Optional[dict[str, Callable[[], None]]] = None,
+        retry_seconds: Optional[float] = None):
+        self.steps = STEPS if steps is None else steps
+        self.retry_seconds = config.WARMUP_RETRY_SECONDS if retry_seconds is None else retry_seconds
+        self.times = {}
+        self.errors = {}
+        self.ready_after = None
+        self.done = threading.Event()
+        self._stopped = threading.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_after is not None
+
+    def _run_step(self, name: str):
+        start = time.perf_counter()
+        try:
+            self.steps[name]()
+        except Exception as e:
+            self.errors[name] = f'{type(e).__name__}: {e}'
+            logging.warning(f'Warmup step {name} failed: {e}')
+        else:
+            self.errors.pop(name, None)
+        self.times[name] = time.perf_counter() - start
+
+    def run(self):
+        """Run all steps, returning once they succeeded or could not be retried."""
+        pending = list(self.steps)
+        with ThreadPoolExecutor(max(1, len(pending)), thread_name_prefix='warmup') as pool:
+            while pending:
+                list(pool.map(self._run_step, pending))
+                pending = [name for name in pending if name in self.errors]
+                if pending and (self.retry_seconds is None or self._stopped.wait(self.retry_seconds)):
+                    break
+        if not self.errors:
+            self.ready_after = time.monotonic() - started
+            logging.info(f'Ready after {self.ready_after:.2f}s: {self.report()}')
+        self.done.set()
+
+    def start(self):
+        """Run in a background thread."""
+        threading.Thread(target=self.run, name='warmup', daemon=True).start()
+
+    def stop(self):
+        """Stop retrying failed steps."""
+        self._stopped.set()
+
+    def report(self) -> dict:
+        """Readiness and where startup time went, in seconds."""
+        import utils
+        return {
+            'ready': self.ready,
+            'ready_after': self.ready_after,
+            'imports': import_times,
+            'warmup': self.times,
+            'init': utils.init_times,
+            'errors': self.errors,
+        }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    timed_import(DEPENDENCIES)
+    warmup = Warmup(retry_seconds=None)
+    warmup.run()
+    print(json.dumps(warmup.report(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
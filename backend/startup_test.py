@@ -0,0 +1,74 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Startup Unit Tests.
+
+These tests run fully offline with fake warmup steps.
+"""
+import threading
+import time
+import unittest
+
+import startup
+
+class WarmupTest(unittest.TestCase):
+
+  def test_steps_run_in_parallel(self):
+    steps = {name: lambda: time.sleep(0.1) for name in ('a', 'b', 'c')}
+    warmup = startup.Warmup(steps, retry_seconds=None)
+    start = time.perf_counter()
+    warmup.run()
+    self.assertLess(time.perf_counter() - start, 0.25)
+    self.assertTrue(warmup.ready)
+    self.assertEqual(set(warmup.report()['warmup']), {'a', 'b', 'c'})
+
+  def test_failed_step_is_retried(self):
+    calls = []
+    def flaky():
+      calls.append(1)
+      if len(calls) < 3:
+        raise ConnectionError('unavailable')
+    warmup = startup.Warmup({'flaky': flaky, 'ok': lambda: None}, retry_seconds=0.01)
+    warmup.run()
+    self.assertTrue(warmup.ready)
+    self.assertEqual(len(calls), 3)
+    self.assertEqual(warmup.errors, {})
+
+  def test_not_ready_until_done(self):
+    release = threading.Event()
+    warmup = startup.Warmup({'slow': release.wait}, retry_seconds=None)
+    warmup.start()
+    self.assertFalse(warmup.report()['ready'])
+    release.set()
+    self.assertTrue(warmup.done.wait(1))
+    self.assertTrue(warmup.report()['ready'])
+
+  def test_stop(self):
+    def fail():
+      raise ConnectionError('unavailable')
+    warmup = startup.Warmup({'fail': fail}, retry_seconds=60)
+    warmup.start()
+    time.sleep(0.05)
+    warmup.stop()
+    self.assertTrue(warmup.done.wait(1))
+    self.assertFalse(warmup.ready)
+    self.assertIn('ConnectionError', warmup.errors['fail'])
+
+  def test_timed_import(self):
+    startup.timed_import(['json', 'startup'])
+    self.assertIn('json', startup.import_times)
+    self.assertGreaterEqual(startup.import_times['startup'], 0)
+
+if __name__ == '__main__':
+  unittest.main()
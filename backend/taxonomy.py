@@ -0,0 +1,359 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-memory trie of the category taxonomy, with product counts per node.
+
+The trie holds every category path of the reference table
+(config.COLUMN_CATEGORIES, up to config.CATEGORY_DEPTH levels) and the
+number of products under each node. It is built from one GROUP BY query,
+or from the reference snapshot when it is recent enough (see
+reference_store.py), in a background thread. Requests never wait for it:
+until it is loaded, or if loading fails, filters are not checked and rank
+outputs are not snapped.
+
+The thread checks the modification time of the reference table every
+config.TAXONOMY_CHECK_SECONDS and rebuilds the trie when the table changed
+since it was built. Filters are only rejected when the trie is at least as
+new as the table, so categories added since it was built are not rejected.
+
+It is used to:
+
+- reject category filters no product matches before paying for an
+  embedding and a vector search, see matches()
+- autocomplete category names, see Taxonomy.autocomplete() and
+  /v1/categories/autocomplete
+- snap LLM rank outputs that are misspelled, differently cased or skip a
+  level onto real category paths, see Taxonomy.snap() and category.py
+"""
+import bisect
+from collections import Counter
+import difflib
+import heapq
+import logging
+import re
+import threading
+import time
+from typing import Iterable, Optional
+
+import config
+import metrics
+import reference_store
+import utils
+
+stats = Counter() # filter_rejected, rank_snapped and rank_dropped counts
+metrics.collected(
+    'catalog_taxonomy', 'Taxonomy outcomes: filter_rejected, rank_snapped and rank_dropped LLM lines',
+    ('outcome',), lambda: {(k,): v for k, v in stats.items()}, type='counter')
+
+COUNT_COLUMN = 'product_count'
+
+
+def taxonomy_query() -> str:
+    """Product count of every category path of the reference table."""
+    columns = ','.join(config.COLUMN_CATEGORIES[:config.CATEGORY_DEPTH])
+    return f"""
+    SELECT
+        {columns},
+        COUNT(*) AS {COUNT_COLUMN}
+    FROM
+        `{config.PRODUCT_REFERENCE_TABLE}`
+    GROUP BY
+        {columns}
+    """
+
+
+def _normalize(name: str) -> str:
+    """Case, punctuation and whitespace insensitive form of a category name."""
+    return ' '.join(re.sub(r'[^\w&]+', ' ', re.sub(r"['’]", '', name)).split()).casefold()
+
+
+class Node:
+    """A category and the number of products under it."""
+    __slots__ = ('count', 'children')
+
+    def __init__(self):
+        self.count = 0
+        self.children = {}
+
+
+class Taxonomy:
+    """Trie of category paths, see the module docstring."""
+    def __init__(self):
+        self.root = Node()
+        self.as_of = 0.0 # Unix time of the data it was built from
+        self._names = None # sorted (normalized name suffix, path), see autocomplete()
+
+    @classmethod
+    def from_rows(cls, rows: Iterable) -> 'Taxonomy':
+        """Build from rows supporting row[column] with the category columns.
+
+        A row's path ends at its first null level. Rows are counted once each,
+        or COUNT_COLUMN times if they have it, as returned by taxonomy_query().
+        """
+        taxonomy = cls()
+        columns = config.COLUMN_CATEGORIES[:config.CATEGORY_DEPTH]
+        for row in rows:
+            path = []
+            for column in columns:
+                if not row[column]:
+                    break
+                path.append(row[column])
+            count = row[COUNT_COLUMN] if COUNT_COLUMN in row.keys() else 1
+            taxonomy.add(path, count)
+        return taxonomy
+
+    def add(self, path: list[str], count: int = 1):
+        """Add count products under path."""
+        self._names = None
+        node = self.root
+        node.count += count
+        for name in path:
+            node = node.children.setdefault(name, Node())
+            node.count += count
+
+    def node(self, prefix: list[str]) -> Optional[Node]:
+        node = self.root
+        for name in prefix:
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def count(self, prefix: list[str]) -> int:
+        """Number of products under the category prefix, 0 if it does not exist."""
+        node = self.node(prefix)
+        return node.count if node is not None else 0
+
+    def children(self, prefix: list[str] = []) -> list[tuple[str, int]]:
+        """(name, count) of the subcategories of prefix, most products first."""
+        node = self.node(prefix)
+        if node is None:
+            return []
+        return sorted(((name, child.count) for name, child in node.children.items()), key=lambda c: -c[1])
+
+    def paths(self) -> Iterable[tuple[tuple[str], int]]:
+        """(path, count) of every node, parents before children."""
+        stack = [((), self.root)]
+        while stack:
+            path, node = stack.pop()
+            if path:
+                yield path, node.count
+            stack.extend((path + (name,), child) for name, child in node.children.items())
+
+    def _index(self) -> list[tuple[str, tuple[str]]]:
+        if self._names is None:
+            names = []
+            for path, _ in self.paths():
+                name = _normalize(path[-1])
+                # every word start, so 'jea' completes "Men's Jeans"
+                names.extend((name[m.start():], path) for m in re.finditer(r'\S+', name))
+            names.sort()
+            self._names = names
+        return self._names
+
+    def autocomplete(self, query: str, prefix: list[str] = [], limit: int = 10) -> list[tuple[tuple[str], int]]:
+        """Categories with a word of their name starting with query.
+
+        Args:
+            query: start of a word of the category name, case and punctuation
+                insensitive. Empty to list the subcategories of prefix
+            prefix: only complete categories under this category prefix
+            limit: max number of results
+
+        Returns:
+            (path, count) tuples, most products first
+        """
+        prefix = tuple(prefix)
+        query = _normalize(query)
+        if not query:
+            return [(prefix + (name,), count) for name, count in self.children(list(prefix))[:limit]]
+        names = self._index()
+        matches = {}
+        for name, path in names[bisect.bisect_left(names, (query,)):]:
+            if not name.startswith(query):
+                break
+            if path[:len(prefix)] == prefix and len(path) > len(prefix):
+                matches[path] = self.count(list(path))
+        return heapq.nsmallest(limit, matches.items(), key=lambda m: (-m[1], len(m[0]), m[0]))
+
+    def snap(self, parts: list[str], cutoff: float = config.TAXONOMY_SNAP_CUTOFF) -> Optional[tuple[str]]:
+        """The real category path closest to an LLM output.
+
+        Each part is matched among the subcategories of the path so far,
+        exactly or ignoring case and punctuation. Failing that, it is matched
+        the same way among their children, for when a level was left out, if
+        only one matches. Then by closest spelling among the subcategories
+        (difflib ratio of at least cutoff). Parts matching nothing are skipped.
+
+        Returns:
+            the path, which may be shorter than parts, or None if no part
+            matched
+        """
+        node, path = self.root, ()
+        for part in parts:
+            name = _match(part, node.children)
+            if name is not None:
+                node, path = node.children[name], path + (name,)
+                continue
+            skipped = [(parent, name) for parent, child in node.children.items()
+                       if (name := _match(part, child.children)) is not None]
+            if len(skipped) == 1:
+                parent, name = skipped[0]
+                node, path = node.children[parent].children[name], path + (parent, name)
+                continue
+            name = _match(part, node.children, cutoff)
+            if name is not None:
+                node, path = node.children[name], path + (name,)
+        return path or None
+
+
+def _match(part: str, names: dict, cutoff: Optional[float] = None) -> Optional[str]:
+    """Name equal to part ignoring case and punctuation, else the closest spelling if cutoff is given."""
+    if part in names:
+        return part
+    normalized = {_normalize(name): name for name in names}
+    part = _normalize(part)
+    if part in normalized:
+        return normalized[part]
+    if cutoff is None:
+        return None
+    close = difflib.get_close_matches(part, list(normalized), n=1, cutoff=cutoff)
+    return normalized[close[0]] if close else None
+
+
+def table_modified() -> float:
+    """Last modification time of the reference table, as a Unix timestamp."""
+    return utils.get_bq_client().get_table(config.PRODUCT_REFERENCE_TABLE).modified.timestamp()
+
+
+def load_taxonomy(modified: Optional[float] = None) -> Taxonomy:
+    """Build the taxonomy from the reference snapshot, or BigQuery if the
+    snapshot is missing or older than modified."""
+    start = time.time()
+    store = reference_store.get_store()
+    snapshot = store.snapshot if store is not None else None
+    if snapshot is not None and (modified is None or snapshot.version >= modified):
+        columns = config.COLUMN_CATEGORIES[:config.CATEGORY_DEPTH]
+        counts = snapshot.table.group_by(columns, use_threads=False).aggregate([([], 'count_all')])
+        rows = [{**row, COUNT_COLUMN: row['count_all']} for row in counts.to_pylist()]
+        as_of = snapshot.version
+    else:
+        rows = utils.get_bq_client().query(taxonomy_query()).result()
+        as_of = start
+    taxonomy = Taxonomy.from_rows(rows)
+    taxonomy.as_of = as_of
+    logging.info(f'Loaded taxonomy of {taxonomy.root.count} products in {time.time() - start:.1f}s')
+    return taxonomy
+
+
+class TaxonomyStore:
+    """Holds the current taxonomy and rebuilds it in the background.
+
+    Nothing is loaded until refresh() is called, by start() or the warmup.
+
+    Args:
+        refresh_seconds: rebuild interval even if the table did not change,
+            None to only rebuild on changes
+        check_seconds: interval between checks of the table modification
+            time, None to not check in the background
+    """
+    def __init__(self, refresh_seconds: Optional[float] = None, check_seconds: Optional[float] = None):
+        self.refresh_seconds = refresh_seconds
+        self.check_seconds = check_seconds
+        self.taxonomy = None
+        self.modified = None # of the reference table at the last check, None if unknown
+        self._loaded = None # time.monotonic() of the last load
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def current(self) -> Optional[Taxonomy]:
+        """The taxonomy if it is at least as new as the reference table, None otherwise."""
+        taxonomy, modified = self.taxonomy, self.modified
+        if taxonomy is None or modified is None or taxonomy.as_of < modified:
+            return None
+        return taxonomy
+
+    def refresh(self):
+        """Check the table modification time and rebuild the taxonomy if it is older.
+
+        Concurrent calls wait for each other, so the taxonomy is only
+        rebuilt once.
+        """
+        with self._lock:
+            try:
+                self.modified = table_modified()
+            except Exception as e:
+                self.modified = None
+                logging.warning(f'Reference table modification time unknown, filters are not checked: {e}')
+            taxonomy = self.taxonomy
+            if (taxonomy is None
+                    or (self.modified is not None and taxonomy.as_of < self.modified)
+                    or (self.refresh_seconds and time.monotonic() - self._loaded >= self.refresh_seconds)):
+                self.taxonomy = load_taxonomy(self.modified)
+                self._loaded = time.monotonic()
+
+    def start(self):
+        """Start the background thread, loading the taxonomy then checking for changes."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_loop, name='taxonomy-refresh', daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f'Taxonomy refresh failed: {e}')
+            if not self.check_seconds:
+                return
+            time.sleep(self.check_seconds)
+
+
+@utils.lazy
+def get_store() -> Optional[TaxonomyStore]:
+    """Returns the taxonomy store, or None if disabled in config.py.
+
+    Doesn't block, the taxonomy is loaded in the background.
+    """
+    if not config.TAXONOMY_ENABLED:
+        return None
+    store = TaxonomyStore(config.TAXONOMY_REFRESH_SECONDS, config.TAXONOMY_CHECK_SECONDS)
+    store.start()
+    return store
+
+
+def get_taxonomy() -> Optional[Taxonomy]:
+    """The latest taxonomy, or None if disabled or not loaded (yet)."""
+    store = get_store()
+    return store.taxonomy if store is not None else None
+
+
+def matches(filters: list[str]) -> bool:
+    """Whether any product is under the category filters.
+
+    True when the taxonomy is unavailable or older than the reference
+    table, so filters are then checked by the vector search as before.
+    """
+    if not filters:
+        return True
+    store = get_store()
+    taxonomy = store.current if store is not None else None
+    if taxonomy is None or not taxonomy.root.count:
+        return True
+    if taxonomy.count(filters[:config.CATEGORY_DEPTH]):
+        return True
+    stats['filter_rejected'] += 1
+    logging.info(f'No product matches category filters {filters}')
+    return False
@@ -0,0 +1,229 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Taxonomy Unit Tests.
+
+These tests run fully offline against small taxonomies and the synthetic
+catalog of fakes.py.
+"""
+import asyncio
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+import pyarrow as pa
+
+import api
+import category
+import config
+import embeddings
+import enrich
+import fakes
+import reference_store
+import taxonomy
+
+def row(*path, count=None):
+  res = dict(zip(config.COLUMN_CATEGORIES, list(path) + [None] * (len(config.COLUMN_CATEGORIES) - len(path))))
+  if count is not None:
+    res[taxonomy.COUNT_COLUMN] = count
+  return res
+
+ROWS = [
+  row('Clothing', "Men's Clothing", 'Jeans', 'Slim Jeans', count=5),
+  row('Clothing', "Men's Clothing", 'Jeans', 'Bootcut Jeans', count=2),
+  row('Clothing', "Women's Clothing", 'Jeans', 'Skinny Jeans', count=4),
+  row('Clothing', "Women's Clothing", 'Dresses', 'Maxi Dresses', count=3),
+  row('Footwear', 'Sports Shoes', count=6), # trailing nulls
+]
+
+class TaxonomyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.taxonomy = taxonomy.Taxonomy.from_rows(ROWS)
+
+  def test_counts(self):
+    self.assertEqual(self.taxonomy.root.count, 20)
+    self.assertEqual(self.taxonomy.count(['Clothing']), 14)
+    self.assertEqual(self.taxonomy.count(['Clothing', "Men's Clothing", 'Jeans']), 7)
+    self.assertEqual(self.taxonomy.count(['Footwear', 'Sports Shoes']), 6)
+    self.assertEqual(self.taxonomy.count(['Clothing', 'Footwear']), 0)
+    self.assertEqual(self.taxonomy.children(['Clothing']), [("Men's Clothing", 7), ("Women's Clothing", 7)])
+
+  def test_rows_without_counts(self):
+    tree = taxonomy.Taxonomy.from_rows([row('a', 'b'), row('a', 'b'), row('a', 'c', 'd')])
+    self.assertEqual(tree.count(['a']), 3)
+    self.assertEqual(tree.count(['a', 'b']), 2)
+
+  def test_autocomplete(self):
+    res = self.taxonomy.autocomplete('jea')
+    self.assertEqual(res[0], (('Clothing', "Men's Clothing", 'Jeans'), 7))
+    self.assertEqual(len(res), 5) # every word start e.g. 'Slim Jeans'
+    self.assertEqual([p for p, _ in self.taxonomy.autocomplete('JEANS', ["Women's Clothing"])], [])
+    self.assertEqual([p[-1] for p, _ in self.taxonomy.autocomplete('jeans', ['Clothing', "Women's Clothing"])],
+                     ['Jeans', 'Skinny Jeans'])
+    self.assertEqual(self.taxonomy.autocomplete('mens'), [(('Clothing', "Men's Clothing"), 7)])
+    self.assertEqual(self.taxonomy.autocomplete('', ['Footwear']), [(('Footwear', 'Sports Shoes'), 6)])
+    self.assertEqual(len(self.taxonomy.autocomplete('j', limit=2)), 2)
+
+  def test_snap(self):
+    jeans = ('Clothing', "Men's Clothing", 'Jeans', 'Slim Jeans')
+    self.assertEqual(self.taxonomy.snap(list(jeans)), jeans)
+    self.assertEqual(self.taxonomy.snap(['clothing', 'MENS CLOTHING', 'jeans', 'slim jeans']), jeans)
+    self.assertEqual(self.taxonomy.snap(['Clothing', "Men's Clothng", 'Jeans', 'Slim Jean']), jeans)
+    # a level left out, and one made up
+    self.assertEqual(self.taxonomy.snap(['Clothing', 'Dresses', 'Maxi Dresses']),
+                     ('Clothing', "Women's Clothing", 'Dresses', 'Maxi Dresses'))
+    self.assertEqual(self.taxonomy.snap(['Clothing', "Men's Clothing", 'Denim', 'Jeans', 'Slim Jeans']), jeans)
+    # ambiguous: Jeans is under both Men's and Women's Clothing
+    self.assertEqual(self.taxonomy.snap(['Clothing', 'Jeans']), ('Clothing',))
+    self.assertIsNone(self.taxonomy.snap(['Furniture']))
+
+  def test_snapshot(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'products.arrow')
+      rows = [row('a', 'b'), row('a', 'b'), row('a', 'c')]
+      table = pa.Table.from_pylist([{config.COLUMN_ID: str(i), **r, config.COLUMN_ATTRIBUTES: '{}',
+                                     config.COLUMN_DESCRIPTION: ''} for i, r in enumerate(rows)])
+      reference_store.write_snapshot(table, path)
+      store = reference_store.ReferenceStore(path)
+      with mock.patch.object(reference_store, 'get_store', return_value=store), \
+           mock.patch.object(taxonomy.utils, 'get_bq_client') as bq:
+        tree = taxonomy.load_taxonomy()
+    bq.assert_not_called()
+    self.assertEqual(tree.children(['a']), [('b', 2), ('c', 1)])
+
+class MatchesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tree = taxonomy.Taxonomy.from_rows(ROWS)
+    self.tree.as_of = 200.0
+    self.store = taxonomy.TaxonomyStore()
+    self.store.taxonomy, self.store.modified = self.tree, 100.0
+    mock.patch.object(taxonomy, 'get_store', return_value=self.store).start()
+    self.addCleanup(mock.patch.stopall)
+
+  def test_matches(self):
+    self.assertTrue(taxonomy.matches([]))
+    self.assertTrue(taxonomy.matches(['Clothing', "Men's Clothing"]))
+    self.assertFalse(taxonomy.matches(['Clothing', 'Sports Shoes']))
+
+  def test_unavailable(self):
+    self.store.taxonomy = None # not loaded yet, or loading failed
+    with mock.patch.object(taxonomy.utils, 'get_bq_client') as bq:
+      self.assertTrue(taxonomy.matches(['anything']))
+    bq.assert_not_called() # no load on the request path
+    self.store.taxonomy = taxonomy.Taxonomy()
+    self.assertTrue(taxonomy.matches(['anything']))
+
+  def test_older_than_table(self):
+    self.store.modified = 300.0 # a category may have been added since the trie was built
+    self.assertTrue(taxonomy.matches(['Clothing', 'Sports Shoes']))
+    self.store.modified = None # modification time unknown
+    self.assertTrue(taxonomy.matches(['Clothing', 'Sports Shoes']))
+
+  def test_parse_rank_snaps(self):
+    candidates = [['Clothing', "Men's Clothing", 'Jeans', 'Slim Jeans'],
+                  ['Clothing', "Women's Clothing", 'Dresses', 'Maxi Dresses']]
+    text = '1. clothing->mens clothing->jeans->slim jeans\n2. Clothing->Dresses->Maxi Dresses\n3. Clothing'
+    with mock.patch.object(taxonomy, 'get_taxonomy', return_value=self.tree):
+      res = category._parse_rank(text, candidates)
+    self.assertEqual(res, [tuple(c) for c in candidates])
+
+class StoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.bq = mock.Mock()
+    self.bq.query.return_value.result.return_value = ROWS
+    self.set_modified(100.0)
+    mock.patch.object(taxonomy.utils, 'get_bq_client', return_value=self.bq).start()
+    mock.patch.object(reference_store, 'get_store', return_value=None).start()
+    self.addCleanup(mock.patch.stopall)
+
+  def set_modified(self, timestamp):
+    self.bq.get_table.return_value.modified = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+  def test_rebuilt_when_table_changes(self):
+    store = taxonomy.TaxonomyStore()
+    self.assertIsNone(store.current)
+    store.refresh()
+    store.refresh()
+    self.assertEqual(self.bq.query.call_count, 1)
+    self.assertIs(store.current, store.taxonomy)
+    store.taxonomy.as_of = 150.0
+    self.set_modified(160.0)
+    store.refresh()
+    self.assertEqual(self.bq.query.call_count, 2)
+    self.assertIsNotNone(store.current)
+
+  def test_failed_load(self):
+    self.bq.query.side_effect = RuntimeError('BigQuery down')
+    store = taxonomy.TaxonomyStore()
+    with self.assertRaises(RuntimeError):
+      store.refresh()
+    self.assertIsNone(store.taxonomy)
+    with mock.patch.object(taxonomy, 'get_store', return_value=store):
+      self.assertTrue(taxonomy.matches(['anything']))
+    self.assertEqual(self.bq.query.call_count, 1) # not retried by the request
+
+  def test_stale_snapshot_not_used(self):
+    snapshot = mock.Mock(version=50.0)
+    with mock.patch.object(reference_store, 'get_store', return_value=mock.Mock(snapshot=snapshot)):
+      tree = taxonomy.load_taxonomy(modified=100.0)
+    self.assertEqual(self.bq.query.call_count, 1)
+    self.assertGreater(tree.as_of, 100.0)
+
+class PipelineTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.catalog = fakes.Catalog(200)
+
+  def setUp(self):
+    embeddings.get_cache.cache_clear()
+
+  def test_rejects_unknown_filters_before_any_rpc(self):
+    desc = self.catalog.description(1)
+    with fakes.installed(self.catalog) as f:
+      categories = asyncio.run(category.retrieve_and_rank_async(desc, filters=['Category 1', 'Category 2.1']))
+      res = asyncio.run(enrich.enrich_async(desc, filters=['Unknown']))
+      self.assertEqual(f.bigquery.queries, 0) # the taxonomy was loaded before any request
+      known = asyncio.run(category.retrieve_and_rank_async(desc, filters=['Category 1', 'Category 1.2']))
+    self.assertEqual(categories, [['ERROR: No existing products match that category']])
+    self.assertEqual(res['attributes'], {'error':'ERROR: no existing products match that category'})
+    self.assertEqual(f.embedding.calls, 1)
+    self.assertEqual(known[0][:2], ('Category 1', 'Category 1.2'))
+
+  def test_autocomplete_endpoint(self):
+    async def get(client, **params):
+      return await client.get('/v1/categories/autocomplete', params=params)
+    async def run():
+      async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url='http://test') as client:
+        return (await get(client, q='category 1.2.3', limit=2),
+                await get(client, category=['Category 1', 'Category 1.1']),
+                await get(client, q='x', limit=0))
+    with fakes.installed(self.catalog):
+      completed, children, invalid = asyncio.run(run())
+    self.assertEqual(completed.status_code, 200)
+    self.assertEqual(len(completed.json()), 2)
+    self.assertTrue(all(c['category'][2].startswith('Category 1.2.3') for c in completed.json()))
+    self.assertEqual([c['category'][:2] for c in children.json()], [['Category 1', 'Category 1.1']] * 3)
+    self.assertEqual(sum(c['count'] for c in children.json()),
+                     sum(self.catalog.leaves[p['leaf']][1] == 'Category 1.1' for p in self.catalog.products.values()))
+    self.assertEqual(invalid.status_code, 422)
+
+if __name__ == '__main__':
+  unittest.main()
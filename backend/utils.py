@@ -13,18 +13,208 @@
 # limitations under the License.
 
 """Functions common to several modules."""
-from functools import cache
+import asyncio
+import functools
+import json
+import logging
+import threading
+import time
+from typing import Callable, Hashable, NamedTuple, Optional
+import weakref
+
 from google.cloud import bigquery
 import vertexai
+import caching
 import config
+import metrics
+import ratelimit
+
+_loop_clients = weakref.WeakKeyDictionary()
+init_times = {} # seconds spent in each lazy() function, see startup.py
+
+def lazy(fn: Callable) -> Callable:
+    """Thread-safe functools.cache for functions creating clients.
+
+    functools.cache lets concurrent first calls each run fn, creating several
+    clients or loading an index several times. Here they wait for a single
+    call instead. Calls with other arguments are not blocked. Exceptions are
+    not cached, so a failed initialization is retried on the next call.
+
+    The duration of each initialization is recorded in init_times, keyed on
+    the function name (and arguments, if any).
+    """
+    values, locks, lock = {}, {}, threading.Lock()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        if key in values:
+            return values[key]
+        with lock:
+            key_lock = locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in values:
+                start = time.perf_counter()
+                values[key] = fn(*args, **kwargs)
+                name = f'{fn.__module__}.{fn.__name__}'
+                if args or kwargs:
+                    name += repr(args + tuple(kwargs.values()))
+                init_times[name] = time.perf_counter() - start
+        return values[key]
+
+    def cache_clear():
+        with lock:
+            values.clear()
+            locks.clear()
+
+    def peek(*args, **kwargs):
+        """The value if already initialized, None otherwise."""
+        return values.get((args, tuple(sorted(kwargs.items()))))
 
-@cache
+    wrapper.cache_clear = cache_clear
+    wrapper.peek = peek
+    return wrapper
+
+@lazy
 def get_bq_client(project=config.PROJECT):
     return bigquery.Client(project)
 
-@cache
-def get_llm(project=config.PROJECT, location=config.LOCATION):
+@lazy
+def get_llm(project=config.PROJECT, location=config.LOCATION, model=config.LLM_MODEL):
     vertexai.init(project=config.PROJECT, location=config.LOCATION)
-    return vertexai.language_models.TextGenerationModel.from_pretrained("text-bison")
+    return vertexai.language_models.TextGenerationModel.from_pretrained(model)
+
+class RateLimitedLLM:
+    """Wraps a TextGenerationModel, sending predict calls through ratelimit.
+
+    Other attributes (e.g. predict_streaming) are forwarded to the model.
+    """
+    def __init__(self, llm):
+        self.llm = llm
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def predict(self, prompt: str, cache_key: Optional[str] = None, **params):
+        """cache_key is accepted for compatibility with CachedLLM and ignored."""
+        return ratelimit.call('llm', self.llm.predict, prompt, **params)
+
+    async def predict_async(self, prompt: str, cache_key: Optional[str] = None, **params):
+        return await ratelimit.call_async('llm', self.llm.predict_async, prompt, **params)
+
+class LLMResponse(NamedTuple):
+    """Stand-in for a TextGenerationResponse served from cache."""
+    text: str
+
+class CachedLLM:
+    """Wraps a TextGenerationModel, caching the text of its responses.
+
+    Entries are keyed on the model, the prompt and the generation parameters.
+    Callers whose prompts vary with inconsequential details (e.g. the order
+    of candidates) can pass a canonical cache_key to stand in for the prompt
+    in the key, to maximize hits without changing the prompt. Changing
+    config.LLM_MODEL invalidates all entries.
+
+    Calls with a non-zero temperature are sampled and are only cached if
+    config.LLM_CACHE_NONZERO_TEMPERATURE is set. Empty responses are never
+    cached.
+
+    Other attributes (e.g. predict_streaming) are forwarded to the model.
+    """
+    def __init__(self, llm, cache: caching.TieredCache, model: str = config.LLM_MODEL):
+        self.llm = llm
+        self.cache = cache
+        self.model = model
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def _key(self, prompt: str, params: dict) -> str:
+        if params.get('temperature') and not config.LLM_CACHE_NONZERO_TEMPERATURE:
+            return None
+        return caching.content_hash(self.model, prompt, json.dumps(params, sort_keys=True))
+
+    def predict(self, prompt: str, cache_key: Optional[str] = None, **params):
+        key = self._key(cache_key or prompt, params)
+        if key and (text := self.cache.get(key)) is not None:
+            return LLMResponse(text.decode('utf-8'))
+        response = self.llm.predict(prompt, **params)
+        if key and response.text:
+            self.cache.put(key, response.text.encode('utf-8'))
+        return response
+
+    async def predict_async(self, prompt: str, cache_key: Optional[str] = None, **params):
+        key = self._key(cache_key or prompt, params)
+        if key and (text := self.cache.get(key)) is not None:
+            return LLMResponse(text.decode('utf-8'))
+        response = await self.llm.predict_async(prompt, **params)
+        if key and response.text:
+            self.cache.put(key, response.text.encode('utf-8'))
+        return response
+
+    def stats(self) -> dict[str, float]:
+        """Hit/miss counters of the cache."""
+        return self.cache.stats()
+
+@lazy
+def get_cached_llm(project=config.PROJECT, location=config.LOCATION, model=config.LLM_MODEL):
+    """get_llm() behind ratelimit and an in-memory LRU and optional SQLite cache."""
+    llm = RateLimitedLLM(get_llm(project, location, model))
+    if not config.LLM_CACHE_MAX_BYTES and not config.LLM_CACHE_PATH:
+        logging.info('LLM cache disabled')
+        return llm
+    cache = caching.tiered_cache(
+        config.LLM_CACHE_MAX_BYTES,
+        config.LLM_CACHE_PATH,
+        table='llm',
+        ttl=config.LLM_CACHE_TTL_SECONDS)
+    return CachedLLM(llm, cache, model)
+
+def _llm_cache_stats() -> dict:
+    llm = get_cached_llm.peek() # don't create the LLM client to report on it
+    return {(k,): v for k, v in llm.stats().items()} if isinstance(llm, CachedLLM) else {}
+
+metrics.collected(
+    'catalog_llm_cache', 'LLM cache counters, see caching.TieredCache.stats()',
+    ('stat',), _llm_cache_stats)
+
+def get_loop_client(key: Hashable, factory: Callable):
+    """Returns an async client bound to the running event loop.
+
+    grpc.aio based clients cannot be shared across event loops, so one client
+    is created per event loop and key.
+
+    Args:
+        key: identifies the client e.g. ('match', api_endpoint)
+        factory: called without arguments to create the client
+    """
+    clients = _loop_clients.setdefault(asyncio.get_running_loop(), {})
+    if key not in clients:
+        clients[key] = factory()
+    return clients[key]
+
+async def query_async(
+    query: str,
+    client: bigquery.Client = None,
+    poll_interval: float = 0.05,
+    max_poll_interval: float = 1.0) -> bigquery.table.RowIterator:
+    """Run a BigQuery query without holding a thread while it executes.
+
+    Only the short job insert and status RPCs run in a worker thread, the
+    wait between polls happens on the event loop with exponential backoff.
 
+    Args:
+        query: SQL query
+        client: BigQuery client, defaults to get_bq_client()
+        poll_interval: initial delay between job status checks in seconds
+        max_poll_interval: max delay between job status checks in seconds
 
+    Returns:
+        the query results
+    """
+    client = client or get_bq_client()
+    job = await asyncio.to_thread(client.query, query)
+    while not await asyncio.to_thread(job.done):
+        await asyncio.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, max_poll_interval)
+    return await asyncio.to_thread(job.result)
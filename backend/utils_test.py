@@ -0,0 +1,127 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Utils Unit Tests.
+
+These tests run fully offline against a fake LLM.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import caching
+import config
+import utils
+
+class FakeLLM:
+  def __init__(self):
+    self.calls = 0
+
+  def predict(self, prompt, **params):
+    self.calls += 1
+    return utils.LLMResponse(f'answer {self.calls}')
+
+  async def predict_async(self, prompt, **params):
+    return self.predict(prompt, **params)
+
+class CachedLLMTest(unittest.TestCase):
+
+  def setUp(self):
+    self.fake = FakeLLM()
+    self.llm = utils.CachedLLM(self.fake, caching.tiered_cache(1024**2), 'text-bison@002')
+
+  def test_cache_hit(self):
+    first = self.llm.predict('prompt', temperature=0, max_output_tokens=10)
+    second = self.llm.predict('prompt', max_output_tokens=10, temperature=0)
+    self.assertEqual(first.text, second.text)
+    self.assertEqual(self.fake.calls, 1)
+    self.assertEqual(self.llm.stats()['memory_hits'], 1)
+
+  def test_params_and_model_in_key(self):
+    self.llm.predict('prompt', temperature=0, max_output_tokens=10)
+    self.llm.predict('prompt', temperature=0, max_output_tokens=20)
+    other_model = utils.CachedLLM(self.fake, self.llm.cache, 'text-bison@001')
+    other_model.predict('prompt', temperature=0, max_output_tokens=10)
+    self.assertEqual(self.fake.calls, 3)
+
+  def test_nonzero_temperature_not_cached(self):
+    self.llm.predict('prompt', temperature=0.5)
+    self.llm.predict('prompt', temperature=0.5)
+    self.assertEqual(self.fake.calls, 2)
+    with mock.patch.object(config, 'LLM_CACHE_NONZERO_TEMPERATURE', True):
+      self.llm.predict('prompt', temperature=0.5)
+      self.llm.predict('prompt', temperature=0.5)
+    self.assertEqual(self.fake.calls, 3)
+
+  def test_predict_async(self):
+    first = asyncio.run(self.llm.predict_async('prompt', temperature=0))
+    second = asyncio.run(self.llm.predict_async('prompt', temperature=0))
+    self.assertEqual(first.text, second.text)
+    self.assertEqual(self.fake.calls, 1)
+
+  def test_cache_key(self):
+    self.llm.predict('a, b', cache_key='{a, b}', temperature=0)
+    self.assertEqual(self.llm.predict('b, a', cache_key='{a, b}', temperature=0).text, 'answer 1')
+    self.llm.predict('a, b', temperature=0) # keyed on the prompt
+    self.assertEqual(self.fake.calls, 2)
+
+  def test_cache_key_ignored_without_cache(self):
+    self.assertEqual(utils.RateLimitedLLM(self.fake).predict('a, b', cache_key='{a, b}').text, 'answer 1')
+
+  def test_persisted(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, 'llm.sqlite')
+      llm = utils.CachedLLM(self.fake, caching.tiered_cache(1024**2, path, table='llm'))
+      llm.predict('prompt', temperature=0)
+      llm = utils.CachedLLM(self.fake, caching.tiered_cache(1024**2, path, table='llm'))
+      self.assertEqual(llm.predict('prompt', temperature=0).text, 'answer 1')
+    self.assertEqual(self.fake.calls, 1)
+
+class LazyTest(unittest.TestCase):
+
+  def test_concurrent_first_calls_initialize_once(self):
+    calls = []
+    @utils.lazy
+    def get_client(name):
+      calls.append(name)
+      time.sleep(0.05)
+      return object()
+    with ThreadPoolExecutor(8) as pool:
+      clients = list(pool.map(lambda _: get_client('a'), range(8)))
+    self.assertEqual(calls, ['a'])
+    self.assertTrue(all(c is clients[0] for c in clients))
+    self.assertIsNot(get_client('b'), clients[0])
+    self.assertIn("utils_test.get_client('a',)", utils.init_times)
+
+  def test_failure_is_retried(self):
+    calls = []
+    @utils.lazy
+    def get_client():
+      calls.append(1)
+      if len(calls) == 1:
+        raise ConnectionError('unavailable')
+      return 'client'
+    with self.assertRaises(ConnectionError):
+      get_client()
+    self.assertEqual(get_client(), 'client')
+    get_client.cache_clear()
+    get_client()
+    self.assertEqual(len(calls), 3)
+
+if __name__ == '__main__':
+  unittest.main()